@@ -91,6 +91,13 @@ class Authorizer(object):
         """
         raise NotImplementedError('list_authorized_users')
 
+    def get_user_data_version(self):
+        """
+        @return A hashable object that changes whenever users or user authorizations change, or None if
+                this cannot be determined.
+        """
+        return None
+
     def create_authorizer(self):
         """
         Clone self with fresh connections. Use readonly_config if available.
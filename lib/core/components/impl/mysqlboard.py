@@ -33,13 +33,13 @@ class MySQLUpdateBoard(UpdateBoard):
         self._mysql.lock_tables(write = ['inventory_updates'])
 
         try:
-            sql = 'INSERT INTO `inventory_updates` (`cmd`, `obj`) VALUES (%s, %s)'
+            cmd_names = {DynamoInventory.CMD_UPDATE: 'update', DynamoInventory.CMD_DELETE: 'delete'}
 
-            for cmd, sobj in update_commands:
-                if cmd == DynamoInventory.CMD_UPDATE:
-                    self._mysql.query(sql, 'update', sobj)
-                elif cmd == DynamoInventory.CMD_DELETE:
-                    self._mysql.query(sql, 'delete', sobj)
+            fields = ('cmd', 'obj')
+            mapping = lambda (cmd, sobj): (cmd_names[cmd], sobj)
+            entries = (c for c in update_commands if c[0] in cmd_names)
+
+            self._mysql.insert_many('inventory_updates', fields, mapping, entries, do_update = False)
 
         finally:
             self._mysql.unlock_tables()
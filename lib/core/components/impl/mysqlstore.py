@@ -15,7 +15,11 @@ class MySQLInventoryStore(InventoryStore):
     def __init__(self, config):
         InventoryStore.__init__(self, config)
 
-        self._mysql = MySQL(config.db_params)
+        # Files and block replica files are written with LOAD DATA LOCAL INFILE
+        db_params = Configuration(config.db_params)
+        db_params['local_infile'] = config.get('bulk_load', True)
+
+        self._mysql = MySQL(db_params)
 
     def close(self):
         self._mysql.close()
@@ -599,7 +603,7 @@ class MySQLInventoryStore(InventoryStore):
         fields = ('id', 'block_id', 'size', 'name') + File.checksum_algorithms
         mapping = lambda lfile: (lfile.id, lfile.block.id, lfile.size, lfile.lfn) + lfile.checksum
 
-        num = self._mysql.insert_many('files_tmp', fields, mapping, files, do_update = False)
+        num = self._mysql.insert_many('files_tmp', fields, mapping, files, do_update = False, bulk_load = True, pipelined = True)
 
         self._mysql.query('DROP TABLE `files`')
         self._mysql.query('RENAME TABLE `files_tmp` TO `files`')
@@ -656,7 +660,7 @@ class MySQLInventoryStore(InventoryStore):
                     for file_id in replica.file_ids:
                         yield (replica.block.id, replica.site.id, file_id)
     
-            self._mysql.insert_many('block_replica_files_tmp', fields, None, get_filereplicas(), do_update = False)
+            self._mysql.insert_many('block_replica_files_tmp', fields, None, get_filereplicas(), do_update = False, bulk_load = True, pipelined = True)
 
             self._mysql.query('DROP TABLE `block_replica_files`')
             self._mysql.query('RENAME TABLE `block_replica_files_tmp` TO `block_replica_files`')
@@ -1063,6 +1067,21 @@ class MySQLInventoryStore(InventoryStore):
             # new insert
             lfile.id = file_id
 
+    def save_files(self, files): #override
+        files = [f for f in files if f.block.dataset.id != 0 and f.block.id != 0]
+        if len(files) == 0:
+            return
+
+        fields = ('block_id', 'size', 'name') + File.checksum_algorithms
+        mapping = lambda lfile: (lfile.block.id, lfile.size, lfile.lfn) + lfile.checksum
+
+        self._mysql.insert_many('files', fields, mapping, files)
+
+        # Read back the ids of the new files
+        by_name = dict((f.lfn, f) for f in files)
+        for name, file_id in self._mysql.select_many('files', ('name', 'id'), 'name', by_name.keys()):
+            by_name[name].id = file_id
+
     def delete_file(self, lfile): #override
         sql = 'DELETE FROM f, brf USING `files` AS f'
         sql += ' LEFT JOIN `block_replica_files` AS brf ON brf.`file_id` = f.`id`'
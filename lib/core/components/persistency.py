@@ -309,6 +309,14 @@ class InventoryStore(object):
 
     def save_file(self, lfile):
         raise NotImplementedError('save_file')
+
+    def save_files(self, files):
+        """
+        Save multiple files. Implementations can override with a bulk operation.
+        @param files  List of File objects
+        """
+        for lfile in files:
+            self.save_file(lfile)
     
     def save_partition(self, partition):
         """
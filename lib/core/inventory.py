@@ -1,4 +1,6 @@
+import sys
 import logging
+import collections
 import re
 
 from dynamo.policy.condition import Condition
@@ -29,10 +31,16 @@ class ObjectRepository(object):
         # This base class does not actually have a persistency store
         self._store = None
 
+        # Incremented at every change through update, delete, and register_update. Identifies the state of the
+        # in-memory content for derived data cached in the process.
+        self.version = 0
+
     def update(self, obj):
+        self.version += 1
         return obj.embed_into(self)
 
     def delete(self, obj):
+        self.version += 1
         try:
             return obj.unlink_from(self)
         except (KeyError, df.ObjectError) as e:
@@ -45,6 +53,106 @@ class ObjectRepository(object):
             LOG.error('Exception in inventory.delete(%s)' % str(obj))
             raise
 
+    @staticmethod
+    def object_key(obj):
+        """
+        @param obj  A (possibly unlinked) inventory object
+        @return Key identifying the object in the inventory.
+        """
+
+        obj_type = type(obj)
+
+        if obj_type is df.File:
+            return (obj_type, obj.lfn)
+        elif obj_type is df.Block:
+            return (obj_type, obj.full_name())
+        elif obj_type is df.BlockReplica:
+            return (obj_type, obj._block_full_name(), obj._site_name())
+        elif obj_type is df.DatasetReplica:
+            return (obj_type, obj._dataset_name(), obj._site_name())
+        elif obj_type is df.SitePartition:
+            return (obj_type, obj._site_name(), obj._partition_name())
+        else:
+            return (obj_type, obj.name)
+
+    @staticmethod
+    def coalesce(commands, merge = None):
+        """
+        Collapse repeated updates of the same object in a sequence of commands. The first update of an object
+        (which may create it) stays in place, and the later updates until the next deletion of the object are
+        replaced by one update with the final state at the position of the last of them. Deletions are kept in
+        place. This keeps the create -> update -> delete order of each object and of the objects depending on it.
+        Updates are not merged across the deletion of a related object (an object of the same dataset, or any
+        site, group, or partition), since the merged state could bring back what the deletion removed.
+        @param commands  List of (cmd, obj, ...). Additional elements are carried along with the command.
+        @param merge     Function (earlier obj, later obj) returning the combined obj. If None, the later obj is used.
+        @return (list of (cmd, obj, ...), number of commands coalesced)
+        """
+
+        result = []
+        # keys of objects with an update since their last deletion
+        updated = set()
+        # key -> index in result of the coalesced update
+        last_update = {}
+        # dataset name (None for other objects) -> keys in last_update
+        scope_keys = collections.defaultdict(set)
+        num_coalesced = 0
+
+        for entry in commands:
+            cmd, obj = entry[:2]
+            key = ObjectRepository.object_key(obj)
+
+            if cmd == DynamoInventory.CMD_UPDATE:
+                if key not in updated:
+                    updated.add(key)
+                else:
+                    try:
+                        index = last_update[key]
+                    except KeyError:
+                        pass
+                    else:
+                        if merge is not None:
+                            entry = (cmd, merge(result[index][1], obj)) + tuple(entry[2:])
+
+                        result[index] = None
+                        num_coalesced += 1
+
+                    last_update[key] = len(result)
+                    scope_keys[ObjectRepository._dataset_scope(obj)].add(key)
+
+            elif cmd == DynamoInventory.CMD_DELETE:
+                updated.discard(key)
+                last_update.pop(key, None)
+
+                # later updates of related objects start a new coalesced update
+                scope = ObjectRepository._dataset_scope(obj)
+                if scope is None:
+                    last_update.clear()
+                    scope_keys.clear()
+                else:
+                    for k in scope_keys.pop(scope, []):
+                        last_update.pop(k, None)
+
+            result.append(entry)
+
+        return [c for c in result if c is not None], num_coalesced
+
+    @staticmethod
+    def _dataset_scope(obj):
+        """
+        @param obj  A (possibly unlinked) inventory object
+        @return Name of the dataset the object belongs to, or None for objects outside datasets.
+        """
+
+        obj_type = type(obj)
+
+        if obj_type is df.Dataset:
+            return obj.name
+        elif obj_type in (df.File, df.Block, df.BlockReplica, df.DatasetReplica):
+            return obj._dataset_name()
+        else:
+            return None
+
     def make_object(self, repstr):
         """
         Create an object from its representation string.
@@ -98,6 +206,8 @@ class DynamoInventoryProxy(ObjectRepository):
         self._store.server_side = False
         df.Block.inventory_store = self._store
 
+        self.version = inventory.version
+
         # When the user application is authorized to change the inventory state, all updated
         # and deleted objects are kept in this list until the end of execution.
         self._update_commands = None
@@ -109,6 +219,8 @@ class DynamoInventoryProxy(ObjectRepository):
         @param obj    Object to embed into this inventory.
         """
 
+        self.version += 1
+
         try:
             embedded_clone, updated = obj.embed_into(self, check = True)
         except:
@@ -125,6 +237,8 @@ class DynamoInventoryProxy(ObjectRepository):
         Put the text representation of obj to _update_commands.
         """
 
+        self.version += 1
+
         if self._update_commands is None:
             return
 
@@ -188,6 +302,15 @@ class DynamoInventory(ObjectRepository):
 
         self.partition_def_path = config.partition_def_path
 
+        # Objects with functions inventory_loaded(inventory), before_change(inventory, obj), after_change(inventory, obj),
+        # start_batch(inventory), and end_batch(inventory), notified when the full content is loaded, around each update
+        # and delete, and around batches of updates. Used to maintain derived data (e.g. aggregated statistics)
+        # incrementally. Exceptions in the observers are logged and do not interrupt the inventory operations.
+        self.observers = []
+
+        # List of files to be written to the store together, or None if writes are immediate
+        self._file_writes = None
+
     def init_store(self, module, config):
         if self._store:
             self._store.close()
@@ -267,6 +390,8 @@ class DynamoInventory(ObjectRepository):
 
         self.loaded = True
 
+        self._notify('inventory_loaded')
+
     def _load_partitions(self):
         """Load partition data from a text table."""
 
@@ -376,9 +501,22 @@ class DynamoInventory(ObjectRepository):
 
         LOG.debug('Saving changes on %s to inventory store.', str(obj))
 
-        embedded_clone = ObjectRepository.update(self, obj)
+        self._notify('before_change', obj)
+
+        try:
+            embedded_clone = ObjectRepository.update(self, obj)
+        finally:
+            self._notify('after_change', obj)
 
         if self._has_store:
+            if self._file_writes is not None:
+                if type(embedded_clone) is df.File:
+                    self._file_writes.append(embedded_clone)
+                    return embedded_clone
+                else:
+                    # other objects can refer to the files in the store
+                    self._flush_file_writes()
+
             try:
                 embedded_clone.write_into(self._store)
             except:
@@ -387,6 +525,79 @@ class DynamoInventory(ObjectRepository):
 
         return embedded_clone
 
+    def start_batch(self):
+        """
+        Buffer the store writes of files from the following updates and save them in bulk. The buffer is written
+        out before any other store write and at end_batch(). Observers are notified so that they can defer their
+        work to the end of the batch.
+        """
+
+        if self._file_writes is None:
+            self._file_writes = []
+            self._notify('start_batch')
+
+    def end_batch(self):
+        if self._file_writes is None:
+            return
+
+        try:
+            self._flush_file_writes()
+        finally:
+            self._file_writes = None
+            self._notify('end_batch')
+
+    def _notify(self, method, *args):
+        """
+        Call the method of all observers. Exceptions are logged and not propagated.
+        """
+
+        for observer in self.observers:
+            try:
+                getattr(observer, method)(self, *args)
+            except:
+                LOG.error('Exception in %s.%s: %s', type(observer).__name__, method, str(sys.exc_info()[1]))
+
+    def _flush_file_writes(self):
+        if len(self._file_writes) == 0:
+            return
+
+        files = self._file_writes
+        self._file_writes = []
+
+        try:
+            self._store.save_files(files)
+        except:
+            LOG.error('Exception writing %d files to inventory store', len(files))
+            raise
+
+    def replay(self, update_commands):
+        """
+        Apply update commands to the in-memory image only, without writing to the store. Used in processes that hold
+        a copy of the server inventory.
+        @param update_commands  List of (cmd, objstr)
+        """
+
+        self.start_batch()
+
+        try:
+            for cmd, objstr in update_commands:
+                obj = self.make_object(objstr)
+
+                self._notify('before_change', obj)
+
+                try:
+                    if cmd == DynamoInventory.CMD_UPDATE:
+                        ObjectRepository.update(self, obj)
+                    elif cmd == DynamoInventory.CMD_DELETE:
+                        try:
+                            ObjectRepository.delete(self, obj)
+                        except (KeyError, df.ObjectError):
+                            pass
+                finally:
+                    self._notify('after_change', obj)
+        finally:
+            self.end_batch()
+
     def delete(self, obj): #override
         """
         Delete an object from memory and write the change to store.
@@ -394,12 +605,20 @@ class DynamoInventory(ObjectRepository):
         @param obj    Object to delete from this inventory.
         """
 
-        deleted_object = ObjectRepository.delete(self, obj)
+        self._notify('before_change', obj)
+
+        try:
+            deleted_object = ObjectRepository.delete(self, obj)
+        finally:
+            self._notify('after_change', obj)
 
         if deleted_object is None:
             return None
 
         if self._has_store:
+            if self._file_writes is not None:
+                self._flush_file_writes()
+
             try:
                 deleted_object.delete_from(self._store)
             except:
@@ -243,6 +243,7 @@ class DynamoServer(object):
                 self._collect_processes(child_processes)
 
                 if self.webserver is not None:
+                    self.webserver.check_restart()
                     self._collect_updates_from_web()
 
                 ## Step 6 (easier to do here because we use "continue"s)
@@ -395,6 +396,7 @@ class DynamoServer(object):
                 self._read_updates()
 
                 if self.webserver is not None:
+                    self.webserver.check_restart()
                     self._collect_updates_from_web()
     
                 ## Step 2
@@ -622,28 +624,46 @@ class DynamoServer(object):
     def _exec_updates(self, update_commands):
         num_updates = 0
         num_deletes = 0
-        for cmd, objstr in update_commands:
-            # Create a python object from its representation string
-            obj = self.inventory.make_object(objstr)
 
-            if cmd == DynamoInventory.CMD_UPDATE:
-                num_updates += 1
-                embedded_object = self.inventory.update(obj)
-                CHANGELOG.info('Saved %s', str(embedded_object))
+        # Create python objects from their representation strings (update_commands can be a generator)
+        commands = [(cmd, self.inventory.make_object(objstr), objstr) for cmd, objstr in update_commands]
 
-            elif cmd == DynamoInventory.CMD_DELETE:
-                num_deletes += 1
-                deleted_object = self.inventory.delete(obj)
-                if deleted_object is not None:
-                    CHANGELOG.info('Deleting %s', str(deleted_object))
+        # Objects are sent in full state; repeated updates of an object need to be applied only once
+        commands, num_coalesced = self.inventory.coalesce(commands)
+        if num_coalesced != 0:
+            LOG.info('Coalesced %d repeated updates.', num_coalesced)
+
+        # Keep the list for the web server
+        applied_commands = []
+
+        self.inventory.start_batch()
+
+        try:
+            for cmd, obj, objstr in commands:
+                if self.webserver:
+                    applied_commands.append((cmd, objstr))
+
+                if cmd == DynamoInventory.CMD_UPDATE:
+                    num_updates += 1
+                    embedded_object = self.inventory.update(obj)
+                    CHANGELOG.info('Saved %s', str(embedded_object))
+
+                elif cmd == DynamoInventory.CMD_DELETE:
+                    num_deletes += 1
+                    deleted_object = self.inventory.delete(obj)
+                    if deleted_object is not None:
+                        CHANGELOG.info('Deleting %s', str(deleted_object))
+
+        finally:
+            self.inventory.end_batch()
 
         if num_updates + num_deletes != 0:
             if self.inventory.has_store:
                 self.manager.master.advertise_store_version(self.inventory.store_version())
 
             if self.webserver:
-                # Restart the web server so it gets the latest inventory image
-                self.webserver.restart()
+                # Pass the updates to the web server (which may restart itself to get the latest inventory image)
+                self.webserver.update_inventory(applied_commands)
 
         return num_updates, num_deletes
 
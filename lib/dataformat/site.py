@@ -48,6 +48,20 @@ class Site(object):
         return self._name
 
     class FileNameMapping(object):
+        """
+        LFN to PFN mapping through chains of regular expression substitutions. The first chain that
+        can be followed to the end gives the PFN.
+        The first steps of all chains are combined into one regular expression to find the first
+        candidate chain in one match. If every step of every chain only looks at the directory part
+        of its input (see _is_separable), the mapping of a directory is memoized and applied to all
+        files in the directory.
+        """
+
+        # Number of directories to remember
+        cache_size = 10000
+        # Python 2 re supports at most 100 groups in one pattern
+        max_combined_groups = 99
+
         def __init__(self, chains):
             """
             @param chains  List of chains. A chain is a list of 2-tuples (lfn pattern, pfn replacement)
@@ -65,6 +79,31 @@ class Site(object):
 
                 self._re_chains.append(re_chain)
 
+            # First steps of all chains as alternatives of one pattern: [(chain index, group offset)]
+            self._combined_re = None
+            self._combined_groups = []
+
+            # Empty chains (always succeed) and inline flags (apply to the whole pattern) cannot be combined
+            first_patterns = [chain[0][0] if len(chain) != 0 else None for chain in chains]
+            if len(first_patterns) > 1 and None not in first_patterns and \
+                    not any(re.search(r'\(\?[a-zA-Z]|\(\?P=|\\[1-9]', pat) for pat in first_patterns):
+                offset = 1
+                for ichain, re_chain in enumerate(self._re_chains):
+                    self._combined_groups.append((ichain, offset))
+                    offset += re_chain[0][0].groups + 1
+
+                if offset - 1 <= Site.FileNameMapping.max_combined_groups:
+                    try:
+                        self._combined_re = re.compile('|'.join('(%s)' % pat for pat in first_patterns))
+                    except (re.error, AssertionError, OverflowError):
+                        # too many groups for this version of re - match the chains one by one
+                        self._combined_re = None
+
+            # {directory: PFN prefix or None}
+            # Plain dict with single get / set operations, which are atomic - map() is called from multiple threads.
+            self._cache = {}
+            self._use_cache = all(Site.FileNameMapping._is_separable(chain) for chain in chains)
+
         def __eq__(self, other):
             return self._chains == other._chains
 
@@ -75,20 +114,142 @@ class Site(object):
             return repr(self._chains)
 
         def map(self, lfn):
-            for chain in self._re_chains:
-                source = lfn
-                for source_re, dest_pat in chain:
-                    matches = source_re.match(source)
-                    if matches is None:
-                        break
+            if not self._use_cache or '\n' in lfn:
+                return self._map(lfn)
+
+            idx = lfn.rfind('/') + 1
+            directory = lfn[:idx]
+            basename = lfn[idx:]
 
-                    source = dest_pat.format(*tuple(matches.group(i + 1) for i in xrange(source_re.groups)))
+            try:
+                prefix = self._cache[directory]
+            except KeyError:
+                pfn = self._map(lfn)
+                if pfn is None:
+                    prefix = None
                 else:
-                    # could go through the entire chain - source is the mapped pfn
-                    return source
+                    prefix = pfn[:len(pfn) - len(basename)]
+
+                if len(self._cache) >= Site.FileNameMapping.cache_size:
+                    # files are mostly mapped directory by directory; start over instead of tracking recency
+                    self._cache = {}
+
+                self._cache[directory] = prefix
+
+            if prefix is None:
+                return None
+            else:
+                return prefix + basename
+
+        def _map(self, lfn):
+            first_chain = 0
+
+            if self._combined_re is not None:
+                matches = self._combined_re.match(lfn)
+                if matches is None:
+                    return None
+
+                for ichain, offset in self._combined_groups:
+                    if matches.group(offset) is not None:
+                        break
+
+                source_re, dest_pat = self._re_chains[ichain][0]
+                source = dest_pat.format(*tuple(matches.group(offset + i + 1) for i in xrange(source_re.groups)))
+                pfn = self._follow(self._re_chains[ichain], 1, source)
+                if pfn is not None:
+                    return pfn
+
+                first_chain = ichain + 1
+
+            for chain in self._re_chains[first_chain:]:
+                pfn = self._follow(chain, 0, lfn)
+                if pfn is not None:
+                    return pfn
 
             return None
 
+        def _follow(self, chain, istep, source):
+            for source_re, dest_pat in chain[istep:]:
+                matches = source_re.match(source)
+                if matches is None:
+                    return None
+
+                source = dest_pat.format(*tuple(matches.group(i + 1) for i in xrange(source_re.groups)))
+
+            # could go through the entire chain - source is the mapped pfn
+            return source
+
+        @staticmethod
+        def _is_separable(chain):
+            """
+            A step is separable if its pattern is Q(.*) or Q(.*)$, where Q ends with a '/' and has no
+            lookaround, backreference, or top-level alternation, and the replacement ends with the
+            placeholder of the last group, used only once. The match of Q then ends within the directory
+            part of the input and does not depend on the file name, which is carried over to the end of
+            the output unchanged.
+            """
+
+            for lfnpat, pfnpat in chain:
+                if Site.FileNameMapping._has_top_level_alternation(lfnpat):
+                    # e.g. a|/store/(.*) can match without reaching the directory part
+                    return False
+
+                if lfnpat.endswith('$'):
+                    lfnpat = lfnpat[:-1]
+
+                if not lfnpat.endswith('(.*)'):
+                    return False
+
+                q = lfnpat[:-4]
+                if not q.endswith('/') or re.search(r'\(\?(?:=|!|<|P=)|\\[1-9]', q):
+                    return False
+
+                try:
+                    ngroups = re.compile(q).groups
+                except re.error:
+                    return False
+
+                # any reference to the last group ({n}, {n:...}, {n[...]}, ...) other than the final {n}
+                if not pfnpat.endswith('{%d}' % ngroups) or pfnpat.endswith('{{%d}' % ngroups) or \
+                        len(re.findall(r'\{%d[^0-9]' % ngroups, pfnpat)) != 1:
+                    return False
+
+            return True
+
+        @staticmethod
+        def _has_top_level_alternation(pattern):
+            """
+            @return True if pattern has a '|' outside of groups and character classes.
+            """
+
+            depth = 0
+            ichar = 0
+            while ichar < len(pattern):
+                char = pattern[ichar]
+                if char == '\\':
+                    ichar += 1
+                elif char == '[':
+                    # skip the class; a ']' right after '[' or '[^' is a literal
+                    ichar += 1
+                    if ichar < len(pattern) and pattern[ichar] == '^':
+                        ichar += 1
+                    if ichar < len(pattern) and pattern[ichar] == ']':
+                        ichar += 1
+                    while ichar < len(pattern) and pattern[ichar] != ']':
+                        if pattern[ichar] == '\\':
+                            ichar += 1
+                        ichar += 1
+                elif char == '(':
+                    depth += 1
+                elif char == ')':
+                    depth -= 1
+                elif char == '|' and depth == 0:
+                    return True
+
+                ichar += 1
+
+            return False
+
 
     def __init__(self, name, host = '', storage_type = TYPE_DISK, backend = '', status = STAT_UNKNOWN, filename_mapping = {}, sid = 0):
         self._name = name
@@ -1,5 +1,6 @@
 import logging
 import time
+import hashlib
 
 from dynamo.dealer.plugins.base import BaseHandler, DealerRequest
 from dynamo.request.copy import CopyRequestManager
@@ -32,6 +33,9 @@ class CopyRequestsHandler(BaseHandler):
 
         self.activated_requests = []
 
+        # {fingerprint of the items list: ({dataset: blocks}, [invalid items])}, valid within one cycle
+        self._item_cache = {}
+
     def set_read_only(self, value = True): #override
         self._read_only = value
         self.request_manager.set_read_only(value)
@@ -49,6 +53,12 @@ class CopyRequestsHandler(BaseHandler):
         overwritten_groups = [inventory.groups[name] for name in self.overwritten_groups]
 
         self.activated_requests = []
+        self._item_cache = {}
+
+        # requests with status or action changes; written together before the registry tables are unlocked
+        updated_requests = []
+        # {item name: (dataset, block)}
+        resolved_items = {}
         
         # full list of blocks to be proposed to Dealer
         blocks_to_propose = {} # {site: {dataset: set of blocks}}
@@ -77,77 +87,50 @@ class CopyRequestsHandler(BaseHandler):
                     action.last_update = now
                     updated = True
                     continue
-    
+
                 try:
-                    dataset_name, block_name = Block.from_full_name(action.item)
-    
-                except ObjectError:
-                    # action.item is (supposed to be) a dataset name
+                    dataset, block = resolved_items[action.item]
+                except KeyError:
+                    dataset, block = resolved_items[action.item] = self._resolve_item(action.item, inventory)
 
-                    try:
-                        dataset = inventory.datasets[action.item]
-                    except KeyError:
-                        action.status = RequestAction.ST_FAILED
-                        action.last_update = now
-                        updated = True                        
-                        continue
+                if dataset is None:
+                    action.status = RequestAction.ST_FAILED
+                    action.last_update = now
+                    updated = True
+                    continue
 
+                if block is None:
+                    # action.item is a dataset name
+                    item = dataset
                     existing_replica = site.find_dataset_replica(dataset)
-
-                    if existing_replica is not None:
-                        if existing_replica.is_complete():
-                            action.status = RequestAction.ST_COMPLETED
-                        else:
-                            # it was queued by someone
-                            action.status = RequestAction.ST_QUEUED
-                        action.last_update = now
-                        updated = True
-
-                    else:
-                        activation_list.append((dataset, site))
-                        to_be_activated = True
-    
                 else:
-                    # action.item is a block name
-    
-                    try:
-                        dataset = inventory.datasets[dataset_name]
-                    except KeyError:
-                        action.status = RequestAction.ST_FAILED
-                        action.last_update = now
-                        updated = True                        
-                        continue
-    
-                    block = dataset.find_block(block_name)
-    
-                    if block is None:
-                        action.status = RequestAction.ST_FAILED
-                        action.last_update = now
-                        updated = True                        
-                        continue
-
+                    item = block
                     existing_replica = block.find_replica(site)
 
-                    if existing_replica is not None:
-                        if existing_replica.is_complete():
-                            action.status = RequestAction.ST_COMPLETED
-                        else:
-                            action.status = RequestAction.ST_QUEUED
-                        action.last_update = now
-                        updated = True
-
+                if existing_replica is not None:
+                    if existing_replica.is_complete():
+                        action.status = RequestAction.ST_COMPLETED
                     else:
-                        activation_list.append((block, site))
-                        to_be_activated = True
+                        # it was queued by someone
+                        action.status = RequestAction.ST_QUEUED
+                    action.last_update = now
+                    updated = True
+
+                else:
+                    activation_list.append((item, site))
+                    to_be_activated = True
 
             if updated:
-                self.request_manager.update_request(request)
+                updated_requests.append(request)
 
             if to_be_activated:
                 self.activated_requests.append(request)
 
+        self.request_manager.update_requests(updated_requests)
         self.request_manager.unlock()
 
+        LOG.info('Updated %d of %d activated requests.', len(updated_requests), len(active_requests))
+
         for item, site in activation_list:
             try:
                 site_blocks = blocks_to_propose[site]
@@ -169,10 +152,12 @@ class CopyRequestsHandler(BaseHandler):
         self.request_manager.lock()
         new_requests = self.request_manager.get_requests(statuses = [Request.ST_NEW])
 
+        updated_requests = []
+
         def reject(request, reason):
             request.status = Request.ST_REJECTED
             request.reject_reason = reason
-            self.request_manager.update_request(request)
+            updated_requests.append(request)
 
         for request in new_requests.itervalues():
             try:
@@ -181,8 +166,7 @@ class CopyRequestsHandler(BaseHandler):
                 reject(request, 'Invalid group name %s' % request.group)
                 continue
 
-            invalid_items = []
-            datasets = request.find_items(inventory, invalid_items)
+            datasets, invalid_items = self._find_items(request, inventory)
             sites = filter(lambda s: s in policy.target_sites, request.find_sites(inventory))
 
             if len(invalid_items) != 0:
@@ -333,7 +317,7 @@ class CopyRequestsHandler(BaseHandler):
             if len(new_dealer_requests) == 0 and len(activation_list) == 0:
                 # nothing to do
                 request.status = Request.ST_COMPLETED
-                self.request_manager.update_request(request)
+                updated_requests.append(request)
                 continue
 
             # finally add to the returned requests
@@ -361,10 +345,11 @@ class CopyRequestsHandler(BaseHandler):
 
             # create actions and set request status to ACTIVATED
             request.activate(activation_list)
-            self.request_manager.update_request(request)
+            updated_requests.append(request)
             
             self.activated_requests.append(request)
 
+        self.request_manager.update_requests(updated_requests)
         self.request_manager.unlock()
 
         # throw away all the DealerRequest objects we've been using and form the final proposal
@@ -383,6 +368,8 @@ class CopyRequestsHandler(BaseHandler):
         Create active copy entries for accepted copies.
         """
 
+        updated_requests = []
+
         for request in self.activated_requests:
             updated = False
 
@@ -419,4 +406,58 @@ class CopyRequestsHandler(BaseHandler):
                         break
 
             if updated:
-                self.request_manager.update_request(request)
+                updated_requests.append(request)
+
+        self.request_manager.lock()
+        self.request_manager.update_requests(updated_requests)
+        self.request_manager.unlock()
+
+    def _resolve_item(self, item, inventory):
+        """
+        @param item       Dataset or block full name
+        @param inventory  DynamoInventory
+        @return (dataset, block). Block is None for a dataset name. (None, None) if the item is not in the inventory.
+        """
+
+        try:
+            dataset_name, block_name = Block.from_full_name(item)
+        except ObjectError:
+            dataset_name = item
+            block_name = None
+
+        try:
+            dataset = inventory.datasets[dataset_name]
+        except KeyError:
+            return None, None
+
+        if block_name is None:
+            return dataset, None
+
+        block = dataset.find_block(block_name)
+        if block is None:
+            return None, None
+
+        return dataset, block
+
+    def _find_items(self, request, inventory):
+        """
+        Resolve the items of a request in the inventory. Results are shared among the requests with the same items
+        list within a cycle and must not be modified.
+        @param request    CopyRequest
+        @param inventory  DynamoInventory
+        @return ({dataset: set of blocks or None}, [invalid item names])
+        """
+
+        fingerprint = hashlib.sha1('\n'.join(sorted(request.items))).hexdigest()
+
+        try:
+            return self._item_cache[fingerprint]
+        except KeyError:
+            pass
+
+        invalid_items = []
+        datasets = request.find_items(inventory, invalid_items)
+
+        self._item_cache[fingerprint] = (datasets, invalid_items)
+
+        return datasets, invalid_items
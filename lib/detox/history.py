@@ -1,14 +1,18 @@
 import os
+import sys
 import re
+import time
+import threading
+import fnmatch
 import sqlite3
 import lzma
 import hashlib
-import signal
 import logging
 
 from dynamo.utils.interface.mysql import MySQL
 from dynamo.dataformat import Site
 from dynamo.operation.history import DeletionHistoryDatabase
+from dynamo.detox.snapshot import SnapshotWriter, SnapshotReader
 from dynamo.dataformat import Configuration
 
 LOG = logging.getLogger(__name__)
@@ -36,6 +40,41 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
         self.snapshots_spool_dir = config.snapshots_spool_dir
         self.snapshots_archive_dir = config.snapshots_archive_dir
 
+        # Archived cycles in the chunked format are read directly from the snapshot files.
+        # Older cycles (SQLite + lzma) are copied into the cache DB.
+        # {cycle_number: SnapshotReader}
+        self._snapshots = {}
+
+        # (cycle_number, thread) of the background snapshot writer (see DetoxHistory.save_cycle_state)
+        self._state_writer = None
+        # sys.exc_info() of the writer if it failed
+        self._state_writer_error = None
+
+    def wait_cycle_state(self, cycle_number = None):
+        """
+        Wait for the snapshot of the cycle state to be written. Raises the exception of the writer if it failed.
+        @param cycle_number  Cycle number or partition name. If None, wait for any pending snapshot.
+        """
+
+        if self._state_writer is None:
+            return
+
+        writer_cycle, thread = self._state_writer
+        if cycle_number is not None and cycle_number != writer_cycle:
+            return
+
+        if thread.is_alive():
+            LOG.info('Waiting for the snapshot of cycle %s to be written', writer_cycle)
+
+        thread.join()
+
+        self._state_writer = None
+
+        if self._state_writer_error is not None:
+            exc_type, exc_value, exc_tb = self._state_writer_error
+            self._state_writer_error = None
+            raise exc_type, exc_value, exc_tb
+
     def get_cycles(self, partition, first = -1, last = -1):
         """
         Get a list of deletion cycles in range first <= cycle <= last. If first == -1, pick only the latest before last.
@@ -79,6 +118,19 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
         @return {site_name:  (id, status, quota)}
         """
 
+        snapshot = self._get_snapshot(cycle_number)
+        if snapshot is not None:
+            site_names = self._get_site_names()
+
+            sites_dict = {}
+            for site_id, status_id, quota in snapshot.sites:
+                if skip_unused and site_id not in snapshot.totals:
+                    continue
+
+                sites_dict[site_names[site_id]] = (snapshot.statuses[status_id], quota)
+
+            return sites_dict
+
         self._fill_snapshot_cache('sites', cycle_number)
 
         table_name = 'sites_%d' % cycle_number
@@ -108,6 +160,34 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
                 If size_only = False: a massive dict {site: [(dataset, size, decision, reason)]}
         """
 
+        snapshot = self._get_snapshot(cycle_number)
+        if snapshot is not None:
+            if type(decisions) is not list:
+                decisions = ['protect', 'delete', 'keep']
+
+            if size_only:
+                site_names = self._get_site_names()
+
+                product = {}
+                for site_id, totals in snapshot.totals.iteritems():
+                    v = {'protect': 0, 'delete': 0, 'keep': 0}
+                    has_decision = False
+                    for decision_id, size in totals.iteritems():
+                        decision = snapshot.decisions[decision_id]
+                        if decision in decisions:
+                            v[decision] = size * 1.e-12
+                            has_decision = True
+
+                    if has_decision:
+                        product[site_names[site_id]] = (v['protect'], v['delete'], v['keep'])
+
+                return product
+
+            else:
+                decision_ids = set(i for i, d in snapshot.decisions.iteritems() if d in decisions)
+                rows = (row for row in snapshot.replicas() if row[3] in decision_ids)
+                return self._make_decisions_dict(snapshot, rows)
+
         self._fill_snapshot_cache('replicas', cycle_number)
 
         table_name = 'replicas_%d' % cycle_number
@@ -172,6 +252,18 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
         @return  site-specific version of get_deletion_decisions with size_only = False
         """
 
+        snapshot = self._get_snapshot(cycle_number)
+        if snapshot is not None:
+            result = self.db.query('SELECT `id` FROM `{0}`.`sites` WHERE `name` = %s'.format(self.history_db), site_name)
+            if len(result) == 0:
+                return []
+
+            product = self._make_decisions_dict(snapshot, snapshot.replicas(site_id = result[0]))
+            try:
+                return product[site_name]
+            except KeyError:
+                return []
+
         self._fill_snapshot_cache('replicas', cycle_number)
 
         table_name = 'replicas_%d' % cycle_number
@@ -184,7 +276,106 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
 
         return self.db.query(query, site_name)
 
+    def get_dataset_deletion_decisions(self, cycle_number, patterns):
+        """
+        @param cycle_number   Cycle number
+        @param patterns       List of dataset names or wildcard patterns
+
+        @return  dataset-specific version of get_deletion_decisions with size_only = False
+        """
+
+        regexes = [re.compile(fnmatch.translate(pattern)) for pattern in patterns]
+
+        # find the dataset ids from the name patterns
+        dataset_ids = set()
+        sql = 'SELECT `id`, `name` FROM `{0}`.`datasets` WHERE `name` LIKE %s'.format(self.history_db)
+        for pattern, regex in zip(patterns, regexes):
+            like = pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_').replace('*', '%').replace('?', '_')
+            for dataset_id, dataset_name in self.db.xquery(sql, like):
+                if regex.match(dataset_name):
+                    dataset_ids.add(dataset_id)
+
+        snapshot = self._get_snapshot(cycle_number)
+        if snapshot is not None:
+            return self._make_decisions_dict(snapshot, snapshot.replicas(dataset_ids = dataset_ids))
+
+        product = {}
+        for site_name, site_decisions in self.get_deletion_decisions(cycle_number, size_only = False).iteritems():
+            matched = [d for d in site_decisions if any(regex.match(d[0]) for regex in regexes)]
+            if len(matched) != 0:
+                product[site_name] = matched
+
+        return product
+
+    def _get_snapshot(self, cycle_number):
+        """
+        @return SnapshotReader if the cycle is archived in the chunked format, otherwise None.
+        """
+
+        try:
+            cycle_number += 0
+        except TypeError:
+            # partition snapshots are not archived
+            return None
+
+        self.wait_cycle_state(cycle_number)
+
+        try:
+            return self._snapshots[cycle_number]
+        except KeyError:
+            pass
+
+        path = self._archive_path(cycle_number, 'snap')
+        if not os.path.exists(path):
+            return None
+
+        snapshot = self._snapshots[cycle_number] = SnapshotReader(path)
+        return snapshot
+
+    def _archive_path(self, cycle_number, suffix):
+        scycle = '%09d' % cycle_number
+        return '%s/%s/%s/snapshot_%09d.%s' % (self.snapshots_archive_dir, scycle[:3], scycle[3:6], cycle_number, suffix)
+
+    def _get_site_names(self):
+        return dict(self.db.xquery('SELECT `id`, `name` FROM `{0}`.`sites`'.format(self.history_db)))
+
+    def _make_decisions_dict(self, snapshot, rows):
+        """
+        Translate the snapshot rows into the get_deletion_decisions format.
+        @param snapshot  SnapshotReader
+        @param rows      Iterable of snapshot replica rows
+
+        @return {site_name: [(dataset_name, size, decision, condition_id, reason)]}, ordered by size in each site
+        """
+
+        rows = list(rows)
+
+        site_names = self._get_site_names()
+
+        dataset_ids = set(row[1] for row in rows)
+        dataset_names = dict(self.db.select_many(MySQL.bare('`{0}`.`datasets`'.format(self.history_db)), ('id', 'name'), 'id', list(dataset_ids)))
+
+        condition_ids = set(row[4] for row in rows)
+        condition_texts = dict(self.db.select_many(MySQL.bare('`{0}`.`policy_conditions`'.format(self.history_db)), ('id', 'text'), 'id', list(condition_ids)))
+
+        product = {}
+        for site_id, dataset_id, size, decision_id, condition_id in rows:
+            site_name = site_names[site_id]
+            try:
+                current = product[site_name]
+            except KeyError:
+                current = product[site_name] = []
+
+            current.append((dataset_names[dataset_id], size, snapshot.decisions[decision_id], condition_id, condition_texts.get(condition_id)))
+
+        for current in product.itervalues():
+            current.sort(key = lambda d: d[1], reverse = True)
+
+        return product
+
     def _fill_snapshot_cache(self, template, cycle_number):
+        self.wait_cycle_state(cycle_number)
+
         self.db.use_db(self.cache_db)
 
         # cycle_number is either a cycle number or a partition name. %s works for both
@@ -209,8 +400,7 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
                     except OSError:
                         pass
 
-                    scycle = '%09d' % cycle_number
-                    xz_file_name = '%s/%s/%s/snapshot_%09d.db.xz' % (self.snapshots_archive_dir, scycle[:3], scycle[3:6], cycle_number)
+                    xz_file_name = self._archive_path(cycle_number, 'db.xz')
                     if not os.path.exists(xz_file_name):
                         raise RuntimeError('Archived snapshot DB ' + xz_file_name + ' does not exist')
     
@@ -350,6 +540,9 @@ class DetoxHistory(DetoxHistoryBase):
         if self._read_only:
             return
 
+        # The cycle becomes visible to the monitors when time_end is set; the snapshot must be in place
+        self.wait_cycle_state(cycle_number)
+
         self.db.query('UPDATE `deletion_cycles` SET `time_end` = NOW() WHERE `id` = %s', cycle_number)
 
     def save_policy(self, policy_text):
@@ -387,7 +580,9 @@ class DetoxHistory(DetoxHistoryBase):
 
     def save_cycle_state(self, cycle_number, deleted_list, kept_list, protected_list, quotas):
         """
-        Save decisions and their reasons for all replicas.
+        Save decisions and their reasons for all replicas. Names are converted to ids and the decisions are packed
+        into an immutable record string here; the snapshot file is written by a background thread. Use
+        wait_cycle_state() to wait for its completion (close_cycle and the snapshot readers do so).
         @param cycle_number      Cycle number.
         @param deleted_list    {replica: [([block_replica], condition)]}
         @param kept_list       {replica: [([block_replica], condition)]}
@@ -401,163 +596,148 @@ class DetoxHistory(DetoxHistoryBase):
         if self._read_only:
             return
 
-        self.save_sites([s.name for s in quotas.iterkeys()])
+        # One snapshot writer at a time
+        self.wait_cycle_state()
 
-        datasets = set()
+        site_names = [s.name for s in quotas.iterkeys()]
+        site_ids = dict(zip(site_names, self.save_sites(site_names, get_ids = True)))
+
+        dataset_names = set()
         for replica, matches in deleted_list.iteritems():
-            datasets.add(replica.dataset.name)
+            dataset_names.add(replica.dataset.name)
         for replica, matches in kept_list.iteritems():
-            datasets.add(replica.dataset.name)
+            dataset_names.add(replica.dataset.name)
         for replica, matches in protected_list.iteritems():
-            datasets.add(replica.dataset.name)
+            dataset_names.add(replica.dataset.name)
 
-        self.save_datasets(datasets)
-    
-        reuse = self.db.reuse_connection
-        self.db.reuse_connection = True
+        dataset_names = list(dataset_names)
+        dataset_ids = dict(zip(dataset_names, self.save_datasets(dataset_names, get_ids = True)))
 
-        self.db.use_db(self.cache_db)
+        decisions = dict(self._get_decision_mapping())
+        decision_ids = dict((name, decision_id) for decision_id, name in decisions.iteritems())
 
         ## Replica state (deletion decisions)
 
-        # Insert full data into a temporary table with site and dataset names
-        tmp_table = 'replicas_tmp'
-        columns = [
-            '`site` varchar(32) CHARACTER SET latin1 COLLATE latin1_general_cs NOT NULL',
-            '`dataset` varchar(512) CHARACTER SET latin1 COLLATE latin1_general_cs NOT NULL',
-            '`size` bigint(20) unsigned NOT NULL',
-            '`decision` enum(\'delete\',\'keep\',\'protect\') CHARACTER SET latin1 COLLATE latin1_general_ci NOT NULL',
-            '`condition` int(10) unsigned NOT NULL',
-            'KEY `site_dataset` (`site`,`dataset`)'
-        ]
-        self.db.create_tmp_table(tmp_table, columns)
-
-        def replica_entry(entries, decision):
+        rows = []
+        for entries, decision in [(deleted_list, 'delete'), (kept_list, 'keep'), (protected_list, 'protect')]:
+            decision_id = decision_ids[decision]
             for replica, matches in entries.iteritems():
-                site_name = replica.site.name
-                dataset_name = replica.dataset.name
+                site_id = site_ids[replica.site.name]
+                dataset_id = dataset_ids[replica.dataset.name]
                 for condition_id, block_replicas in matches.iteritems():
                     size = sum(r.size for r in block_replicas)
-                    yield (site_name, dataset_name, size, decision, condition_id)
+                    rows.append((site_id, dataset_id, size, decision_id, condition_id))
 
-        fields = ('site', 'dataset', 'size', 'decision', 'condition')
-        self.db.insert_many(tmp_table, fields, None, replica_entry(deleted_list, 'delete'), do_update = False, db = self.db.scratch_db)
-        self.db.insert_many(tmp_table, fields, None, replica_entry(kept_list, 'keep'), do_update = False, db = self.db.scratch_db)
-        self.db.insert_many(tmp_table, fields, None, replica_entry(protected_list, 'protect'), do_update = False, db = self.db.scratch_db)
+        rows.sort()
 
-        # Make a snapshot table
-        replica_table_name = 'replicas_%s' % cycle_number
+        pack = SnapshotWriter.row.pack
+        records = ''.join(pack(*row) for row in rows)
+        rows = None
 
-        if self.db.table_exists(replica_table_name):
-            self.db.query('DROP TABLE `{0}`'.format(replica_table_name))
+        ## Site state (status and quotas)
 
-        self.db.query('CREATE TABLE `{0}` LIKE `replicas`'.format(replica_table_name))
+        sites = [(site_ids[site.name], site.status, int(quota)) for site, quota in quotas.iteritems()]
 
-        # Then use insert select join to convert the names to ids
-        sql = 'INSERT INTO `{0}` (`site_id`, `dataset_id`, `size`, `decision`, `condition`)'.format(replica_table_name)
-        sql += ' SELECT s.`id`, d.`id`, r.`size`, r.`decision`, r.`condition` FROM `{0}`.`{1}` AS r'.format(self.db.scratch_db, tmp_table)
-        sql += ' INNER JOIN `{0}`.`sites` AS s ON s.`name` = r.`site`'.format(self.history_db)
-        sql += ' INNER JOIN `{0}`.`datasets` AS d ON d.`name` = r.`dataset`'.format(self.history_db)
-        self.db.query(sql)
+        ## Now transfer data to a snapshot file in the background
+        thread = threading.Thread(target = self._write_cycle_state, name = 'DetoxSnapshot', args = (cycle_number, records, sites, decisions))
+        self._state_writer = (cycle_number, thread)
+        self._state_writer_error = None
+        thread.start()
 
-        self.db.drop_tmp_table(tmp_table)
+    def _write_cycle_state(self, cycle_number, records, sites, decisions):
+        """
+        Body of the background snapshot writer. Does not use the database.
+        """
 
-        ## Site state (status and quotas)
+        start = time.time()
 
-        # Insert full data into a temporary table with site info
-        tmp_table = 'sites_tmp'
-        columns = [
-            '`site` varchar(32) CHARACTER SET latin1 COLLATE latin1_general_cs NOT NULL',
-            '`status` enum(\'ready\',\'waitroom\',\'morgue\',\'unknown\') CHARACTER SET latin1 COLLATE latin1_general_ci NOT NULL',
-            '`quota` int(10) NOT NULL',
-            'KEY `site` (`site`)'
-        ]
-        self.db.create_tmp_table(tmp_table, columns)
+        try:
+            try:
+                cycle_number += 0
+            except TypeError:
+                # cycle_number is actually the partition name
+                db_file_name = '%s/snapshot_%s.db' % (self.snapshots_spool_dir, cycle_number)
+                self._write_sqlite_snapshot(db_file_name, records, sites, decisions)
+            else:
+                # This was a numbered cycle
+                # Archive in the chunked format
+                self._write_chunked_snapshot(cycle_number, records, sites, decisions)
+        except:
+            LOG.error('Failed to write the snapshot of cycle %s', cycle_number)
+            self._state_writer_error = sys.exc_info()
+        else:
+            LOG.info('Snapshot of cycle %s written in %.1f seconds', cycle_number, time.time() - start)
 
-        fields = ('site', 'status', 'quota')
-        mapping = lambda (site, quota): (site.name, site.status, quota)
-        self.db.insert_many(tmp_table, fields, mapping, quotas.iteritems(), do_update = False, db = self.db.scratch_db)
+    def _get_decision_mapping(self):
+        # Get the decision value to name mapping from MySQL information_schema
+        # This is just a fancy way to arrive at a list [(1, 'delete'), (2, 'keep'), (3, 'protect')]
+        enum = self.db.query('SELECT `COLUMN_TYPE` FROM `information_schema`.`COLUMNS` WHERE `TABLE_SCHEMA` = %s AND `TABLE_NAME` = \'replicas\' AND `COLUMN_NAME` = \'decision\'', self.cache_db)[0]
+        # "enum('delete','keep','protect')" -> ['delete', 'keep', 'protect']
+        values = map(lambda s: s.replace("'", '').replace('"', ''), enum[5:-1].split(','))
+        decision_mapping = []
+        for idec, decision in enumerate(values):
+            # MySQL enum starts at 1
+            decision_mapping.append((idec + 1, decision))
+
+        return decision_mapping
 
-        # Make a snapshot table
-        site_table_name = 'sites_%s' % cycle_number
+    def _iter_records(self, records):
+        unpack_from = SnapshotWriter.row.unpack_from
+        size = SnapshotWriter.row.size
+        for offset in xrange(0, len(records), size):
+            yield unpack_from(records, offset)
 
-        if self.db.table_exists(site_table_name):
-            self.db.query('DROP TABLE `{0}`'.format(site_table_name))
+    def _write_chunked_snapshot(self, cycle_number, records, sites, decisions):
+        path = self._archive_path(cycle_number, 'snap')
 
-        self.db.query('CREATE TABLE `{0}` LIKE `sites`'.format(site_table_name))
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
 
-        # Then use insert select join to convert the names to ids
-        sql = 'INSERT INTO `{0}` (`site_id`, `status`, `quota`)'.format(site_table_name)
-        sql += ' SELECT s.`id`, t.`status`, t.`quota` FROM `{0}`.`{1}` AS t'.format(self.db.scratch_db, tmp_table)
-        sql += ' INNER JOIN `{0}`.`sites` AS s ON s.`name` = t.`site`'.format(self.history_db)
-        self.db.query(sql)
+        LOG.info('Creating chunked snapshot %s', path)
 
-        self.db.drop_tmp_table(tmp_table)
+        writer = SnapshotWriter(path)
 
-        ## Now transfer data to an SQLite file
         try:
-            cycle_number += 0
-        except TypeError:
-            # cycle_number is actually the partition name
-            db_file_name = '%s/snapshot_%s.db' % (self.snapshots_spool_dir, cycle_number)
-            is_cycle = False
-        else:
-            # Saving quotas during a cycle
-            db_file_name = '%s/snapshot_%09d.db' % (self.snapshots_spool_dir, cycle_number)
-            is_cycle = True
+            for row in self._iter_records(records):
+                writer.add_replica(*row)
+        except:
+            writer.abort()
+            raise
+
+        statuses = {Site.STAT_READY: 'ready', Site.STAT_WAITROOM: 'waitroom', Site.STAT_MORGUE: 'morgue', Site.STAT_UNKNOWN: 'unknown'}
 
+        writer.close(decisions, statuses, sites)
+
+        self._snapshots.pop(cycle_number, None)
+
+    def _write_sqlite_snapshot(self, db_file_name, records, sites, decisions):
         try:
             os.makedirs(self.snapshots_spool_dir)
             os.chmod(self.snapshots_spool_dir, 0777)
         except OSError:
             pass
 
-        if os.path.exists(db_file_name):
-            os.unlink(db_file_name)
-
-        LOG.info('Creating snapshot SQLite3 DB %s', db_file_name)
-
-        # For some unknown reason, we observed sqlite3.connect hanging - employing alarm mechanism to time out
-        class Timeout(Exception):
-            pass
-
-        def timeout_handler(signum, frame):
-            raise Timeout()
+        # Readers only see the complete file
+        tmp_file_name = db_file_name + '.tmp'
 
-        signal.signal(signal.SIGALRM, timeout_handler)
+        if os.path.exists(tmp_file_name):
+            os.unlink(tmp_file_name)
 
-        signal.alarm(5)
+        LOG.info('Creating snapshot SQLite3 DB %s', db_file_name)
 
-        for att in range(3):
-            try:
-                snapshot_db = sqlite3.connect(db_file_name)
-            except Timeout:
-                continue
-            else:
-                signal.alarm(0)
-                break
-        else:
-            raise RuntimeError('Failed to create %s' % db_file_name)
+        snapshot_db = sqlite3.connect(tmp_file_name)
 
         snapshot_cursor = snapshot_db.cursor()
 
         # Make enum mapping tables
-        # Get the decision value to name mapping from MySQL information_schema
-        # This is just a fancy way to arrive at a list [(1, 'delete'), (2, 'keep'), (3, 'protect')]
-        enum = self.db.query('SELECT `COLUMN_TYPE` FROM `information_schema`.`COLUMNS` WHERE `TABLE_SCHEMA` = %s AND `TABLE_NAME` = \'replicas\' AND `COLUMN_NAME` = \'decision\'', self.cache_db)[0]
-        # "enum('delete','keep','protect')" -> ['delete', 'keep', 'protect']
-        values = map(lambda s: s.replace("'", '').replace('"', ''), enum[5:-1].split(','))
-        decision_mapping = []
-        for idec, decision in enumerate(values):
-            # MySQL enum starts at 1
-            decision_mapping.append((idec + 1, decision))
-
         sql = 'CREATE TABLE `decisions` ('
         sql += '`id` TINYINT PRIMARY KEY NOT NULL,'
         sql += '`value` TEXT NOT NULL'
         sql += ')'
         snapshot_db.execute(sql)
-        for value, name in decision_mapping:
+        for value, name in sorted(decisions.iteritems()):
             snapshot_db.execute('INSERT INTO `decisions` VALUES (?, ?)', (value, name))
 
         sql = 'CREATE TABLE `statuses` ('
@@ -582,9 +762,7 @@ class DetoxHistory(DetoxHistoryBase):
         snapshot_db.execute('CREATE INDEX `site_dataset` ON `replicas` (`site_id`, `dataset_id`)')
 
         sql = 'INSERT INTO `replicas` VALUES (?, ?, ?, ?, ?)'
-
-        for entry in self.db.xquery('SELECT `site_id`, `dataset_id`, `size`, 0+`decision`, `condition` FROM `{0}`'.format(replica_table_name)):
-            snapshot_cursor.execute(sql, entry)
+        snapshot_cursor.executemany(sql, self._iter_records(records))
 
         snapshot_db.commit()
 
@@ -597,9 +775,7 @@ class DetoxHistory(DetoxHistoryBase):
         snapshot_db.execute(sql)
 
         sql = 'INSERT INTO `sites` VALUES (?, ?, ?)'
-
-        for entry in self.db.xquery('SELECT `site_id`, 0+`status`, `quota` FROM `{0}`'.format(site_table_name)):
-            snapshot_cursor.execute(sql, entry)
+        snapshot_cursor.executemany(sql, sites)
 
         snapshot_db.commit()
 
@@ -607,30 +783,7 @@ class DetoxHistory(DetoxHistoryBase):
         snapshot_cursor.close()
         snapshot_db.close()
 
-        if is_cycle:
-            # This was a numbered cycle
-            # Archive the sqlite3 file
-    
-            scycle = '%09d' % cycle_number
-            archive_dir_name = '%s/%s/%s' % (self.snapshots_archive_dir, scycle[:3], scycle[3:6])
-            xz_file_name = '%s/snapshot_%09d.db.xz' % (archive_dir_name, cycle_number)
-    
-            try:
-                os.makedirs(archive_dir_name)
-            except OSError:
-                pass
-    
-            with open(db_file_name, 'rb') as db_file:
-                with open(xz_file_name, 'wb') as xz_file:
-                    xz_file.write(lzma.compress(db_file.read()))
-
-            self._update_cache_usage('replicas', cycle_number)
-            self._update_cache_usage('sites', cycle_number)
-
-        # Finally restore the history DB
-        self.db.use_db(self.history_db)
-
-        self.db.reuse_connection = reuse
+        os.rename(tmp_file_name, db_file_name)
 
     def make_cycle_entry(self, cycle_number, site):
         history_record = self.make_entry(site.name)
@@ -83,7 +83,10 @@ class Detox(object):
             comment = 'Dynamo -- Automatic group reassignment for %s partition.' % self.policy.partition_name
             self._commit_reassignments(inventory, reowned, comment)
 
+            # waits for the snapshot to be written
             self.history.close_cycle(cycle_tag)
+        else:
+            self.history.wait_cycle_state(cycle_tag)
 
         LOG.info('Detox cycle completed')
 
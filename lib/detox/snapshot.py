@@ -0,0 +1,314 @@
+import os
+import json
+import lzma
+import struct
+import bisect
+import sqlite3
+import logging
+
+LOG = logging.getLogger(__name__)
+
+class SnapshotFormatError(Exception):
+    pass
+
+
+class ChunkedSnapshot(object):
+    """
+    Layout of a chunked detox snapshot file:
+      magic
+      chunk 0 (lzma-compressed packed replica rows)
+      chunk 1
+      ...
+      dataset index block 0 (lzma-compressed sorted little-endian uint64 dataset_id << 24 | chunk number)
+      ...
+      footer (lzma-compressed JSON index)
+      footer offset (8 bytes), magic
+    Replica rows are (site_id, dataset_id, size, decision_id, condition_id). The footer holds the decision and status
+    name mappings, the site rows (site_id, status_id, quota), the total size per site and decision, for each chunk
+    its position and the list of (site_id, min dataset_id, max dataset_id) segments it contains, and for each dataset
+    index block its position and dataset id range.
+    """
+
+    magic = 'DTXSNAP1'
+    row = struct.Struct('<HIqBI')
+    trailer = struct.Struct('<Q8s')
+    index_key = struct.Struct('<Q')
+    chunk_bits = 24
+    index_block_size = 65536
+
+
+class SnapshotWriter(ChunkedSnapshot):
+    """
+    Write a chunked snapshot. Rows should be added in (site_id, dataset_id) order so that each site spans few chunks.
+    """
+
+    def __init__(self, path, rows_per_chunk = 8192):
+        self.path = path
+        self.rows_per_chunk = rows_per_chunk
+
+        self._file = open(path + '.tmp', 'wb')
+        self._file.write(ChunkedSnapshot.magic)
+
+        self._rows = []
+        # [(offset, length, nrows, [(site_id, min dataset_id, max dataset_id)])]
+        self._chunks = []
+        # {site_id: {decision_id: size}}
+        self._totals = {}
+        # dataset_id << chunk_bits | chunk number
+        self._dataset_keys = []
+
+    def add_replica(self, site_id, dataset_id, size, decision_id, condition_id):
+        self._rows.append((site_id, dataset_id, size, decision_id, condition_id))
+
+        try:
+            site_totals = self._totals[site_id]
+        except KeyError:
+            site_totals = self._totals[site_id] = {}
+
+        try:
+            site_totals[decision_id] += size
+        except KeyError:
+            site_totals[decision_id] = size
+
+        if len(self._rows) == self.rows_per_chunk:
+            self._write_chunk()
+
+    def close(self, decisions, statuses, sites):
+        """
+        Write the footer and move the file in place. The temporary file is removed if writing fails.
+        @param decisions  {decision_id: name}
+        @param statuses   {status_id: name}
+        @param sites      [(site_id, status_id, quota)]
+        """
+
+        try:
+            self._close(decisions, statuses, sites)
+            os.rename(self.path + '.tmp', self.path)
+        except:
+            self.abort()
+            raise
+
+    def abort(self):
+        """
+        Close and remove the temporary file without writing the snapshot.
+        """
+
+        try:
+            self._file.close()
+        except:
+            pass
+
+        try:
+            os.unlink(self.path + '.tmp')
+        except OSError:
+            LOG.error('Failed to remove %s.tmp', self.path)
+
+    def _close(self, decisions, statuses, sites):
+        if len(self._rows) != 0:
+            self._write_chunk()
+
+        # Dataset index
+        keys = sorted(self._dataset_keys)
+        self._dataset_keys = None
+
+        pack = ChunkedSnapshot.index_key.pack
+
+        index_blocks = []
+        for start in xrange(0, len(keys), ChunkedSnapshot.index_block_size):
+            block = keys[start:start + ChunkedSnapshot.index_block_size]
+            data = lzma.compress(''.join(pack(key) for key in block))
+            min_id = block[0] >> ChunkedSnapshot.chunk_bits
+            max_id = block[-1] >> ChunkedSnapshot.chunk_bits
+            index_blocks.append((self._file.tell(), len(data), min_id, max_id))
+            self._file.write(data)
+
+        index = {
+            'decisions': decisions.items(),
+            'statuses': statuses.items(),
+            'sites': list(sites),
+            'totals': [(site_id, totals.items()) for site_id, totals in self._totals.iteritems()],
+            'chunks': self._chunks,
+            'dataset_index': index_blocks
+        }
+
+        footer_offset = self._file.tell()
+        self._file.write(lzma.compress(json.dumps(index)))
+        self._file.write(ChunkedSnapshot.trailer.pack(footer_offset, ChunkedSnapshot.magic))
+        self._file.close()
+
+    def _write_chunk(self):
+        segments = []
+        for site_id, dataset_id, _, _, _ in self._rows:
+            if len(segments) != 0 and segments[-1][0] == site_id:
+                segment = segments[-1]
+                if dataset_id < segment[1]:
+                    segment[1] = dataset_id
+                elif dataset_id > segment[2]:
+                    segment[2] = dataset_id
+            else:
+                segments.append([site_id, dataset_id, dataset_id])
+
+        chunk_number = len(self._chunks)
+        for dataset_id in set(row[1] for row in self._rows):
+            self._dataset_keys.append((dataset_id << ChunkedSnapshot.chunk_bits) | chunk_number)
+
+        pack = ChunkedSnapshot.row.pack
+        data = lzma.compress(''.join(pack(*row) for row in self._rows))
+
+        self._chunks.append((self._file.tell(), len(data), len(self._rows), segments))
+        self._file.write(data)
+
+        self._rows = []
+
+
+class SnapshotReader(ChunkedSnapshot):
+    """
+    Read a chunked snapshot. Only the chunks that can contain the requested rows are decompressed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as source:
+            if source.read(len(ChunkedSnapshot.magic)) != ChunkedSnapshot.magic:
+                raise SnapshotFormatError('%s is not a chunked snapshot' % path)
+
+            source.seek(-ChunkedSnapshot.trailer.size, os.SEEK_END)
+            trailer_offset = source.tell()
+            footer_offset, magic = ChunkedSnapshot.trailer.unpack(source.read(ChunkedSnapshot.trailer.size))
+            if magic != ChunkedSnapshot.magic:
+                raise SnapshotFormatError('%s is truncated' % path)
+
+            source.seek(footer_offset)
+            index = json.loads(lzma.decompress(source.read(trailer_offset - footer_offset)))
+
+        self.decisions = dict((int(i), str(name)) for i, name in index['decisions'])
+        self.statuses = dict((int(i), str(name)) for i, name in index['statuses'])
+        # [(site_id, status_id, quota)]
+        self.sites = [tuple(s) for s in index['sites']]
+        # {site_id: {decision_id: size}}
+        self.totals = dict((site_id, dict((int(d), size) for d, size in totals)) for site_id, totals in index['totals'])
+        # [(offset, length, nrows, [(site_id, min dataset_id, max dataset_id)])]
+        self.chunks = index['chunks']
+        # [(offset, length, min dataset_id, max dataset_id)]
+        self.dataset_index = index['dataset_index']
+
+        self.num_chunks_read = 0
+
+    def replicas(self, site_id = None, dataset_ids = None):
+        """
+        Iterate over replica rows (site_id, dataset_id, size, decision_id, condition_id).
+        @param site_id      If not None, limit to the site.
+        @param dataset_ids  If not None, limit to the datasets in the collection.
+        """
+
+        if dataset_ids is not None:
+            dataset_id_set = set(dataset_ids)
+            if len(dataset_id_set) == 0:
+                return
+
+        with open(self.path, 'rb') as source:
+            if dataset_ids is not None:
+                chunk_numbers = self._find_dataset_chunks(source, sorted(dataset_id_set))
+
+            for chunk_number, (offset, length, nrows, segments) in enumerate(self.chunks):
+                if dataset_ids is not None and chunk_number not in chunk_numbers:
+                    continue
+
+                if site_id is not None and not any(segment[0] == site_id for segment in segments):
+                    continue
+
+                source.seek(offset)
+                data = lzma.decompress(source.read(length))
+                self.num_chunks_read += 1
+
+                unpack_from = ChunkedSnapshot.row.unpack_from
+                size = ChunkedSnapshot.row.size
+                for irow in xrange(nrows):
+                    row = unpack_from(data, irow * size)
+                    if site_id is not None and row[0] != site_id:
+                        continue
+                    if dataset_ids is not None and row[1] not in dataset_id_set:
+                        continue
+
+                    yield row
+
+    def _find_dataset_chunks(self, source, dataset_ids):
+        """
+        @param source       Open snapshot file
+        @param dataset_ids  Sorted list of dataset ids
+        @return Set of chunk numbers containing any of the datasets
+        """
+
+        chunk_bits = ChunkedSnapshot.chunk_bits
+        chunk_mask = (1 << chunk_bits) - 1
+
+        chunk_numbers = set()
+
+        for offset, length, min_id, max_id in self.dataset_index:
+            ipos = bisect.bisect_left(dataset_ids, min_id)
+            if ipos == len(dataset_ids) or dataset_ids[ipos] > max_id:
+                continue
+
+            source.seek(offset)
+            data = lzma.decompress(source.read(length))
+            nkeys, remainder = divmod(len(data), ChunkedSnapshot.index_key.size)
+            if remainder != 0:
+                raise SnapshotFormatError('%s has a corrupt dataset index block at offset %d' % (self.path, offset))
+
+            keys = struct.unpack('<%dQ' % nkeys, data)
+
+            for dataset_id in dataset_ids[ipos:]:
+                if dataset_id > max_id:
+                    break
+
+                ikey = bisect.bisect_left(keys, dataset_id << chunk_bits)
+                while ikey < len(keys) and (keys[ikey] >> chunk_bits) == dataset_id:
+                    chunk_numbers.add(keys[ikey] & chunk_mask)
+                    ikey += 1
+
+        return chunk_numbers
+
+
+def convert_sqlite_snapshot(sqlite_path, path, rows_per_chunk = 8192):
+    """
+    Write the content of an (uncompressed) SQLite snapshot file into a chunked snapshot.
+    @param sqlite_path     Path to the SQLite file
+    @param path            Path to the chunked snapshot file
+    @param rows_per_chunk  Number of replica rows per chunk
+    """
+
+    snapshot_db = sqlite3.connect(sqlite_path)
+    snapshot_db.text_factory = str
+
+    try:
+        cursor = snapshot_db.cursor()
+
+        cursor.execute('SELECT `id`, `value` FROM `decisions`')
+        decisions = dict(cursor.fetchall())
+        cursor.execute('SELECT `id`, `value` FROM `statuses`')
+        statuses = dict(cursor.fetchall())
+        cursor.execute('SELECT `site_id`, `status_id`, `quota` FROM `sites`')
+        sites = cursor.fetchall()
+
+        writer = SnapshotWriter(path, rows_per_chunk = rows_per_chunk)
+
+        try:
+            cursor.execute('SELECT `site_id`, `dataset_id`, `size`, `decision_id`, `condition` FROM `replicas` ORDER BY `site_id`, `dataset_id`')
+            while True:
+                rows = cursor.fetchmany(10000)
+                if len(rows) == 0:
+                    break
+
+                for row in rows:
+                    writer.add_replica(*row)
+        except:
+            writer.abort()
+            raise
+
+        writer.close(decisions, statuses, sites)
+
+        cursor.close()
+
+    finally:
+        snapshot_db.close()
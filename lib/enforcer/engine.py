@@ -0,0 +1,338 @@
+import logging
+import random
+import collections
+
+from dynamo.policy.attrs import DatasetAttr
+
+LOG = logging.getLogger(__name__)
+
+class RuleMatcher(object):
+    """
+    Target replica conditions of all enforcer rules compiled into one matcher. A condition text used by multiple rules
+    is evaluated once for all of them, and predicates on dataset attributes (which have the same value for all replicas
+    of a dataset) are evaluated once per dataset.
+    """
+
+    def __init__(self, rules):
+        """
+        @param rules  {rule name: EnforcerRule}
+        """
+
+        # [(dataset predicates, replica predicates, set of rule names)]
+        self.conditions = []
+
+        by_text = {}
+        for rule_name, rule in rules.iteritems():
+            for condition in rule.target_replicas:
+                try:
+                    entry = by_text[condition.text]
+                except KeyError:
+                    dataset_predicates = [p for p in condition.predicates if isinstance(p.variable, DatasetAttr)]
+                    replica_predicates = [p for p in condition.predicates if not isinstance(p.variable, DatasetAttr)]
+                    entry = by_text[condition.text] = (dataset_predicates, replica_predicates, set())
+                    self.conditions.append(entry)
+
+                entry[2].add(rule_name)
+
+    def match(self, replicas, site_rules):
+        """
+        Match the replicas of one dataset against the conditions.
+        @param replicas    Non-empty list of dataset replicas of a single dataset
+        @param site_rules  {site: set of rule names} Rules for which the replicas at the site are considered
+        @return {rule name: set of matching replicas}
+        """
+
+        matched = collections.defaultdict(set)
+
+        for dataset_predicates, replica_predicates, rule_names in self.conditions:
+            dataset_match = True
+            for predicate in dataset_predicates:
+                if not predicate(replicas[0]):
+                    dataset_match = False
+                    break
+
+            if not dataset_match:
+                continue
+
+            for replica in replicas:
+                rules = rule_names & site_rules[replica.site]
+                if len(rules) == 0:
+                    continue
+
+                for predicate in replica_predicates:
+                    if not predicate(replica):
+                        break
+                else:
+                    for rule_name in rules:
+                        matched[rule_name].add(replica)
+
+        return matched
+
+
+class RuleStatus(object):
+    """
+    Result of the evaluation of one enforcer rule.
+    """
+
+    def __init__(self):
+        # Names of datasets with enough complete replicas
+        self.already_there = []
+        # {dataset name__site name: physical size__logical size} for incomplete replicas filling the missing copies
+        self.en_route = {}
+        # {dataset name: size} for datasets lacking copies
+        self.still_missing = {}
+        # [(dataset, site)] copies to request
+        self.requests = []
+        # {dataset: set of replicas} replicas at the destinations to protect (only for rules with protect = True)
+        self.protected_replicas = {}
+
+
+class EnforcerEngine(object):
+    """
+    Evaluate all enforcer rules in one pass over the datasets. The source and target replica conditions of all rules
+    are matched together, and the replicas at the destination sites are examined once per dataset for all rules that
+    select the dataset. Results are cached per inventory version and shared among the engines with the same rules
+    in the process (enforcer dealer plugin, EnforcedProtectionTagger, track_enforcer).
+    """
+
+    # {(inventory id, partition name, rules key): (inventory version, {rule name: RuleStatus})}
+    _cache = {}
+
+    def __init__(self, rules, partition_name):
+        """
+        @param rules           {rule name: EnforcerRule}
+        @param partition_name  Partition to work in
+        """
+
+        self.rules = rules
+        self.partition_name = partition_name
+
+        self.matcher = RuleMatcher(rules)
+
+        rule_keys = []
+        for rule_name in sorted(rules.iterkeys()):
+            rule = rules[rule_name]
+            rule_keys.append((
+                rule_name,
+                rule.num_copies,
+                tuple(c.text for c in rule.destination_sites),
+                tuple(c.text for c in rule.source_sites),
+                tuple(c.text for c in rule.target_replicas),
+                rule.destination_group_name,
+                rule.protect
+            ))
+
+        self._rules_key = tuple(rule_keys)
+
+    def evaluate(self, inventory):
+        """
+        @param inventory  Inventory
+        @return {rule name: RuleStatus}
+        """
+
+        cache_key = (id(inventory), self.partition_name, self._rules_key)
+        version = getattr(inventory, 'version', None)
+
+        try:
+            cached_version, statuses = EnforcerEngine._cache[cache_key]
+        except KeyError:
+            pass
+        else:
+            if version is not None and cached_version == version:
+                LOG.info('Using the enforcer rule evaluation for inventory version %d.', version)
+                return statuses
+
+        statuses = self._evaluate(inventory)
+
+        if version is not None:
+            EnforcerEngine._cache[cache_key] = (version, statuses)
+
+        return statuses
+
+    def _evaluate(self, inventory):
+        partition = inventory.partitions[self.partition_name]
+
+        statuses = {}
+        # {rule name: (destination sites, source sites, destination group, target number of copies)}
+        setups = {}
+        # {site: set of rule names} rules considering the replicas at the site (at the sources, and at the destinations for protection)
+        site_rules = collections.defaultdict(set)
+
+        for rule_name, rule in self.rules.iteritems():
+            statuses[rule_name] = RuleStatus()
+
+            destination_sites = find_sites(rule.destination_sites, inventory, partition)
+            source_sites = find_sites(rule.source_sites, inventory, partition)
+            destination_group = inventory.groups[rule.destination_group_name]
+            # if there are not enough destinations, the rule is never fulfilled - cap
+            target_num = min(rule.num_copies, len(destination_sites))
+
+            setups[rule_name] = (destination_sites, source_sites, destination_group, target_num)
+
+            for site in source_sites:
+                site_rules[site].add(rule_name)
+
+            if rule.protect:
+                for site in destination_sites:
+                    site_rules[site].add(rule_name)
+
+        num_evaluated = 0
+
+        for dataset in inventory.datasets.itervalues():
+            replicas = []
+            for replica in dataset.replicas:
+                if replica.site in site_rules and replica in replica.site.partitions[partition].replicas:
+                    replicas.append(replica)
+
+            if len(replicas) == 0:
+                continue
+
+            matched = self.matcher.match(replicas, site_rules)
+            if len(matched) == 0:
+                continue
+
+            rules_to_count = []
+
+            for rule_name, matched_replicas in matched.iteritems():
+                destination_sites, source_sites, _, _ = setups[rule_name]
+
+                for replica in matched_replicas:
+                    if replica.site in source_sites:
+                        rules_to_count.append(rule_name)
+                        break
+
+                if self.rules[rule_name].protect:
+                    protected = set(r for r in matched_replicas if r.site in destination_sites)
+                    if len(protected) != 0 and len(protected) <= self.rules[rule_name].num_copies:
+                        statuses[rule_name].protected_replicas[dataset] = protected
+
+            if len(rules_to_count) == 0:
+                continue
+
+            num_evaluated += 1
+
+            # Full dataset replicas entirely in the partition, with their single owner (None if multiple owners)
+            candidates = []
+            for replica in dataset.replicas:
+                if len(replica.block_replicas) != len(dataset.blocks):
+                    # this is a block-level replica instead of a dataset subscription
+                    continue
+
+                try:
+                    blockreps_in_partition = replica.site.partitions[partition].replicas[replica]
+                except KeyError:
+                    continue
+
+                if blockreps_in_partition is not None:
+                    # skip replicas not fully in partition
+                    continue
+
+                owners = set(b.group for b in replica.block_replicas)
+                if len(owners) == 1:
+                    candidates.append((replica, owners.pop()))
+                else:
+                    candidates.append((replica, None))
+
+            # {replica: is_full()} evaluated once for all rules
+            fullness = {}
+
+            for rule_name in rules_to_count:
+                self._count_replicas(rule_name, setups[rule_name], dataset, candidates, fullness, statuses[rule_name])
+
+        LOG.info('Evaluated %d enforcer rules on %d datasets.', len(self.rules), num_evaluated)
+
+        return statuses
+
+    def _count_replicas(self, rule_name, setup, dataset, candidates, fullness, status):
+        """
+        Check how many full replicas of the dataset are in the destination sites and fill the rule status.
+        """
+
+        destination_sites, _, destination_group, target_num = setup
+
+        num_complete = 0
+        num_incomplete = 0
+        used_sites = set()
+        data_incomplete = {}
+        can_be_flipped = []
+
+        for replica, owner in candidates:
+            if replica.site not in destination_sites:
+                continue
+
+            if owner is not destination_group:
+                # Replicas not owned by the target group is neither complete nor incomplete
+                # But can be flipped the ownership later as an easy completion
+                can_be_flipped.append(replica)
+                continue
+
+            used_sites.add(replica.site)
+
+            try:
+                is_full = fullness[replica]
+            except KeyError:
+                is_full = fullness[replica] = replica.is_full()
+
+            if is_full:
+                num_complete += 1
+            else:
+                num_incomplete += 1
+                data_incomplete[replica.site.name] = str(replica.size(physical = True)) + "__" + str(replica.size(physical = False))
+
+        if num_complete >= target_num:
+            status.already_there.append(dataset.name)
+
+        elif num_complete + num_incomplete >= target_num:
+            for key, value in data_incomplete.iteritems():
+                status.en_route[dataset.name + "__" + key] = value
+
+        else:
+            # Number of complete and en-route replicas is smaller than the number of replicas needed. We need to create more replicas.
+
+            site_candidates = destination_sites - used_sites
+            if len(site_candidates) == 0:
+                # we have nowhere to request copy to
+                return
+
+            status.still_missing[dataset.name] = dataset.size
+
+            site_candidates = list(site_candidates)
+            random.shuffle(site_candidates)
+
+            request_sites = []
+            while num_complete + num_incomplete + len(request_sites) < target_num:
+                # prioritize the replicas where we can just flip the ownership
+                if len(can_be_flipped) != 0:
+                    replica = can_be_flipped.pop()
+                    request_sites.append(replica.site)
+                    continue
+
+                if len(site_candidates) == 0:
+                    break
+
+                request_sites.append(site_candidates.pop())
+
+            for site in request_sites:
+                LOG.debug('Enforcer rule %s requesting %s at %s', rule_name, dataset.name, site.name)
+                status.requests.append((dataset, site))
+
+
+def find_sites(conditions, inventory, partition):
+    """
+    @param conditions  List of ORed site conditions
+    @param inventory   Inventory
+    @param partition   Partition
+    @return Set of sites whose partition matches any of the conditions.
+    """
+
+    sites = set()
+
+    for site in inventory.sites.itervalues():
+        site_partition = site.partitions[partition]
+
+        for condition in conditions:
+            if condition.match(site_partition):
+                sites.add(site)
+                break
+
+    return sites
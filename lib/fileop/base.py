@@ -8,12 +8,13 @@ class FileOperation(object):
     def set_read_only(self, value = True):
         self._read_only = value
 
-    def form_batches(self, tasks):
+    def form_batches(self, tasks, max_tasks = None):
         """
         Organize the transfer and deletion tasks into batches in whatever way preferrable to the backend.
         Tasks can be dropped; total number of tasks in the output can be smaller than the input.
         RLFSM can decide to further break down the batch, if some files are failing.
-        @params tasks  list of RLFSM.Transfer(Deletion)Task objects
+        @params tasks      list of RLFSM.Transfer(Deletion)Task objects
+        @params max_tasks  If not None, maximum number of tasks the backend should accept now
 
         @return  List of lists of tasks
         """
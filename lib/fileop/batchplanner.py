@@ -0,0 +1,177 @@
+import bisect
+import collections
+import logging
+
+LOG = logging.getLogger(__name__)
+
+class BatchPlanner(object):
+    """
+    Organizes transfer tasks into batches for the file operation backends. Tasks are first grouped
+    by link (source, destination) and by file size class, so that a batch does not mix very large
+    and very small files. Within each group, tasks are packed into batches with a first-fit decreasing
+    heuristic on the expected transfer duration.
+    The planner only looks at task.source, task.subscription.destination, and task.subscription.file,
+    and can therefore be exercised with any objects that have these attributes.
+    """
+
+    def __init__(self, config):
+        # Maximum number of tasks in a single batch
+        self.batch_size = config.get('batch_size', 1)
+        # Maximum sum of expected transfer durations (s) in a single batch. 0 -> no limit
+        self.max_batch_duration = config.get('max_batch_duration', 0)
+        # Upper bounds (bytes) of the file size classes. Files larger than the last bound form the last class.
+        self.size_classes = sorted(config.get('size_classes', [1.e+8, 1.e+9, 1.e+10]))
+        # Maximum number of pending tasks per link. 0 -> no limit
+        self.max_link_tasks = config.get('max_link_tasks', 0)
+        # Throughput (bytes / s) used to estimate the durations when no link performance model is set
+        self.default_throughput = float(config.get('default_throughput', 1.e+7))
+
+        # Optional LinkPerformance object used to estimate the durations
+        self.link_performance = None
+
+    def plan(self, tasks, max_tasks = None, link_load = None):
+        """
+        Form batches out of transfer tasks. Tasks can be dropped when per-link or total limits are reached.
+        @param tasks      List of RLFSM.TransferTask objects
+        @param max_tasks  Maximum total number of tasks to return. None -> no limit
+        @param link_load  {(source name, destination name): number of pending tasks}, used with max_link_tasks
+
+        @return  List of lists of tasks. Batches of different links are interleaved.
+        """
+
+        by_link = collections.OrderedDict()
+        for task in tasks:
+            key = (task.source.name, task.subscription.destination.name)
+            try:
+                by_link[key].append(task)
+            except KeyError:
+                by_link[key] = [task]
+
+        selected = []
+
+        for (source_name, dest_name), link_tasks in by_link.iteritems():
+            if self.max_link_tasks > 0:
+                if link_load is None:
+                    load = 0
+                else:
+                    load = link_load.get((source_name, dest_name), 0)
+
+                num_allowed = max(self.max_link_tasks - load, 0)
+                if num_allowed < len(link_tasks):
+                    LOG.debug('Link %s -> %s is at capacity. Dropping %d tasks.', source_name, dest_name, len(link_tasks) - num_allowed)
+                    link_tasks = link_tasks[:num_allowed]
+
+            if len(link_tasks) != 0:
+                selected.append(((source_name, dest_name), link_tasks))
+
+        if max_tasks is not None:
+            # Share max_tasks among the links before packing, so that full batches of the first links do not use it up
+            quotas = self._share([len(link_tasks) for _, link_tasks in selected], max_tasks)
+            selected = [(link, link_tasks[:quota]) for (link, link_tasks), quota in zip(selected, quotas) if quota != 0]
+
+        link_batches = []
+
+        for (source_name, dest_name), link_tasks in selected:
+            if self.link_performance is None:
+                throughput = self.default_throughput
+            else:
+                throughput = self.link_performance.throughput(source_name, dest_name)
+
+            by_class = collections.defaultdict(list)
+            for task in link_tasks:
+                size = task.subscription.file.size
+                by_class[bisect.bisect_left(self.size_classes, size)].append((size / throughput, task))
+
+            batches = []
+            for size_class in sorted(by_class.iterkeys()):
+                batches.extend(self._pack(by_class[size_class]))
+
+            link_batches.append(batches)
+
+        # Interleave the links
+        result = []
+        num_tasks = 0
+        index = 0
+        while len(link_batches) != 0:
+            remaining = []
+            for batches in link_batches:
+                batch = batches[index]
+
+                if max_tasks is not None and num_tasks + len(batch) > max_tasks:
+                    batch = batch[:max_tasks - num_tasks]
+                    if len(batch) != 0:
+                        result.append(batch)
+
+                    return result
+
+                result.append(batch)
+                num_tasks += len(batch)
+
+                if len(batches) > index + 1:
+                    remaining.append(batches)
+
+            link_batches = remaining
+            index += 1
+
+        return result
+
+    def _share(self, demands, total):
+        """
+        Divide total among the demands as evenly as possible (max-min fair share).
+        @param demands  List of numbers of tasks
+        @param total    Number to divide
+
+        @return  List of shares, in the order of demands
+        """
+
+        shares = [0] * len(demands)
+        remaining = max(total, 0)
+
+        # Serve the smallest demands first; whatever they do not use goes to the larger ones
+        order = sorted(range(len(demands)), key = lambda i: demands[i])
+        for nleft, index in zip(xrange(len(order), 0, -1), order):
+            shares[index] = min(demands[index], remaining // nleft)
+            remaining -= shares[index]
+
+        # Remainder of the integer division, one task each in the original order
+        for index in xrange(len(demands)):
+            if remaining == 0:
+                break
+            if shares[index] < demands[index]:
+                shares[index] += 1
+                remaining -= 1
+
+        return shares
+
+    def _pack(self, entries):
+        """
+        First-fit decreasing bin packing.
+        @param entries  List of (expected duration, task)
+
+        @return  List of lists of tasks
+        """
+
+        entries.sort(key = lambda e: e[0], reverse = True)
+
+        # [[total duration, [tasks]]]
+        bins = []
+        # bins that can still take tasks
+        open_bins = []
+
+        for duration, task in entries:
+            for b in open_bins:
+                if self.max_batch_duration > 0 and b[0] + duration > self.max_batch_duration:
+                    continue
+
+                b[0] += duration
+                b[1].append(task)
+                break
+            else:
+                b = [duration, [task]]
+                bins.append(b)
+                open_bins.append(b)
+
+            if len(b[1]) >= self.batch_size:
+                open_bins.remove(b)
+
+        return [b[1] for b in bins]
@@ -6,6 +6,7 @@ import collections
 import json
 import logging
 import errno
+import threading
 
 import fts3.rest.client.easy as fts3
 from fts3.rest.client.request import Request
@@ -16,7 +17,8 @@ from dynamo.fileop.transfer import FileTransferOperation, FileTransferQuery
 from dynamo.fileop.deletion import FileDeletionOperation, FileDeletionQuery
 from dynamo.fileop.errors import find_msg_code
 from dynamo.utils.interface.mysql import MySQL
-from dynamo.dataformat import Site
+from dynamo.utils.parallel import Map
+from dynamo.dataformat import Site, Configuration
 
 LOG = logging.getLogger(__name__)
 
@@ -53,9 +55,23 @@ class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOpe
         # Bookkeeping device
         self.db = MySQL(config.db_params)
 
-        # Reuse the context object
+        # Reuse the context objects. Contexts are pooled so that concurrent calls do not share one.
         self.keep_context = config.get('keep_context', True)
-        self._context = None
+        self._contexts = []
+        self._context_lock = threading.Lock()
+
+        # Job status polling: number of concurrent queries, number of jobs per bulk query (1 -> no bulk query),
+        # and the time in seconds for which the results of a polling sweep are used.
+        self.status_poll_threads = config.get('status_poll_threads', 8)
+        self.status_bulk_size = config.get('status_bulk_size', 20)
+        self.status_lifetime = config.get('status_lifetime', 60)
+        # persistent thread pool for the status queries
+        self._status_poller = Map(Configuration(num_threads = self.status_poll_threads, repeat_on_exception = False))
+
+        # {optype: (timestamp, {job_id: job status})}
+        self._job_status = {}
+        # {optype: {job_id: job status}} of jobs found in a final state (never change)
+        self._final_jobs = {}
 
     def num_pending_transfers(self): #override
         # Check the number of files in queue
@@ -98,12 +114,17 @@ class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOpe
 
         return num_pending
 
-    def form_batches(self, tasks): #override
+    def form_batches(self, tasks, max_tasks = None): #override
         if len(tasks) == 0:
             return []
 
-        # FTS3 has no restriction on how to group the transfers, but cannot apparently take thousands
-        # of tasks at once
+        if hasattr(tasks[0], 'source'):
+            # These are transfer tasks
+            # FTS3 has no restriction on how to group the transfers, but a batch completes only when its slowest
+            # file does. Group by link and file size.
+            return self.batch_planner.plan(tasks, max_tasks = max_tasks)
+
+        # FTS3 cannot apparently take thousands of tasks at once
         batches = [[]]
         for task in tasks:
             batches[-1].append(task)
@@ -317,18 +338,19 @@ class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOpe
         return self._do_ftscall(url = url)
 
     def _do_ftscall(self, binding = None, url = None):
-        if self._context is None:
+        with self._context_lock:
+            try:
+                context = self._contexts.pop()
+            except IndexError:
+                context = None
+
+        if context is None:
             # request_class = Request -> use "requests"-based https call (instead of default PyCURL,
             # which may not be able to handle proxy certificates depending on the cURL installation)
             # verify = False -> do not verify the server certificate
             context = fts3.Context(self.server_url, ucert = self.x509proxy, ukey = self.x509proxy,
                                    request_class = Request, verify = False)
 
-            if self.keep_context:
-                self._context = context
-        else:
-            context = self._context
-
         if binding is not None:
             reqstring = binding[0]
         else:
@@ -336,23 +358,29 @@ class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOpe
 
         LOG.debug('FTS: %s', reqstring)
 
-        wait_time = 1.
-        for attempt in xrange(10):
-            try:
-                if binding is not None:
-                    method, args, kwd = binding
-                    return getattr(fts3, method)(context, *args, **kwd)
-                else:
-                    return json.loads(context.get(url))
-            except fts_exceptions.ServerError as exc:
-                if str(exc.reason) == '500':
-                    # Internal server error - let's try again
+        try:
+            wait_time = 1.
+            for attempt in xrange(10):
+                try:
+                    if binding is not None:
+                        method, args, kwd = binding
+                        return getattr(fts3, method)(context, *args, **kwd)
+                    else:
+                        return json.loads(context.get(url))
+                except fts_exceptions.ServerError as exc:
+                    if str(exc.reason) == '500':
+                        # Internal server error - let's try again
+                        pass
+                except fts_exceptions.TryAgain:
                     pass
-            except fts_exceptions.TryAgain:
-                pass
+    
+                time.sleep(wait_time)
+                wait_time *= 1.5
 
-            time.sleep(wait_time)
-            wait_time *= 1.5
+        finally:
+            if self.keep_context:
+                with self._context_lock:
+                    self._contexts.append(context)
 
         LOG.error('Failed to communicate with FTS server: %s', reqstring)
         raise RuntimeError('Failed to communicate with FTS server: %s' % reqstring)
@@ -431,30 +459,40 @@ class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOpe
                     LOG.error('Failed to cancel FTS job %s', job_id)
     
     def _get_status(self, batch_id, optype):
+        # FTS jobs of the batch and their unprocessed tasks in one query; jobs whose tasks are all processed do not appear
         if optype == 'transfer' or optype == 'staging':
-            sql = 'SELECT `id`, `job_id` FROM `fts_transfer_batches`'
-            sql += ' WHERE `task_type` = %s AND `fts_server_id` = %s AND `batch_id` = %s'
-            batch_data = self.db.query(sql, optype, self.server_id, batch_id)
-            task_table_name = 'fts_transfer_tasks'
+            sql = 'SELECT b.`id`, b.`job_id`, t.`fts_file_id`, t.`id` FROM `fts_transfer_batches` AS b'
+            sql += ' INNER JOIN `fts_transfer_tasks` AS t ON t.`fts_batch_id` = b.`id`'
+            sql += ' WHERE b.`task_type` = %s AND b.`fts_server_id` = %s AND b.`batch_id` = %s'
+            sql += ' ORDER BY b.`id`'
+            task_data = self.db.xquery(sql, optype, self.server_id, batch_id)
         else:
-            sql = 'SELECT `id`, `job_id` FROM `fts_deletion_batches`'
-            sql += ' WHERE `fts_server_id` = %s AND `batch_id` = %s'
-            batch_data = self.db.query(sql, self.server_id, batch_id)
-            task_table_name = 'fts_deletion_tasks'
+            sql = 'SELECT b.`id`, b.`job_id`, t.`fts_file_id`, t.`id` FROM `fts_deletion_batches` AS b'
+            sql += ' INNER JOIN `fts_deletion_tasks` AS t ON t.`fts_batch_id` = b.`id`'
+            sql += ' WHERE b.`fts_server_id` = %s AND b.`batch_id` = %s'
+            sql += ' ORDER BY b.`id`'
+            task_data = self.db.xquery(sql, self.server_id, batch_id)
+
+        # [(job_id, {fts_file_id: task_id})] in the order of the FTS batches
+        batch_data = []
+        _fts_batch_id = 0
+        for fts_batch_id, job_id, fts_file_id, task_id in task_data:
+            if fts_batch_id != _fts_batch_id:
+                _fts_batch_id = fts_batch_id
+                fts_to_task = {}
+                batch_data.append((job_id, fts_to_task))
+
+            fts_to_task[fts_file_id] = task_id
 
         message_pattern = re.compile('(?:DESTINATION|SOURCE|TRANSFER|DELETION) \[([0-9]+)\] (.*)')
 
         results = []
 
-        for fts_batch_id, job_id in batch_data:
+        for job_id, fts_to_task in batch_data:
             LOG.debug('Checking status of FTS %s batch %s', optype, job_id)
 
-            sql = 'SELECT `fts_file_id`, `id` FROM `{table}` WHERE `fts_batch_id` = %s'.format(table = task_table_name)
-            fts_to_task = dict(self.db.xquery(sql, fts_batch_id))
-
-            try:
-                result = self._ftscall('get_job_status', job_id = job_id, list_files = True)
-            except:
+            result = self._get_job_status(job_id, optype)
+            if result is None:
                 LOG.error('Failed to get job status for FTS job %s', job_id)
                 continue
     
@@ -539,6 +577,117 @@ class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOpe
 
         return results
 
+    def _get_job_status(self, job_id, optype):
+        """
+        Get the status of a job with the file list. Statuses of all jobs with unprocessed tasks are polled
+        together the first time this function is called and then every status_lifetime seconds.
+        @return  Job status (dict) or None if the query failed.
+        """
+
+        try:
+            return self._final_jobs[optype][job_id]
+        except KeyError:
+            pass
+
+        timestamp, statuses = self._job_status.get(optype, (0, {}))
+        if time.time() - timestamp > self.status_lifetime:
+            statuses = self._poll_jobs(optype)
+            self._job_status[optype] = (time.time(), statuses)
+
+        try:
+            return statuses[job_id]
+        except KeyError:
+            # submitted after the last poll, or the poll failed
+            pass
+
+        try:
+            return self._ftscall('get_job_status', job_id = job_id, list_files = True)
+        except:
+            return None
+
+    def _poll_jobs(self, optype):
+        """
+        Query the statuses of all jobs that have unprocessed tasks, in parallel. Jobs seen in a final state
+        are not queried again.
+        @return  {job_id: job status}
+        """
+
+        if optype == 'transfer' or optype == 'staging':
+            sql = 'SELECT DISTINCT b.`job_id` FROM `fts_transfer_batches` AS b'
+            sql += ' INNER JOIN `fts_transfer_tasks` AS t ON t.`fts_batch_id` = b.`id`'
+            sql += ' WHERE b.`task_type` = %s AND b.`fts_server_id` = %s'
+            job_ids = self.db.query(sql, optype, self.server_id)
+            files_key = 'files'
+        else:
+            sql = 'SELECT DISTINCT b.`job_id` FROM `fts_deletion_batches` AS b'
+            sql += ' INNER JOIN `fts_deletion_tasks` AS t ON t.`fts_batch_id` = b.`id`'
+            sql += ' WHERE b.`fts_server_id` = %s'
+            job_ids = self.db.query(sql, self.server_id)
+            files_key = 'dm'
+
+        try:
+            final_jobs = self._final_jobs[optype]
+        except KeyError:
+            final_jobs = self._final_jobs[optype] = {}
+
+        # forget the final jobs of this optype that are not needed any more
+        job_id_set = set(job_ids)
+        for job_id in final_jobs.keys():
+            if job_id not in job_id_set:
+                final_jobs.pop(job_id)
+
+        job_ids = [j for j in job_ids if j not in final_jobs]
+
+        if len(job_ids) == 0:
+            return {}
+
+        LOG.info('Polling the status of %d FTS %s jobs.', len(job_ids), optype)
+
+        def get_statuses(chunk):
+            statuses = []
+
+            if len(chunk) > 1 and hasattr(fts3, 'get_jobs_statuses'):
+                # Bulk listing endpoint (/jobs/id1,id2,...). Not all server versions return the full file information.
+                try:
+                    results = self._ftscall('get_jobs_statuses', chunk, list_files = True)
+                except:
+                    results = []
+
+                if type(results) is dict:
+                    results = [results]
+
+                for result in results:
+                    try:
+                        if all('file_id' in f and 'file_state' in f for f in result[files_key]):
+                            statuses.append((result['job_id'], result))
+                    except (KeyError, TypeError):
+                        pass
+
+            found = set(s[0] for s in statuses)
+
+            for job_id in chunk:
+                if job_id in found:
+                    continue
+
+                try:
+                    statuses.append((job_id, self._ftscall('get_job_status', job_id = job_id, list_files = True)))
+                except:
+                    LOG.error('Failed to get job status for FTS job %s', job_id)
+
+            return statuses
+
+        bulk_size = max(self.status_bulk_size, 1)
+        chunks = [job_ids[i:i + bulk_size] for i in xrange(0, len(job_ids), bulk_size)]
+
+        statuses = {}
+        for chunk_statuses in self._status_poller.execute(get_statuses, chunks):
+            for job_id, result in chunk_statuses:
+                statuses[job_id] = result
+                if result.get('job_state') in ('FINISHED', 'FINISHEDDIRTY', 'FAILED', 'CANCELED'):
+                    final_jobs[job_id] = result
+
+        return statuses
+
     def _write_history(self, history_db, task_id, history_id, optype):
         if not self._read_only:
             history_db.db.insert_update('fts_servers', ('url',), self.server_url)
@@ -31,18 +31,18 @@ class StandaloneFileOperation(FileTransferOperation, FileTransferQuery, FileDele
         # FOD can throttle itself.
         return 0
 
-    def form_batches(self, tasks): #override
+    def form_batches(self, tasks, max_tasks = None): #override
         if len(tasks) == 0:
             return []
 
         if hasattr(tasks[0], 'source'):
-            # These are transfer tasks
-            by_endpoints = collections.defaultdict(list)
-            for task in tasks:
-                endpoints = (task.source, task.subscription.destination)
-                by_endpoints[endpoints].append(task)
+            # These are transfer tasks; batches must have a single source and destination
+            if self.batch_planner.max_link_tasks > 0:
+                link_load = self._get_link_load()
+            else:
+                link_load = None
 
-            return by_endpoints.values()
+            return self.batch_planner.plan(tasks, max_tasks = max_tasks, link_load = link_load)
         else:
             by_endpoint = collections.defaultdict(list)
             for task in tasks:
@@ -174,6 +174,15 @@ class StandaloneFileOperation(FileTransferOperation, FileTransferQuery, FileDele
     def forget_deletion_batch(self, batch_id): #override
         return self._forget_batch(batch_id, 'deletion')
 
+    def _get_link_load(self):
+        sql = 'SELECT b.`source_site`, b.`destination_site`, COUNT(*) FROM `standalone_transfer_tasks` AS a'
+        sql += ' INNER JOIN `transfer_tasks` AS q ON q.`id` = a.`id`'
+        sql += ' INNER JOIN `standalone_transfer_batches` AS b ON b.`batch_id` = q.`batch_id`'
+        sql += ' WHERE a.`status` IN (\'new\', \'staging\', \'staged\', \'queued\', \'active\')'
+        sql += ' GROUP BY b.`source_site`, b.`destination_site`'
+
+        return dict(((s, d), n) for s, d, n in self.db.xquery(sql))
+
     def _cancel(self, task_ids, optype):
         sql = 'UPDATE `standalone_{op}_tasks` SET `status` = \'cancelled\''.format(op = optype)
         self.db.execute_many(sql, 'id', task_ids, ['`status` IN (\'new\', \'queued\')'])
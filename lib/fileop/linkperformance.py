@@ -0,0 +1,172 @@
+import math
+import time
+import logging
+
+LOG = logging.getLogger(__name__)
+
+class LinkPerformance(object):
+    """
+    Exponentially decayed per-link transfer statistics. For each (source, destination) pair,
+    weighted sums of transferred bytes, transfer durations, and successes and failures are kept.
+    All sums are decayed with a common half-life so that the most recent history dominates.
+    """
+
+    class Link(object):
+        __slots__ = ['bytes', 'duration', 'successes', 'failures', 'timestamp']
+
+        def __init__(self, timestamp):
+            self.bytes = 0.
+            self.duration = 0.
+            self.successes = 0.
+            self.failures = 0.
+            self.timestamp = timestamp
+
+    def __init__(self, config):
+        # Half-life of the statistics in seconds
+        self.halflife = float(config.get('halflife', 86400))
+        # Throughput (bytes / s) assumed for links without history
+        self.default_throughput = float(config.get('default_throughput', 1.e+7))
+        # Failure rate assumed for links without history
+        self.default_failure_rate = float(config.get('default_failure_rate', 0.1))
+        # Number of concurrent transfers on a link before they start to queue
+        self.link_concurrency = config.get('link_concurrency', 20)
+        # Weights of the default values added to the statistics of each link, in seconds of transfer
+        # time and in number of transfers. Links with little history are pulled towards the defaults.
+        self.prior_duration = float(config.get('prior_duration', 60))
+        self.prior_transfers = float(config.get('prior_transfers', 1))
+
+        # {(source name, destination name): Link}
+        self._links = {}
+
+        # Set to True once the history is loaded
+        self.loaded = False
+
+    def load(self, history_db, window = None):
+        """
+        Fill the statistics from the file_transfers table of the history DB.
+        @param history_db  HistoryDatabase instance
+        @param window      Time window in seconds to read back. Default is 5 half-lives.
+        """
+
+        if window is None:
+            window = self.halflife * 5.
+
+        sql = 'SELECT ss.`name`, sd.`name`, f.`size`, t.`exitcode`, UNIX_TIMESTAMP(t.`started`), UNIX_TIMESTAMP(t.`finished`), UNIX_TIMESTAMP(t.`completed`)'
+        sql += ' FROM `file_transfers` AS t'
+        sql += ' INNER JOIN `files` AS f ON f.`id` = t.`file_id`'
+        sql += ' INNER JOIN `sites` AS ss ON ss.`id` = t.`source_id`'
+        sql += ' INNER JOIN `sites` AS sd ON sd.`id` = t.`destination_id`'
+        sql += ' WHERE t.`completed` > FROM_UNIXTIME(%s)'
+        sql += ' ORDER BY t.`completed`'
+
+        num = 0
+        for source, destination, size, exitcode, started, finished, completed in history_db.db.xquery(sql, int(time.time() - window)):
+            self._add(source, destination, size, exitcode, started, finished, completed)
+            num += 1
+
+        LOG.info('Loaded %d file transfers into link performance model for %d links.', num, len(self._links))
+
+        self.loaded = True
+
+    def update(self, source, destination, size, exitcode, start_time, finish_time, timestamp = None):
+        """
+        Add the result of a completed transfer. Ignored until the history is loaded, since the
+        history read at load time already includes the transfers archived before that.
+        @param source       Source site name
+        @param destination  Destination site name
+        @param size         File size in bytes
+        @param exitcode     Transfer exit code (0 = success)
+        @param start_time   UNIX timestamp of the transfer start (can be None)
+        @param finish_time  UNIX timestamp of the transfer end (can be None)
+        @param timestamp    Time of the record. Defaults to now.
+        """
+
+        if not self.loaded:
+            return
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        self._add(source, destination, size, exitcode, start_time, finish_time, timestamp)
+
+    def throughput(self, source, destination, now = None):
+        """
+        @return  Expected per-transfer throughput (bytes / s) of the link.
+        """
+
+        link = self._links.get((source, destination))
+        if link is None:
+            return self.default_throughput
+
+        if now is None:
+            now = time.time()
+
+        decay = self._decay_factor(link, now)
+        prior_bytes = self.default_throughput * self.prior_duration
+
+        return (link.bytes * decay + prior_bytes) / (link.duration * decay + self.prior_duration)
+
+    def failure_rate(self, source, destination, now = None):
+        """
+        @return  Expected failure probability of a transfer on the link.
+        """
+
+        link = self._links.get((source, destination))
+        if link is None:
+            return self.default_failure_rate
+
+        if now is None:
+            now = time.time()
+
+        decay = self._decay_factor(link, now)
+        failures = link.failures * decay + self.default_failure_rate * self.prior_transfers
+        total = (link.successes + link.failures) * decay + self.prior_transfers
+
+        return failures / total
+
+    def expected_time(self, source, destination, size, load = 0, now = None):
+        """
+        Expected time until a file of the given size is successfully transferred over the link.
+        Transfers beyond link_concurrency are assumed to queue, and failed attempts are assumed to be
+        retried on the same link.
+        @param source       Source site name
+        @param destination  Destination site name
+        @param size         File size in bytes
+        @param load         Number of transfers currently pending on the link
+        """
+
+        rate = self.throughput(source, destination, now = now)
+        failure = min(self.failure_rate(source, destination, now = now), 0.99)
+
+        queue_factor = 1. + float(load) / self.link_concurrency
+
+        return (max(size, 1) / rate) * queue_factor / (1. - failure)
+
+    def _add(self, source, destination, size, exitcode, start_time, finish_time, timestamp):
+        key = (source, destination)
+        try:
+            link = self._links[key]
+        except KeyError:
+            link = self._links[key] = LinkPerformance.Link(timestamp)
+
+        decay = self._decay_factor(link, timestamp)
+        if decay != 1.:
+            link.bytes *= decay
+            link.duration *= decay
+            link.successes *= decay
+            link.failures *= decay
+            link.timestamp = timestamp
+
+        if exitcode == 0:
+            link.successes += 1.
+            if start_time is not None and finish_time is not None and finish_time > start_time:
+                link.bytes += float(size)
+                link.duration += float(finish_time - start_time)
+        else:
+            link.failures += 1.
+
+    def _decay_factor(self, link, now):
+        if now <= link.timestamp:
+            return 1.
+
+        return math.pow(0.5, (now - link.timestamp) / self.halflife)
@@ -10,6 +10,7 @@ from dynamo.fileop.base import FileQuery
 from dynamo.fileop.transfer import FileTransferOperation, FileTransferQuery
 from dynamo.fileop.deletion import FileDeletionOperation, FileDeletionQuery, DirDeletionOperation
 from dynamo.fileop.errors import irrecoverable_errors
+from dynamo.fileop.linkperformance import LinkPerformance
 from dynamo.dataformat import Configuration, Block, Site, BlockReplica
 from dynamo.history.history import HistoryDatabase
 from dynamo.utils.interface.mysql import MySQL
@@ -78,6 +79,14 @@ class RLFSM(object):
         # Handle to the history DB
         self.history_db = HistoryDatabase(config.get('history', None))
 
+        # Source selection algorithm: 'throughput' (weighted by the expected completion time on each link)
+        # or 'random' (uniform among the sites not tried yet)
+        self.source_selection = config.get('source_selection', 'throughput')
+        if self.source_selection == 'throughput':
+            self.link_performance = LinkPerformance(config.get('link_performance', Configuration()))
+        else:
+            self.link_performance = None
+
         # FileTransferOperation backend (can make it a map from (source, dest) to operator)
         self.transfer_operations = []
         if 'transfer' in config:
@@ -89,6 +98,9 @@ class RLFSM(object):
 
                 self.transfer_operations.append((condition, FileTransferOperation.get_instance(module, conf)))
 
+        for _, op in self.transfer_operations:
+            op.batch_planner.link_performance = self.link_performance
+
         if 'transfer_query' in config:
             self.transfer_queries = []
             for condition_text, module, conf in config.transfer_query:
@@ -251,7 +263,7 @@ class RLFSM(object):
             if len(my_tasks) == 0:
                 return 0, 0, 0
 
-            batches = op.form_batches(my_tasks)
+            batches = op.form_batches(my_tasks, max_tasks = op.max_pending_transfers - pending_count[op])
     
             if self.cycle_stop.is_set():
                 return 0, 0, 0
@@ -533,10 +545,6 @@ class RLFSM(object):
 
         subscriptions = []
 
-        get_all = 'SELECT u.`id`, u.`status`, u.`delete`, f.`block_id`, f.`name`, s.`name`, u.`hold_reason` FROM `file_subscriptions` AS u'
-        get_all += ' INNER JOIN `files` AS f ON f.`id` = u.`file_id`'
-        get_all += ' INNER JOIN `sites` AS s ON s.`id` = u.`site_id`'
-
         constraints = []
         if op == 'transfer':
             constraints.append('u.`delete` = 0')
@@ -546,26 +554,66 @@ class RLFSM(object):
             constraints.append('u.`status` IN ' + MySQL.stringify_sequence(status))
 
         if len(constraints) != 0:
-            get_all += ' WHERE ' + ' AND '.join(constraints)
+            where = ' WHERE ' + ' AND '.join(constraints)
+        else:
+            where = ''
 
-        get_all += ' ORDER BY s.`id`, f.`block_id`'
+        # Resolve all blocks that appear in the subscriptions in one go
+        get_blocks = 'SELECT DISTINCT b.`id`, d.`name`, b.`name` FROM `file_subscriptions` AS u'
+        get_blocks += ' INNER JOIN `files` AS f ON f.`id` = u.`file_id`'
+        get_blocks += ' INNER JOIN `blocks` AS b ON b.`id` = f.`block_id`'
+        get_blocks += ' INNER JOIN `datasets` AS d ON d.`id` = b.`dataset_id`'
+        get_blocks += where
 
-        get_tried_sites = 'SELECT s.`name`, f.`exitcode` FROM `failed_transfers` AS f'
-        get_tried_sites += ' INNER JOIN `sites` AS s ON s.`id` = f.`source_id`'
-        get_tried_sites += ' WHERE f.`subscription_id` = %s'
+        blocks = {}
+        for block_id, dataset_name, block_name in self.db.xquery(get_blocks):
+            try:
+                dataset = inventory.datasets[dataset_name]
+            except KeyError:
+                # Dataset was deleted from the inventory earlier in this process
+                continue
+
+            block = dataset.find_block(Block.to_internal_name(block_name))
+            if block is not None:
+                blocks[block_id] = block
+
+        # Failed sources of all subscriptions in retry state, in the order of failure
+        failures = collections.defaultdict(list)
+        if op != 'deletion' and (status is None or 'retry' in status):
+            get_tried_sites = 'SELECT f.`subscription_id`, s.`name`, f.`exitcode` FROM `failed_transfers` AS f'
+            get_tried_sites += ' INNER JOIN `file_subscriptions` AS u ON u.`id` = f.`subscription_id`'
+            get_tried_sites += ' INNER JOIN `sites` AS s ON s.`id` = f.`source_id`'
+            get_tried_sites += ' WHERE u.`delete` = 0 AND u.`status` = \'retry\''
+            get_tried_sites += ' ORDER BY f.`subscription_id`, f.`id`'
+
+            for sub_id, source_name, exitcode in self.db.xquery(get_tried_sites):
+                failures[sub_id].append((source_name, exitcode))
+
+        get_all = 'SELECT u.`id`, u.`status`, u.`delete`, f.`block_id`, f.`id`, f.`name`, s.`name`, u.`hold_reason` FROM `file_subscriptions` AS u'
+        get_all += ' INNER JOIN `files` AS f ON f.`id` = u.`file_id`'
+        get_all += ' INNER JOIN `sites` AS s ON s.`id` = u.`site_id`'
+        get_all += where
+        get_all += ' ORDER BY s.`id`, f.`block_id`'
 
         _destination_name = ''
         _block_id = -1
 
+        # Files and source candidates are common to all subscriptions of a block
+        # {block_id: {file_id: file}}
+        block_files = {}
+        # {(block, destination): ([complete disk], [complete tape], [partial replicas])}
+        block_sources = {}
+
         no_source = []
         all_failed = []
         to_done = []
+        to_cancel = []
 
         COPY = 0
         DELETE = 1
 
-        for row in self.db.query(get_all):
-            sub_id, st, optype, block_id, file_name, site_name, hold_reason = row
+        for row in self.db.xquery(get_all):
+            sub_id, st, optype, block_id, file_id, file_name, site_name, hold_reason = row
 
             if site_name != _destination_name:
                 _destination_name = site_name
@@ -581,28 +629,32 @@ class RLFSM(object):
                 continue
 
             if block_id != _block_id:
-                lfile = inventory.find_file(file_name)
-                if lfile is None:
-                    # Dataset, block, or file was deleted from the inventory earlier in this process (deletion not reflected in the inventory store yet)
-                    continue
+                try:
+                    block = blocks[block_id]
+                except KeyError:
+                    # Dataset or block was deleted from the inventory earlier in this process (deletion not reflected in the inventory store yet)
+                    block = None
+                    files = {}
+                else:
+                    try:
+                        files = block_files[block_id]
+                    except KeyError:
+                        files = block_files[block_id] = dict((f.id, f) for f in block.files)
+
+                    dest_replica = block.find_replica(destination)
 
                 _block_id = block_id
-                block = lfile.block
-                dest_replica = block.find_replica(destination)
 
-            else:
-                lfile = block.find_file(file_name)
-                if lfile is None:
-                    # Dataset, block, or file was deleted from the inventory earlier in this process (deletion not reflected in the inventory store yet)
-                    continue
+            try:
+                lfile = files[file_id]
+            except KeyError:
+                # File was deleted from the inventory earlier in this process (deletion not reflected in the inventory store yet)
+                continue
 
             if dest_replica is None and st != 'cancelled':
                 LOG.debug('Destination replica for %s does not exist. Canceling the subscription.', file_name)
                 # Replica was invalidated
-                sql = 'UPDATE `file_subscriptions` SET `status` = \'cancelled\''
-                sql += ' WHERE `id` = %s'
-                if not self._read_only:
-                    self.db.query(sql, sub_id)
+                to_cancel.append(sub_id)
 
                 if status is not None and 'cancelled' not in status:
                     # We are not asked to return cancelled subscriptions
@@ -623,12 +675,29 @@ class RLFSM(object):
                         st = 'done'
 
                     else:
-                        disk_sources = []
-                        tape_sources = []
-                        for replica in block.replicas:
-                            if replica.site == destination or replica.site.status != Site.STAT_READY:
-                                continue
-            
+                        try:
+                            complete_disk, complete_tape, partial = block_sources[(block, destination)]
+                        except KeyError:
+                            complete_disk = []
+                            complete_tape = []
+                            partial = []
+                            for replica in block.replicas:
+                                if replica.site == destination or replica.site.status != Site.STAT_READY:
+                                    continue
+
+                                if replica.file_ids is None:
+                                    if replica.site.storage_type == Site.TYPE_DISK:
+                                        complete_disk.append(replica.site)
+                                    elif replica.site.storage_type == Site.TYPE_MSS:
+                                        complete_tape.append(replica.site)
+                                else:
+                                    partial.append(replica)
+
+                            block_sources[(block, destination)] = (complete_disk, complete_tape, partial)
+
+                        disk_sources = list(complete_disk)
+                        tape_sources = list(complete_tape)
+                        for replica in partial:
                             if replica.has_file(lfile):
                                 if replica.site.storage_type == Site.TYPE_DISK:
                                     disk_sources.append(replica.site)
@@ -643,7 +712,7 @@ class RLFSM(object):
 
                 if st == 'retry':
                     failed_sources = {}
-                    for source_name, exitcode in self.db.query(get_tried_sites, sub_id):
+                    for source_name, exitcode in failures.get(sub_id, []):
                         try:
                             source = inventory.sites[source_name]
                         except KeyError:
@@ -698,6 +767,7 @@ class RLFSM(object):
             LOG.info(msg)
 
         if not self._read_only:
+            self.db.execute_many('UPDATE `file_subscriptions` SET `status` = \'cancelled\'', 'id', to_cancel)
             self.db.execute_many('UPDATE `file_subscriptions` SET `status` = \'done\', `last_update` = NOW()', 'id', to_done)
             self.db.execute_many('UPDATE `file_subscriptions` SET `status` = \'held\', `hold_reason` = \'no_source\', `last_update` = NOW()', 'id', no_source)
             self.db.execute_many('UPDATE `file_subscriptions` SET `status` = \'held\', `hold_reason` = \'all_failed\', `last_update` = NOW()', 'id', all_failed)
@@ -974,6 +1044,9 @@ class RLFSM(object):
 
                 if optype == 'transfer':
                     LOG.debug('Archiving transfer of %s from %s to %s (exitcode %d)', lfn, source_name, dest_name, exitcode)
+
+                    if self.link_performance is not None and status != FileQuery.STAT_CANCELLED:
+                        self.link_performance.update(source_name, dest_name, size, exitcode, start_time, finish_time)
                 else:
                     LOG.debug('Archiving deletion of %s at %s (exitcode %d)', lfn, site_name, exitcode)
 
@@ -1061,7 +1134,43 @@ class RLFSM(object):
         @return  List of TransferTask objects
         """
 
-        def find_site_to_try(sources, failed_sources):
+        if self.link_performance is not None:
+            if not self.link_performance.loaded:
+                self.link_performance.load(self.history_db)
+
+            # Number of pending transfers per link, incremented as we assign new tasks
+            sql = 'SELECT ss.`name`, sd.`name`, COUNT(*) FROM `transfer_tasks` AS t'
+            sql += ' INNER JOIN `file_subscriptions` AS u ON u.`id` = t.`subscription_id`'
+            sql += ' INNER JOIN `sites` AS ss ON ss.`id` = t.`source_id`'
+            sql += ' INNER JOIN `sites` AS sd ON sd.`id` = u.`site_id`'
+            sql += ' GROUP BY t.`source_id`, u.`site_id`'
+            link_load = collections.defaultdict(int)
+            for source_name, dest_name, count in self.db.xquery(sql):
+                link_load[(source_name, dest_name)] = count
+
+            now = time.time()
+
+        def choose(sites, subscription):
+            if self.link_performance is None or len(sites) == 1:
+                return random.choice(sites)
+
+            # Weighted random choice, with the weights inversely proportional to the expected completion time
+            dest_name = subscription.destination.name
+            size = subscription.file.size
+            weights = []
+            for site in sites:
+                load = link_load[(site.name, dest_name)]
+                weights.append(1. / self.link_performance.expected_time(site.name, dest_name, size, load = load, now = now))
+
+            x = random.random() * sum(weights)
+            for site, weight in zip(sites, weights):
+                x -= weight
+                if x < 0.:
+                    return site
+
+            return sites[-1]
+
+        def find_site_to_try(subscription, sources, failed_sources):
             not_tried = set(sources)
             if failed_sources is not None:
                 not_tried -= set(failed_sources.iterkeys())
@@ -1090,17 +1199,17 @@ class RLFSM(object):
                     return by_failure[0]
 
             else:
-                LOG.debug('Selecting randomly')
-                return random.choice(list(not_tried))
+                LOG.debug('Selecting from untried sites')
+                return choose(list(not_tried), subscription)
 
         tasks = []
 
         for subscription in subscriptions:
             LOG.debug('Selecting a disk source for subscription %d (%s to %s)', subscription.id, subscription.file.lfn, subscription.destination.name)
-            source = find_site_to_try(subscription.disk_sources, subscription.failed_sources)
+            source = find_site_to_try(subscription, subscription.disk_sources, subscription.failed_sources)
             if source is None:
                 LOG.debug('Selecting a tape source for subscription %d', subscription.id)
-                source = find_site_to_try(subscription.tape_sources, subscription.failed_sources)
+                source = find_site_to_try(subscription, subscription.tape_sources, subscription.failed_sources)
 
             if source is None:
                 # If both disk and tape failed irrecoveably, the subscription must be placed in held queue in get_subscriptions.
@@ -1108,6 +1217,9 @@ class RLFSM(object):
                 LOG.warning('Could not find a source for transfer of %s to %s from %d disk and %d tape candidates.',
                     subscription.file.lfn, subscription.destination.name, len(subscription.disk_sources), len(subscription.tape_sources))
                 continue
+
+            if self.link_performance is not None:
+                link_load[(source.name, subscription.destination.name)] += 1
             
             tasks.append(RLFSM.TransferTask(subscription, source))
 
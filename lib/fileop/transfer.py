@@ -1,4 +1,5 @@
 from dynamo.fileop.base import FileOperation, FileQuery
+from dynamo.fileop.batchplanner import BatchPlanner
 from dynamo.utils.classutil import get_instance
 from dynamo.dataformat import File, ConfigurationError
 
@@ -21,6 +22,9 @@ class FileTransferOperation(FileOperation):
             except ValueError:
                 raise ConfigurationError('Checksum algorithm %s not supported by File object.' % self.checksum_algorithm)
 
+        # Batch formation by link, file size, and expected duration
+        self.batch_planner = BatchPlanner(config)
+
     def num_pending_transfers(self):
         """
         Return the number of pending transfers. Can report max_pending_transfers even when there are more.
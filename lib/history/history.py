@@ -1,3 +1,6 @@
+import collections
+import threading
+
 from dynamo.utils.interface.mysql import MySQL
 from dynamo.dataformat import Configuration
 
@@ -13,6 +16,24 @@ class HistoryDatabase(object):
     # default configuration
     _config = Configuration()
 
+    # Dimension tables resolvable through resolve_ids: {kind: (key columns, insert columns)}
+    # Keys of files are (name, size) tuples and keys of blocks are (dataset name, block name) tuples.
+    # Key columns must have a case-sensitive UNIQUE key so that concurrent inserts do not create duplicates.
+    _id_tables = {
+        'partitions': (('name',), ('name',)),
+        'groups': (('name',), ('name',)),
+        'sites': (('name',), ('name',)),
+        'user_services': (('name',), ('name',)),
+        'datasets': (('name',), ('name',)),
+        'files': (('name',), ('name', 'size')),
+        'blocks': (('dataset_id', 'name'), ('dataset_id', 'name'))
+    }
+
+    # Process-wide name -> id caches {(host, db, kind): OrderedDict(name: id)}. Ids of the dimension
+    # table rows never change once inserted, so the cache can only be incomplete, never stale.
+    _id_cache = {}
+    _id_cache_lock = threading.Lock()
+
     @staticmethod
     def set_default(config):
         HistoryDatabase._config = Configuration(config)
@@ -23,6 +44,12 @@ class HistoryDatabase(object):
 
         self.db = MySQL(config.db_params)
 
+        # Maximum number of names cached per table
+        self.id_cache_size = config.get('id_cache_size', 100000)
+
+        db_config = self.db.config()
+        self._id_cache_key = (db_config.get('host', ''), db_config.get('db', ''))
+
         self.set_read_only(config.get('read_only', False))
 
     def set_read_only(self, value = True):
@@ -50,10 +77,10 @@ class HistoryDatabase(object):
             else:
                 return
 
-        self.db.insert_many('user_services', ('name',), MySQL.make_tuple, service_names, do_update = True)
+        ids = self.resolve_ids('user_services', service_names)
 
         if get_ids:
-            return self.db.select_many('user_services', ('id',), 'name', service_names)
+            return ids
 
     def save_partitions(self, partition_names, get_ids = False):
         if self._read_only:
@@ -62,10 +89,10 @@ class HistoryDatabase(object):
             else:
                 return
 
-        self.db.insert_many('partitions', ('name',), MySQL.make_tuple, partition_names, do_update = True)
+        ids = self.resolve_ids('partitions', partition_names)
 
         if get_ids:
-            return self.db.select_many('partitions', ('id',), 'name', partition_names)
+            return ids
 
     def save_sites(self, site_names, get_ids = False):
         if self._read_only:
@@ -74,10 +101,10 @@ class HistoryDatabase(object):
             else:
                 return
 
-        self.db.insert_many('sites', ('name',), MySQL.make_tuple, site_names, do_update = True)
+        ids = self.resolve_ids('sites', site_names)
 
         if get_ids:
-            return self.db.select_many('sites', ('id',), 'name', site_names)
+            return ids
 
     def save_groups(self, group_names, get_ids = False):
         if self._read_only:
@@ -86,10 +113,10 @@ class HistoryDatabase(object):
             else:
                 return
 
-        self.db.insert_many('groups', ('name',), MySQL.make_tuple, group_names, do_update = True)
+        ids = self.resolve_ids('groups', group_names)
 
         if get_ids:
-            return self.db.select_many('groups', ('id',), 'name', group_names)
+            return ids
 
     def save_datasets(self, dataset_names, get_ids = False):
         if self._read_only:
@@ -98,10 +125,10 @@ class HistoryDatabase(object):
             else:
                 return
 
-        self.db.insert_many('datasets', ('name',), MySQL.make_tuple, dataset_names, do_update = True)
+        ids = self.resolve_ids('datasets', dataset_names)
 
         if get_ids:
-            return self.db.select_many('datasets', ('id',), 'name', dataset_names)
+            return ids
 
     def save_blocks(self, block_list, get_ids = False):
         """
@@ -113,34 +140,7 @@ class HistoryDatabase(object):
             else:
                 return
 
-        reuse_orig = self.db.reuse_connection
-        self.db.reuse_connection = True
-
-        datasets = set(b[0] for b in block_list)
-
-        self.save_datasets(datasets)
-
-        columns = [
-            '`dataset` varchar(512) CHARACTER SET latin1 COLLATE latin1_general_cs NOT NULL',
-            '`block` varchar(128) CHARACTER SET latin1 COLLATE latin1_general_cs NOT NULL'
-        ]
-        self.db.create_tmp_table('blocks_tmp', columns)
-        self.db.insert_many('blocks_tmp', ('dataset', 'block'), None, block_list, db = self.db.scratch_db)
-
-        sql = 'INSERT INTO `blocks` (`dataset_id`, `name`)'
-        sql += ' SELECT d.`id`, b.`block` FROM `{scratch}`.`blocks_tmp` AS b'.format(scratch = self.db.scratch_db)
-        sql += ' INNER JOIN `datasets` AS d ON d.`name` = b.`dataset`'
-        self.db.query(sql)
-
-        if get_ids:
-            sql = 'SELECT b.`id` FROM `blocks` AS b'
-            sql += ' INNER JOIN (SELECT d.`id` dataset_id, t.`block` block_name FROM `{scratch}`.`blocks_tmp` AS t'.format(scratch = self.db.scratch_db)
-            sql += ' INNER JOIN `datasets` AS d ON d.`name` = t.`dataset`) AS j ON (j.`dataset_id`, j.`block_name`) = (b.`dataset_id`, b.`name`)'
-
-            ids = self.db.query(sql)
-
-        self.db.drop_tmp_table('blocks_tmp')
-        self.db.reuse_connection = reuse_orig
+        ids = self.resolve_ids('blocks', block_list)
 
         if get_ids:
             return ids
@@ -152,7 +152,110 @@ class HistoryDatabase(object):
             else:
                 return
 
-        self.db.insert_many('files', ('name', 'size'), None, file_data, do_update = True)
+        ids = self.resolve_ids('files', file_data)
 
         if get_ids:
-            return self.db.select_many('files', ('id',), 'name', [f[0] for f in file_data])
+            return ids
+
+    def resolve_ids(self, kind, names):
+        """
+        Get the ids of the names in one of the dimension tables, inserting only the names that are
+        not in the table yet. Names are looked up in the process-wide cache first, and the rest are
+        resolved with bulk SELECT and INSERT queries. Concurrent insertions of the same names from
+        other processes are harmless because ids are always read back from the table.
+        @param kind   Table name (partitions, groups, sites, user_services, datasets, files, or blocks)
+        @param names  List of names. Elements are (name, size) for files and (dataset name, block name)
+                      for blocks.
+
+        @return  List of ids of the unique names in the order of first appearance. In read-only mode,
+                 names not in the table get id 0.
+        """
+
+        if kind == 'files':
+            # key is the name, size is only used for insertion
+            sizes = dict(names)
+            names = [f[0] for f in names]
+
+        keys = []
+        seen = set()
+        for name in names:
+            if name not in seen:
+                seen.add(name)
+                keys.append(name)
+
+        ids = self._get_cached_ids(kind, keys)
+
+        missing = [key for key in keys if key not in ids]
+        if len(missing) != 0:
+            key_columns, insert_columns = HistoryDatabase._id_tables[kind]
+
+            if kind == 'blocks':
+                dataset_names = list(set(d for d, _ in missing))
+                dataset_ids = dict(zip(dataset_names, self.resolve_ids('datasets', dataset_names)))
+                db_keys = [(dataset_ids[d], b) for d, b in missing]
+            else:
+                db_keys = missing
+
+            found = self._select_ids(kind, key_columns, db_keys)
+
+            to_insert = [key for key in db_keys if key not in found]
+            if len(to_insert) != 0 and not self._read_only:
+                if kind == 'files':
+                    mapping = lambda name: (name, sizes[name])
+                elif len(key_columns) == 1:
+                    mapping = MySQL.make_tuple
+                else:
+                    mapping = None
+
+                # ON DUPLICATE KEY UPDATE on the key itself = no-op for rows inserted concurrently
+                self.db.insert_many(kind, insert_columns, mapping, to_insert, do_update = True, update_columns = key_columns[-1:])
+
+                found.update(self._select_ids(kind, key_columns, to_insert))
+
+            resolved = {}
+            for key, db_key in zip(missing, db_keys):
+                try:
+                    resolved[key] = found[db_key]
+                except KeyError:
+                    # read-only mode
+                    pass
+
+            self._cache_ids(kind, resolved)
+            ids.update(resolved)
+
+        return [ids.get(key, 0) for key in keys]
+
+    def _select_ids(self, kind, key_columns, keys):
+        if len(key_columns) == 1:
+            return dict(self.db.select_many(kind, key_columns + ('id',), key_columns[0], keys))
+        else:
+            return dict((row[:-1], row[-1]) for row in self.db.select_many(kind, key_columns + ('id',), key_columns, keys))
+
+    def _get_id_cache(self, kind):
+        cache_key = self._id_cache_key + (kind,)
+        with HistoryDatabase._id_cache_lock:
+            try:
+                return HistoryDatabase._id_cache[cache_key]
+            except KeyError:
+                cache = HistoryDatabase._id_cache[cache_key] = collections.OrderedDict()
+                return cache
+
+    def _get_cached_ids(self, kind, keys):
+        cache = self._get_id_cache(kind)
+        ids = {}
+        with HistoryDatabase._id_cache_lock:
+            for key in keys:
+                try:
+                    # move to the end (most recently used)
+                    ids[key] = cache[key] = cache.pop(key)
+                except KeyError:
+                    pass
+
+        return ids
+
+    def _cache_ids(self, kind, resolved):
+        cache = self._get_id_cache(kind)
+        with HistoryDatabase._id_cache_lock:
+            cache.update(resolved)
+            while len(cache) > self.id_cache_size:
+                cache.popitem(last = False)
@@ -1,5 +1,3 @@
-import collections
-
 from dynamo.dataformat import Configuration
 from dynamo.enforcer.interface import EnforcerInterface
 
@@ -16,31 +14,15 @@ class EnforcedProtectionTagger(object):
         self.enforcer = EnforcerInterface(config.enforcer)
 
     def load(self, inventory):
-        partition = inventory.partitions[self.enforcer.partition_name]
+        statuses = self.enforcer.engine.evaluate(inventory)
 
         for rule_name, rule in self.enforcer.rules.iteritems():
             if not rule.protect:
                 continue
 
-            target_replicas = collections.defaultdict(set) # {dataset: set(replicas)}
-            target_sites = self.enforcer.get_destination_sites(rule_name, inventory, partition)
-
-            for site in target_sites:
-                site_partition = site.partitions[partition]
-
-                for replica in site_partition.replicas.iterkeys():
-                    for condition in rule.target_replicas:
-                        if condition.match(replica):
-                            break
-                    else:
-                        # no condition matched
-                        continue
-
-                    target_replicas[replica.dataset].add(replica)
-
-            for dataset, replicas in target_replicas.iteritems():
-                if len(replicas) <= rule.num_copies:
-                    try:
-                        dataset.attr['enforcer_protected_replicas'].update(replicas)
-                    except KeyError:
-                        dataset.attr['enforcer_protected_replicas'] = replicas
+            for dataset, replicas in statuses[rule_name].protected_replicas.iteritems():
+                try:
+                    dataset.attr['enforcer_protected_replicas'].update(replicas)
+                except KeyError:
+                    # copy - the evaluation result is cached
+                    dataset.attr['enforcer_protected_replicas'] = set(replicas)
@@ -1,6 +1,7 @@
 import logging
 import fnmatch
 import re
+import collections
 
 from dynamo.utils.interface.mysql import MySQL
 from dynamo.dataformat import Configuration, Block, ObjectError, ConfigurationError
@@ -35,6 +36,9 @@ class MySQLReplicaLock(object):
         for user_id, role_id in config.get('users', []):
             self.users.append((user_id, role_id))
 
+        # Compiled wildcard dataset patterns, reused while the set of patterns does not change
+        self._matcher = None
+
     def load(self, inventory):
         for dataset in inventory.datasets.itervalues():
             try:
@@ -48,6 +52,8 @@ class MySQLReplicaLock(object):
             query = 'SELECT `item`, `sites`, `groups` FROM `detox_locks`'
             entries = self._mysql.query(query)
 
+        # [(dataset pattern, block name, sites pattern, groups pattern)]
+        locks = []
         for item_name, sites_pattern, groups_pattern in entries:
             # wildcard not allowed in block name
             try:
@@ -55,14 +61,30 @@ class MySQLReplicaLock(object):
             except ObjectError:
                 dataset_pattern, block_name = item_name, None
 
+            locks.append((dataset_pattern, block_name, sites_pattern, groups_pattern))
+
+        # Match all wildcard dataset patterns in one pass over the datasets
+        patterns = frozenset(lock[0] for lock in locks if '*' in lock[0])
+
+        if self._matcher is None or self._matcher.patterns != patterns:
+            LOG.debug('Compiling %d lock patterns.', len(patterns))
+            self._matcher = LockPatternMatcher(patterns)
+
+        # {dataset pattern: [datasets]}
+        pattern_datasets = dict((pattern, []) for pattern in patterns)
+
+        if len(patterns) != 0:
+            for dataset in inventory.datasets.itervalues():
+                for pattern in self._matcher.match(dataset.name):
+                    pattern_datasets[pattern].append(dataset)
+
+        # {sites pattern: [sites]} and {groups pattern: [groups]}
+        pattern_sites = {}
+        pattern_groups = {}
+
+        for dataset_pattern, block_name, sites_pattern, groups_pattern in locks:
             if '*' in dataset_pattern:
-                pat_exp = re.compile(fnmatch.translate(dataset_pattern))
-                
-                datasets = []
-                for dataset in inventory.datasets.values():
-                    # this is highly inefficient but I can't think of a better way
-                    if pat_exp.match(dataset.name):
-                        datasets.append(dataset)
+                datasets = pattern_datasets[dataset_pattern]
             else:
                 try:
                     dataset = inventory.datasets[dataset_pattern]
@@ -72,31 +94,37 @@ class MySQLReplicaLock(object):
 
                 datasets = [dataset]
 
-            specified_sites = []
-            if sites_pattern:
-                if sites_pattern == '*':
-                    pass
-                elif '*' in sites_pattern:
-                    pat_exp = re.compile(fnmatch.translate(sites_pattern))
-                    specified_sites.extend(s for n, s in inventory.sites.iteritems() if pat_exp.match(n))
-                else:
-                    try:
-                        specified_sites.append(inventory.sites[sites_pattern])
-                    except KeyError:
+            try:
+                specified_sites = pattern_sites[sites_pattern]
+            except KeyError:
+                specified_sites = pattern_sites[sites_pattern] = []
+                if sites_pattern:
+                    if sites_pattern == '*':
                         pass
+                    elif '*' in sites_pattern:
+                        pat_exp = re.compile(fnmatch.translate(sites_pattern))
+                        specified_sites.extend(s for n, s in inventory.sites.iteritems() if pat_exp.match(n))
+                    else:
+                        try:
+                            specified_sites.append(inventory.sites[sites_pattern])
+                        except KeyError:
+                            pass
 
-            specified_groups = []
-            if groups_pattern:
-                if groups_pattern == '*':
-                    pass
-                elif '*' in groups_pattern:
-                    pat_exp = re.compile(fnmatch.translate(groups_pattern))
-                    specified_groups.extend(g for n, g in inventory.groups.iteritems() if pat_exp.match(n))
-                else:
-                    try:
-                        specified_groups.append(inventory.groups[groups_pattern])
-                    except KeyError:
+            try:
+                specified_groups = pattern_groups[groups_pattern]
+            except KeyError:
+                specified_groups = pattern_groups[groups_pattern] = []
+                if groups_pattern:
+                    if groups_pattern == '*':
                         pass
+                    elif '*' in groups_pattern:
+                        pat_exp = re.compile(fnmatch.translate(groups_pattern))
+                        specified_groups.extend(g for n, g in inventory.groups.iteritems() if pat_exp.match(n))
+                    else:
+                        try:
+                            specified_groups.append(inventory.groups[groups_pattern])
+                        except KeyError:
+                            pass
 
             for dataset in datasets:
                 sites = set(specified_sites)
@@ -162,4 +190,85 @@ class MySQLReplicaLock(object):
                 if blocks == dataset.blocks:
                     locked_blocks[site] = None
 
-        LOG.info('Locked %d items.', len(entries))
+        LOG.info('Locked %d items.', len(locks))
+
+
+class LockPatternMatcher(object):
+    """
+    Wildcard dataset name patterns compiled for matching a dataset name against all patterns at once. Patterns are
+    grouped by their literal prefix (the part before the first wildcard character), and the prefixes are arranged in
+    a character trie. A name walks down the trie once, and only the groups whose prefix the name starts with are
+    tested, each with a single combined regular expression.
+    """
+
+    wildcards = '*?['
+
+    def __init__(self, patterns):
+        """
+        @param patterns  Collection of fnmatch-style patterns
+        """
+
+        self.patterns = frozenset(patterns)
+
+        # trie node: [{character: node}, (prefix length, combined regex, [(pattern, regex)]) or None]
+        self._root = [{}, None]
+
+        by_prefix = collections.defaultdict(list)
+        for pattern in self.patterns:
+            by_prefix[LockPatternMatcher.literal_prefix(pattern)].append(pattern)
+
+        for prefix, group_patterns in by_prefix.iteritems():
+            node = self._root
+            for char in prefix:
+                try:
+                    node = node[0][char]
+                except KeyError:
+                    node[0][char] = [{}, None]
+                    node = node[0][char]
+
+            # regexes match the part of the name after the prefix
+            expressions = [fnmatch.translate(pattern[len(prefix):]) for pattern in group_patterns]
+            combined = re.compile('|'.join('(?:%s)' % exp for exp in expressions))
+            regexes = [(pattern, re.compile(exp)) for pattern, exp in zip(group_patterns, expressions)]
+
+            node[1] = (len(prefix), combined, regexes)
+
+    @staticmethod
+    def literal_prefix(pattern):
+        for pos, char in enumerate(pattern):
+            if char in LockPatternMatcher.wildcards:
+                return pattern[:pos]
+
+        return pattern
+
+    def match(self, name):
+        """
+        @param name  Dataset name
+        @return List of patterns matching the name.
+        """
+
+        matched = []
+
+        node = self._root
+        pos = 0
+        while True:
+            group = node[1]
+            if group is not None:
+                prefix_length, combined, regexes = group
+                if combined.match(name, prefix_length):
+                    if len(regexes) == 1:
+                        matched.append(regexes[0][0])
+                    else:
+                        matched.extend(pattern for pattern, regex in regexes if regex.match(name, prefix_length))
+
+            if pos == len(name):
+                break
+
+            try:
+                node = node[0][name[pos]]
+            except KeyError:
+                break
+
+            pos += 1
+
+        return matched
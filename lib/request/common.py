@@ -56,6 +56,53 @@ class RequestManager(object):
         if not self._read_only:
             self.registry.db.unlock_tables()
 
+    def poll_requests(self, since, request_id = None, statuses = None, users = None, items = None, sites = None):
+        """
+        Find the requests created or updated since a previous poll. Every creation or update of a request sets its
+        change sequence number in history to a new value of a monotonically increasing counter. The counter is
+        incremented before the rows are written, so the requests with the largest sequence number read here may not
+        be complete yet. Therefore the requests with change_seq >= since are returned, and the returned sequence number
+        is the largest one actually read. The next poll with this number returns those requests again; callers should
+        key the results by request id.
+        @param since  Sequence number returned by the previous poll (0 for the first poll).
+        @return (sequence number for the next poll, {request id: request}, [ids of changed requests that do not
+                satisfy the constraints any more])
+        """
+
+        changes = self._get_changes(since)
+        if len(changes) == 0:
+            return since, {}, []
+
+        sequence = max(change_seq for _, change_seq in changes)
+        request_ids = [rid for rid, _ in changes]
+
+        requests = self.get_requests(request_id = request_id, statuses = statuses, users = users, items = items, sites = sites, request_ids = request_ids)
+        removed = [rid for rid in request_ids if rid not in requests]
+
+        return sequence, requests, removed
+
+    def _next_change_seq(self):
+        """
+        Increment the change sequence. Writers must hold the lock (see lock()) from this call until the last write of
+        the change, so that a poll reading a sequence number can only miss rows of that same number.
+        @return New value of the change sequence.
+        """
+
+        sql = 'INSERT INTO `request_change_sequences` (`optype`, `value`) VALUES (%s, LAST_INSERT_ID(1))'
+        sql += ' ON DUPLICATE KEY UPDATE `value` = LAST_INSERT_ID(`value` + 1)'
+        self.history.db.query(sql, self.optype)
+
+        return self.history.db.last_insert_id
+
+    def _get_changes(self, since):
+        """
+        @param since  Change sequence number
+        @return List of (id, change_seq) of requests created or updated at or after since.
+        """
+
+        sql = 'SELECT `id`, `change_seq` FROM `{op}_requests` WHERE `change_seq` >= %s'.format(op = self.optype)
+        return self.history.db.query(sql, since)
+
     def _save_items(self, items):
         """
         Save the items into history.
@@ -198,12 +245,15 @@ class RequestManager(object):
 
         return tmp_table_name
 
-    def _make_registry_constraints(self, request_id, statuses, users, items, sites):
+    def _make_registry_constraints(self, request_id, statuses, users, items, sites, request_ids = None):
         constraints = []
 
         if request_id is not None:
             constraints.append('r.`id` = %d' % request_id)
 
+        if request_ids is not None:
+            constraints.append('r.`id` IN (%s)' % ','.join('%d' % rid for rid in request_ids))
+
         if statuses is not None:
             constraints.append('r.`status` IN ' + MySQL.stringify_sequence(statuses))
 
@@ -219,7 +269,7 @@ class RequestManager(object):
         else:
             return ''
 
-    def _make_history_constraints(self, request_id, statuses, users, items, sites):
+    def _make_history_constraints(self, request_id, statuses, users, items, sites, request_ids = None):
         if users is not None:
             history_user_ids = self.history.db.select_many('users', 'id', 'name', users)
         else:
@@ -241,6 +291,9 @@ class RequestManager(object):
         if request_id is not None:
             constraints.append('r.`id` = %d' % request_id)
 
+        if request_ids is not None:
+            constraints.append('r.`id` IN (%s)' % ','.join('%d' % rid for rid in request_ids))
+
         if statuses is not None:
             constraints.append('r.`status` IN ' + MySQL.stringify_sequence(statuses))
 
@@ -1,5 +1,6 @@
 import time
 import logging
+import collections
 
 from dynamo.request.common import RequestManager
 from dynamo.utils.interface.mysql import MySQL
@@ -23,14 +24,18 @@ class CopyRequestManager(RequestManager):
         if not self._read_only:
             self.registry.db.lock_tables(write = tables)
 
-    def get_requests(self, request_id = None, statuses = None, users = None, items = None, sites = None):
+    def get_requests(self, request_id = None, statuses = None, users = None, items = None, sites = None, request_ids = None):
+        """
+        @param request_ids  If not None, limit to the requests with ids in the (non-empty) list (see poll_requests).
+        """
+
         all_requests = {}
 
         sql = 'SELECT r.`id`, r.`group`, r.`num_copies`, 0+r.`status`, UNIX_TIMESTAMP(r.`first_request_time`), UNIX_TIMESTAMP(r.`last_request_time`),'
         sql += ' r.`request_count`, r.`user`, r.`dn`, a.`item`, a.`site`, 0+a.`status`, UNIX_TIMESTAMP(a.`updated`)'
         sql += ' FROM `copy_requests` AS r'
         sql += ' LEFT JOIN `active_copies` AS a ON a.`request_id` = r.`id`'
-        sql += self._make_registry_constraints(request_id, statuses, users, items, sites)
+        sql += self._make_registry_constraints(request_id, statuses, users, items, sites, request_ids)
         sql += ' ORDER BY r.`id`'
 
         _rid = 0
@@ -72,7 +77,7 @@ class CopyRequestManager(RequestManager):
         sql += ' FROM `copy_requests` AS r'
         sql += ' INNER JOIN `groups` AS g ON g.`id` = r.`group_id`'
         sql += ' INNER JOIN `users` AS u ON u.`id` = r.`user_id`'
-        sql += self._make_history_constraints(request_id, statuses, users, items, sites)
+        sql += self._make_history_constraints(request_id, statuses, users, items, sites, request_ids)
         sql += ' ORDER BY r.`id`'
 
         for rid, group, n, status, request_time, reason, user, dn in self.history.db.xquery(sql):
@@ -131,9 +136,9 @@ class CopyRequestManager(RequestManager):
         history_group_ids = self.history.save_groups([group], get_ids = True)
         history_dataset_ids, history_block_ids = self._save_items(items)
 
-        sql = 'INSERT INTO `copy_requests` (`id`, `group_id`, `num_copies`, `user_id`, `request_time`)'
-        sql += ' VALUES (%s, %s, %s, %s, FROM_UNIXTIME(%s))'
-        self.history.db.query(sql, request_id, history_group_ids[0], ncopies, history_user_ids[0], now)
+        sql = 'INSERT INTO `copy_requests` (`id`, `group_id`, `num_copies`, `user_id`, `request_time`, `change_seq`)'
+        sql += ' VALUES (%s, %s, %s, %s, FROM_UNIXTIME(%s), %s)'
+        self.history.db.query(sql, request_id, history_group_ids[0], ncopies, history_user_ids[0], now, self._next_change_seq())
 
         mapping = lambda sid: (request_id, sid)
         self.history.db.insert_many('copy_request_sites', ('request_id', 'site_id'), mapping, history_site_ids)
@@ -145,33 +150,85 @@ class CopyRequestManager(RequestManager):
         return self.get_requests(request_id = request_id)[request_id]
 
     def update_request(self, request):
-        if self._read_only:
-            return
+        self.update_requests([request])
 
-        sql = 'UPDATE `copy_requests` SET `status` = %s, `group_id` = (SELECT `id` FROM `groups` WHERE `name` = %s), `num_copies` = %s, `rejection_reason` = %s WHERE `id` = %s'
-        self.history.db.query(sql, request.status, request.group, request.n, request.reject_reason, request.request_id)
+    def update_requests(self, requests):
+        """
+        Write the status and actions of multiple requests with a fixed set of bulk statements: one UPDATE per
+        distinct set of column values in history, one UPDATE through a temporary table and one INSERT for the active
+        copies in registry, and one DELETE for the requests in terminal states.
+        @param requests  List of CopyRequests. If a request appears multiple times, the last instance is used.
+        """
 
-        if request.status in (Request.ST_NEW, Request.ST_ACTIVATED):
-            sql = 'UPDATE `copy_requests` SET `status` = %s, `group` = %s, `num_copies` = %s, `last_request_time` = FROM_UNIXTIME(%s), `request_count` = %s WHERE `id` = %s'
-            self.registry.db.query(sql, request.status, request.group, request.n, request.last_request, request.request_count, request.request_id)
+        if self._read_only:
+            return
 
-            if request.actions is not None:
-                # insert or update active copies
-                fields = ('request_id', 'item', 'site', 'status', 'created', 'updated')
-                update_columns = ('status', 'updated')
-                for a in request.actions:
-                    now = time.strftime('%Y-%m-%d %H:%M:%S') # current local time
-                    values = (request.request_id, a.item, a.site, a.status, now, now)
-                    self.registry.db.insert_update('active_copies', fields, *values, update_columns = update_columns)
+        requests = dict((request.request_id, request) for request in requests).values()
+        if len(requests) == 0:
+            return
 
-        else:
-            # terminal state
+        live_requests = [r for r in requests if r.status in (Request.ST_NEW, Request.ST_ACTIVATED)]
+        terminal_ids = [r.request_id for r in requests if r.status not in (Request.ST_NEW, Request.ST_ACTIVATED)]
+
+        if len(live_requests) != 0:
+            columns = [
+                '`id` int(10) unsigned NOT NULL',
+                '`status` tinyint(1) unsigned NOT NULL',
+                '`group` varchar(32) NOT NULL',
+                '`num_copies` tinyint(1) unsigned NOT NULL',
+                '`last_request_time` int(10) unsigned DEFAULT NULL',
+                '`request_count` int(10) unsigned NOT NULL',
+                'PRIMARY KEY (`id`)'
+            ]
+            self.registry.db.create_tmp_table('requests_tmp', columns)
+
+            fields = ('id', 'status', 'group', 'num_copies', 'last_request_time', 'request_count')
+            mapping = lambda r: (r.request_id, r.status, r.group, r.n, r.last_request, r.request_count)
+            self.registry.db.insert_many('requests_tmp', fields, mapping, live_requests, do_update = False, db = self.registry.db.scratch_db)
+
+            # numeric enum values are indices
+            # last_request_time is converted by the server as in the single-row UPDATE (session time zone, NULL stays NULL)
+            sql = 'UPDATE `copy_requests` AS r INNER JOIN `{db}`.`requests_tmp` AS t ON t.`id` = r.`id`'
+            sql += ' SET r.`status` = t.`status`, r.`group` = t.`group`, r.`num_copies` = t.`num_copies`,'
+            sql += ' r.`last_request_time` = FROM_UNIXTIME(t.`last_request_time`), r.`request_count` = t.`request_count`'
+            self.registry.db.query(sql.format(db = self.registry.db.scratch_db))
+
+            self.registry.db.drop_tmp_table('requests_tmp')
+
+            # insert or update active copies
+            now = time.strftime('%Y-%m-%d %H:%M:%S') # current local time
+            actions = []
+            for request in live_requests:
+                if request.actions is not None:
+                    actions.extend((request.request_id, a.item, a.site, a.status, now, now) for a in request.actions)
+
+            fields = ('request_id', 'item', 'site', 'status', 'created', 'updated')
+            self.registry.db.insert_many('active_copies', fields, None, actions, update_columns = ('status', 'updated'))
+
+        if len(terminal_ids) != 0:
             sql = 'DELETE FROM r, a, i, s USING `copy_requests` AS r'
             sql += ' LEFT JOIN `active_copies` AS a ON a.`request_id` = r.`id`'
             sql += ' LEFT JOIN `copy_request_items` AS i ON i.`request_id` = r.`id`'
             sql += ' LEFT JOIN `copy_request_sites` AS s ON s.`request_id` = r.`id`'
-            sql += ' WHERE r.`id` = %s'
-            self.registry.db.query(sql, request.request_id)        
+            sql += ' WHERE r.`id` IN (%s)' % ','.join('%d' % rid for rid in terminal_ids)
+            self.registry.db.query(sql)
+
+        # history last: pollers read the change sequence number from history, and the registry rows are final by then
+        # all requests in one call share the change sequence number
+        change_seq = self._next_change_seq()
+
+        # history: requests sharing the column values are updated together
+        group_ids = dict(self.history.db.select_many('groups', ('name', 'id'), 'name', set(r.group for r in requests)))
+
+        history_updates = collections.defaultdict(list)
+        for request in requests:
+            key = (request.status, group_ids.get(request.group), request.n, request.reject_reason)
+            history_updates[key].append(request.request_id)
+
+        for (status, group_id, n, reject_reason), request_ids in history_updates.iteritems():
+            sql = 'UPDATE `copy_requests` SET `status` = %s, `group_id` = %s, `num_copies` = %s, `rejection_reason` = %s, `change_seq` = %s'
+            sql += ' WHERE `id` IN (%s)' % ','.join('%d' % rid for rid in request_ids)
+            self.history.db.query(sql, status, group_id, n, reject_reason, change_seq)
 
     def collect_updates(self, inventory):
         """
@@ -181,6 +238,8 @@ class CopyRequestManager(RequestManager):
         now = int(time.time())
 
         incomplete_replicas = ([], [])
+        # requests with changes, written together at the end
+        updated_requests = []
 
         self.lock()
 
@@ -191,7 +250,7 @@ class CopyRequestManager(RequestManager):
                 if request.actions is None:
                     LOG.error('No active copies for activated request %d', request.request_id)
                     request.status = Request.ST_COMPLETED
-                    self.update_request(request)
+                    updated_requests.append(request)
 
                     continue
 
@@ -201,7 +260,7 @@ class CopyRequestManager(RequestManager):
                     LOG.error('Unknown group %s', request.group)
                     request.status = Request.REJECTED
                     request.reject_reason = 'Unknown group %s' % request.group
-                    self.update_request(request)
+                    updated_requests.append(request)
 
                     continue
 
@@ -308,7 +367,9 @@ class CopyRequestManager(RequestManager):
                     updated = True
 
                 if updated:
-                    self.update_request(request)
+                    updated_requests.append(request)
+
+            self.update_requests(updated_requests)
 
         finally:
             self.unlock()
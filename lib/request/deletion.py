@@ -22,14 +22,18 @@ class DeletionRequestManager(RequestManager):
         if not self._read_only:
             self.registry.db.lock_tables(write = tables)
 
-    def get_requests(self, request_id = None, statuses = None, users = None, items = None, sites = None):
+    def get_requests(self, request_id = None, statuses = None, users = None, items = None, sites = None, request_ids = None):
+        """
+        @param request_ids  If not None, limit to the requests with ids in the (non-empty) list (see poll_requests).
+        """
+
         all_requests = {}
 
         sql = 'SELECT r.`id`, 0+r.`status`, UNIX_TIMESTAMP(r.`request_time`),'
         sql += ' r.`user`, r.`dn`, a.`item`, a.`site`, 0+a.`status`, UNIX_TIMESTAMP(a.`updated`)'
         sql += ' FROM `deletion_requests` AS r'
         sql += ' LEFT JOIN `active_deletions` AS a ON a.`request_id` = r.`id`'
-        sql += self._make_registry_constraints(request_id, statuses, users, items, sites)
+        sql += self._make_registry_constraints(request_id, statuses, users, items, sites, request_ids)
         sql += ' ORDER BY r.`id`'
 
         _rid = 0
@@ -70,7 +74,7 @@ class DeletionRequestManager(RequestManager):
         sql += ' r.`rejection_reason`, u.`name`, u.`dn`'
         sql += ' FROM `deletion_requests` AS r'
         sql += ' INNER JOIN `users` AS u ON u.`id` = r.`user_id`'
-        sql += self._make_history_constraints(request_id, statuses, users, items, sites)
+        sql += self._make_history_constraints(request_id, statuses, users, items, sites, request_ids)
         sql += ' ORDER BY r.`id`'
 
         for rid, status, request_time, reason, user, dn in self.history.db.xquery(sql):
@@ -128,10 +132,10 @@ class DeletionRequestManager(RequestManager):
         history_site_ids = self.history.save_sites(sites, get_ids = True)
         history_dataset_ids, history_block_ids = self._save_items(items)
 
-        sql = 'INSERT INTO `deletion_requests` (`id`, `user_id`, `request_time`)'
-        sql += ' SELECT %s, u.`id`, FROM_UNIXTIME(%s) FROM `groups` AS g, `users` AS u'
+        sql = 'INSERT INTO `deletion_requests` (`id`, `user_id`, `request_time`, `change_seq`)'
+        sql += ' SELECT %s, u.`id`, FROM_UNIXTIME(%s), %s FROM `groups` AS g, `users` AS u'
         sql += ' WHERE u.`dn` = %s'
-        self.history.db.query(sql, request_id, now, caller.dn)
+        self.history.db.query(sql, request_id, now, self._next_change_seq(), caller.dn)
 
         mapping = lambda sid: (request_id, sid)
         self.history.db.insert_many('deletion_request_sites', ('request_id', 'site_id'), mapping, history_site_ids)
@@ -146,9 +150,6 @@ class DeletionRequestManager(RequestManager):
         if self._read_only:
             return
 
-        sql = 'UPDATE `deletion_requests` SET `status` = %s, `rejection_reason` = %s WHERE `id` = %s'
-        self.history.db.query(sql, request.status, request.reject_reason, request.request_id)
-
         if request.status in (Request.ST_NEW, Request.ST_ACTIVATED):
             sql = 'UPDATE `deletion_requests` SET `status` = %s, `request_time` = FROM_UNIXTIME(%s) WHERE `id` = %s'
             self.registry.db.query(sql, request.status, request.request_time, request.request_id)
@@ -171,6 +172,10 @@ class DeletionRequestManager(RequestManager):
             sql += ' WHERE r.`id` = %s'
             self.registry.db.query(sql, request.request_id)
 
+        # history last: pollers read the change sequence number from history
+        sql = 'UPDATE `deletion_requests` SET `status` = %s, `rejection_reason` = %s, `change_seq` = %s WHERE `id` = %s'
+        self.history.db.query(sql, request.status, request.reject_reason, self._next_change_seq(), request.request_id)
+
     def collect_updates(self, inventory):
         """
         Check active requests against the inventory state and set the status flags accordingly.
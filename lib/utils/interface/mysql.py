@@ -3,7 +3,10 @@ import sys
 import logging
 import time
 import re
+import threading
 import multiprocessing
+import tempfile
+import shutil
 from ConfigParser import ConfigParser
 
 import MySQLdb
@@ -29,17 +32,262 @@ from dynamo.dataformat import Configuration
 
 LOG = logging.getLogger(__name__)
 
+# Connections inherited from the parent process. They must not be used or closed (closing sends
+# a quit message through the socket shared with the parent), so references are kept here.
+_inherited_connections = []
+
+class ConnectionPool(object):
+    """
+    Process-wide pool of idle MySQLdb connections sharing the same connection parameters.
+    Connections idle for longer than validate_after seconds are pinged before being handed out,
+    and those idle for longer than idle_timeout seconds are closed. Reused connections are reset
+    (open transaction rolled back) on checkout; connections whose session state was changed are
+    not returned to the pool (see MySQL._session_statement). Checked-out connections are tracked
+    individually, and connections unknown to the pool are never pooled or closed. After a fork,
+    connections of the parent process are abandoned and the pool starts empty.
+    """
+
+    # {parameter key: ConnectionPool}
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    # Parameters (set through MySQL.set_default: pool_idle_timeout, pool_validate_after, pool_max_idle)
+    idle_timeout = 300.
+    validate_after = 30.
+    max_idle = 16
+
+    @staticmethod
+    def get(parameters):
+        key = tuple(sorted(parameters.items()))
+
+        with ConnectionPool._pools_lock:
+            try:
+                return ConnectionPool._pools[key]
+            except KeyError:
+                pool = ConnectionPool._pools[key] = ConnectionPool(parameters)
+                return pool
+
+    @staticmethod
+    def all_stats():
+        """
+        @return  [(host, user, db, stats)] for all pools of the process
+        """
+
+        with ConnectionPool._pools_lock:
+            pools = ConnectionPool._pools.values()
+
+        return [(p._parameters.get('host', ''), p._parameters.get('user', ''), p._parameters.get('db', ''), p.stats()) for p in pools]
+
+    def __init__(self, parameters):
+        self._parameters = dict(parameters)
+
+        # [(connection, time of checkin)], most recent at the end
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+        # {id(connection): time of checkout}
+        self._checked_out = {}
+
+        self._counters = dict.fromkeys(('created', 'reused', 'validated', 'dropped', 'evicted', 'closed', 'max_in_use'), 0)
+
+    def checkout(self):
+        """
+        @return  A validated connection
+        """
+
+        self._check_fork()
+
+        while True:
+            with self._lock:
+                try:
+                    connection, last_used = self._idle.pop()
+                except IndexError:
+                    break
+
+            idle_time = time.time() - last_used
+
+            if idle_time > ConnectionPool.idle_timeout:
+                self._close(connection, 'evicted')
+                continue
+
+            if idle_time > ConnectionPool.validate_after:
+                try:
+                    connection.ping()
+                except MySQLdb.Error:
+                    self._close(connection, 'dropped')
+                    continue
+
+                self._count('validated')
+
+            try:
+                # reset: end any transaction left open by the previous user
+                connection.rollback()
+            except MySQLdb.Error:
+                self._close(connection, 'dropped')
+                continue
+
+            self._count('reused', connection)
+            return connection
+
+        connection = MySQLdb.connect(**self._parameters)
+        self._count('created', connection)
+
+        return connection
+
+    def checkin(self, connection):
+        """
+        Return a connection without session state (table locks, temporary tables, or session variables) to the pool.
+        """
+
+        if not self._release(connection):
+            return
+
+        now = time.time()
+        to_close = []
+
+        with self._lock:
+            # oldest ones are at the beginning
+            while len(self._idle) != 0 and now - self._idle[0][1] > ConnectionPool.idle_timeout:
+                to_close.append(self._idle.pop(0)[0])
+
+            if len(self._idle) < ConnectionPool.max_idle:
+                self._idle.append((connection, now))
+            else:
+                to_close.append(connection)
+
+        for conn in to_close:
+            self._close(conn, 'evicted')
+
+    def discard(self, connection):
+        """
+        Close a checked-out connection that should not be reused.
+        """
+
+        if not self._release(connection):
+            return
+
+        self._close(connection, 'closed')
+
+    def stats(self):
+        now = time.time()
+
+        with self._lock:
+            stats = dict(self._counters)
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = len(self._checked_out)
+            # seconds for which the oldest checked-out connection has been held
+            stats['max_held'] = max([now - t for t in self._checked_out.itervalues()] + [0.])
+
+        return stats
+
+    def _release(self, connection):
+        """
+        Remove a connection from the checked-out list.
+        @return False if the connection was not checked out from this pool in this process. Such connections
+                (e.g. of the parent process) are set aside without closing.
+        """
+
+        self._check_fork()
+
+        with self._lock:
+            known = self._checked_out.pop(id(connection), None) is not None
+
+        if not known:
+            _inherited_connections.append(connection)
+
+        return known
+
+    def _count(self, key, checked_out = None):
+        with self._lock:
+            self._counters[key] += 1
+            if checked_out is not None:
+                self._checked_out[id(checked_out)] = time.time()
+                self._counters['max_in_use'] = max(self._counters['max_in_use'], len(self._checked_out))
+
+    def _close(self, connection, reason):
+        self._count(reason)
+        try:
+            connection.close()
+        except MySQLdb.Error:
+            pass
+
+    def _check_fork(self):
+        """
+        Reset the pool if we are in a forked child.
+        @return True if a fork happened since the pool was last used.
+        """
+
+        if self._pid == os.getpid():
+            return False
+
+        with self._lock:
+            if self._pid != os.getpid():
+                _inherited_connections.extend(c for c, _ in self._idle)
+                self._idle = []
+                self._checked_out = {}
+                self._pid = os.getpid()
+                self._counters = dict.fromkeys(self._counters.iterkeys(), 0)
+
+        return True
+
+
+class ConnectionState(object):
+    """
+    Connection and session bookkeeping of a MySQL object, or of one thread of a MySQL object
+    when connection_per_thread is set.
+    """
+
+    def __init__(self, lock, pool = None):
+        self.connection = None
+        # pid of the process that opened the connection
+        self.pid = 0
+        self.lock = lock
+        # see lock_tables
+        self.locked_tables = []
+        # names of temporary tables created through create_tmp_table
+        self.tmp_tables = set()
+        self.last_insert_id = 0
+        # while nonzero, the connection is kept even if reuse_connection is False
+        self.pinned = 0
+        # set when a statement changed the session (variables, transaction); the connection is then not pooled
+        self.session_modified = False
+
+        # pool the connection was checked out from; the connection is returned when the state is deleted
+        # (e.g. when the thread ends for per-thread states)
+        self.pool = pool
+
+    def __del__(self):
+        if self.pool is None or self.connection is None:
+            return
+
+        try:
+            if len(self.locked_tables) == 0 and len(self.tmp_tables) == 0 and not self.session_modified:
+                self.pool.checkin(self.connection)
+            else:
+                self.pool.discard(self.connection)
+        except:
+            pass
+
+
 class MySQL(object):
     """Generic thread-safe MySQL interface (for an interface)."""
 
     _default_config = Configuration()
     _default_parameters = {'': {}} # {user: config}
 
+    # Statements that leave state in the session. A connection that executed one is not returned to the pool.
+    _session_statement = re.compile(r'\s*(?:SET|USE|BEGIN|START\s+TRANSACTION|CREATE\s+TEMPORARY|LOCK)\b', re.IGNORECASE)
+
     @staticmethod
     def set_default(config):
         MySQL._default_config = Configuration(config)
         MySQL._default_config.pop('params')
 
+        ConnectionPool.idle_timeout = MySQL._default_config.get('pool_idle_timeout', ConnectionPool.idle_timeout)
+        ConnectionPool.validate_after = MySQL._default_config.get('pool_validate_after', ConnectionPool.validate_after)
+        ConnectionPool.max_idle = MySQL._default_config.get('pool_max_idle', ConnectionPool.max_idle)
+
         for user, params in config.params.items():
             MySQL._default_parameters[user] = dict(params)
             MySQL._default_parameters[user]['user'] = user
@@ -108,17 +356,28 @@ class MySQL(object):
         if 'db' in config:
             self._connection_parameters['db'] = config['db']
 
-        self._connection = None
-
-        # Avoid interference in case the module is used from multiple threads
-        self._connection_lock = multiprocessing.RLock()
-
-        # MySQL tables can be locked by multiple statements but are unlocked with one.
-        # In nested functions with each one locking different tables, we need to call UNLOCK TABLES
-        # only after the outermost function asks for it.
-        self._locked_tables = []
+        # Allow LOAD DATA LOCAL INFILE on the connections of this object (needed by insert_many with bulk_load = True).
+        # Off unless requested: with local_infile, the server can ask the client to send any file readable by the process.
+        self.local_infile = config.get('local_infile', MySQL._default_config.get('local_infile', False))
+        if self.local_infile:
+            self._connection_parameters['local_infile'] = 1
+
+        # Connections are taken from the process-wide pool of connections with the same parameters
+        self._pool = None
+
+        # If True, each thread uses its own connection (taken from the pool and returned when the thread ends)
+        # and threads do not block each other. Table locks and temporary tables are then per thread.
+        # If False, all threads share one connection and are serialized by the connection lock.
+        if config.get('connection_per_thread', MySQL._default_config.get('connection_per_thread', False)):
+            self._thread_states = threading.local()
+            self._shared_state = None
+        else:
+            self._thread_states = None
+            # Avoid interference in case the module is used from multiple threads
+            self._shared_state = ConnectionState(multiprocessing.RLock())
         
         # Use with care! If False, table locks and temporary tables cannot be used
+        # Connections are returned to the pool after each query.
         self.reuse_connection = config.get('reuse_connection', MySQL._default_config.get('reuse_connection', True))
 
         # Default 1M characters
@@ -127,16 +386,92 @@ class MySQL(object):
         # Default database for CREATE TEMPORARY TABLE
         self.scratch_db = config.get('scratch_db', MySQL._default_config.get('scratch_db', ''))
 
+        # Size of a single LOAD DATA batch in insert_many(bulk_load = True), in units of the server max_allowed_packet
+        self.bulk_load_batch_factor = config.get('bulk_load_batch_factor', MySQL._default_config.get('bulk_load_batch_factor', 16))
+
+        # Server variables queried once (max_allowed_packet, local_infile)
+        self._server_variables = {}
+
+    def _state(self):
+        if self._thread_states is None:
+            return self._shared_state
+
+        try:
+            return self._thread_states.state
+        except AttributeError:
+            state = self._thread_states.state = ConnectionState(threading.RLock())
+            return state
+
+    @property
+    def _connection(self):
+        return self._state().connection
+
+    @_connection.setter
+    def _connection(self, connection):
+        self._state().connection = connection
+
+    @property
+    def _connection_lock(self):
+        return self._state().lock
+
+    @property
+    def _locked_tables(self):
+        # MySQL tables can be locked by multiple statements but are unlocked with one.
+        # In nested functions with each one locking different tables, we need to call UNLOCK TABLES
+        # only after the outermost function asks for it.
+        return self._state().locked_tables
+
+    @property
+    def last_insert_id(self):
         # Row id of the last insertion. Will be nonzero if the table has an auto-increment primary key.
-        # **NOTE** While core execution of query() and xquery() are locked and thread-safe, last_insert_id is not.
-        # Use insert_and_get_id() in a threaded environment.
-        self.last_insert_id = 0
+        # **NOTE** While core execution of query() and xquery() are locked and thread-safe, last_insert_id is not
+        # unless connection_per_thread is set. Use insert_and_get_id() in a threaded environment.
+        return self._state().last_insert_id
+
+    @last_insert_id.setter
+    def last_insert_id(self, value):
+        self._state().last_insert_id = value
+
+    def pool_stats(self):
+        """
+        @return  Statistics of the connection pool used by this object:
+                 {created, reused, validated, dropped, evicted, closed, in_use, max_in_use, max_held, idle}
+        """
+        return self._get_pool().stats()
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ConnectionPool.get(self._connection_parameters)
+
+        return self._pool
+
+    def _release_connection(self, discard = False):
+        """
+        Give the connection back to the pool, or close it if discard is True or the session has state.
+        """
+
+        state = self._state()
+        if state.connection is None:
+            return
+
+        if state.pid != os.getpid():
+            _inherited_connections.append(state.connection)
+        elif discard or len(state.locked_tables) != 0 or len(state.tmp_tables) != 0 or state.session_modified:
+            state.pool.discard(state.connection)
+        else:
+            state.pool.checkin(state.connection)
+
+        state.connection = None
+        state.pool = None
+        state.tmp_tables.clear()
+        state.session_modified = False
 
     def db_name(self):
         return self._connection_parameters['db']
 
     def use_db(self, db):
         self.close()
+        self._pool = None
         if db is None:
             try:
                 self._connection_parameters.pop('db')
@@ -149,9 +484,7 @@ class MySQL(object):
         return self.query('SELECT @@hostname')[0]
 
     def close(self):
-        if self._connection is not None:
-            self._connection.close()
-            self._connection = None
+        self._release_connection(discard = True)
 
     def config(self):
         conf = Configuration()
@@ -172,22 +505,35 @@ class MySQL(object):
         conf['reuse_connection'] = self.reuse_connection
         conf['max_query_len'] = self.max_query_len
         conf['scratch_db'] = self.scratch_db
+        conf['local_infile'] = self.local_infile
 
         return conf
 
     def get_cursor(self, cursor_cls = MySQLdb.connections.Connection.default_cursor):
-        if self._connection is None:
-            self._connection = MySQLdb.connect(**self._connection_parameters)
+        state = self._state()
+
+        if state.connection is not None and state.pid != os.getpid():
+            # we are in a forked child
+            _inherited_connections.append(state.connection)
+            state.connection = None
+            state.pool = None
+            del state.locked_tables[:]
+            state.tmp_tables.clear()
+            state.session_modified = False
+
+        if state.connection is None:
+            state.pool = self._get_pool()
+            state.connection = state.pool.checkout()
+            state.pid = os.getpid()
 
-        return self._connection.cursor(cursor_cls)
+        return state.connection.cursor(cursor_cls)
 
     def close_cursor(self, cursor):
         if cursor is not None:
             cursor.close()
     
-        if not self.reuse_connection and self._connection is not None:
-            self._connection.close()
-            self._connection = None
+        if not self.reuse_connection and self._state().pinned == 0:
+            self._release_connection()
 
     def query(self, sql, *args, **kwd):
         """
@@ -217,6 +563,9 @@ class MySQL(object):
     
             self.last_insert_id = 0
 
+            if MySQL._session_statement.match(sql):
+                self._state().session_modified = True
+
             if LOG.getEffectiveLevel() == logging.DEBUG:
                 if len(args) == 0:
                     LOG.debug(sql)
@@ -242,7 +591,7 @@ class MySQL(object):
 
                         # reconnect to server
                         cursor.close()
-                        self._connection = None
+                        self._release_connection(discard = True)
                         cursor = self.get_cursor()
         
                 else: # 10 failures
@@ -350,6 +699,9 @@ class MySQL(object):
     
             self.last_insert_id = 0
 
+            if MySQL._session_statement.match(sql):
+                self._state().session_modified = True
+
             if LOG.getEffectiveLevel() == logging.DEBUG:
                 if len(args) == 0:
                     LOG.debug(sql)
@@ -366,7 +718,7 @@ class MySQL(object):
                         last_except = sys.exc_info()[1]
                         # reconnect to server
                         cursor.close()
-                        self._connection = None
+                        self._release_connection(discard = True)
                         cursor = self.get_cursor(MySQLdb.cursors.SSCursor)
         
                 else: # 10 failures
@@ -470,9 +822,11 @@ class MySQL(object):
 
         self.execute_many(sqlbase, key, pool, additional_conditions)
 
-    def insert_many(self, table, fields, mapping, objects, do_update = True, db = '', update_columns = None):
+    def insert_many(self, table, fields, mapping, objects, do_update = True, db = '', update_columns = None, bulk_load = False, pipelined = False):
         """
         INSERT INTO table (fields) VALUES (mapping(objects)).
+        With bulk_load = True, rows are instead streamed to the server with LOAD DATA LOCAL INFILE, which is considerably
+        faster for large numbers of rows. Duplicate rows are then ignored when do_update is False (instead of raising an error).
         @param table          Table name.
         @param fields         Name of columns. If None, perform INSERT INTO table VALUES
         @param mapping        Typically a lambda that takes an element in the objects list and return a tuple corresponding to a row to insert.
@@ -480,6 +834,10 @@ class MySQL(object):
         @param do_update      If True, use ON DUPLICATE KEY UPDATE which can be slower than a straight INSERT.
         @param db             DB name.
         @param update_columns Tuple of column names to update when do_update is True. If None, all columns are updated.
+        @param bulk_load      If True, use LOAD DATA LOCAL INFILE. Falls back to INSERT if the object was not created with
+                              local_infile = True or the server does not allow it.
+        @param pipelined      With bulk_load, stream the rows through a named pipe while the server is reading them instead
+                              of writing each batch to a temporary file first.
 
         @return  total number of inserted rows.
         """
@@ -502,6 +860,14 @@ class MySQL(object):
         if db == '':
             db = self.db_name()
 
+        if bulk_load:
+            if not self.local_infile:
+                LOG.warning('local_infile is not set for this connection. Using INSERT for bulk load of %s.%s.', db, table)
+            elif self._get_server_variable('local_infile') in (1, '1', 'ON'):
+                return self._load_many(table, fields, mapping, obj, itr, do_update, db, update_columns, pipelined)
+            else:
+                LOG.warning('Server does not allow LOAD DATA LOCAL INFILE. Using INSERT for bulk load of %s.%s.', db, table)
+
         sqlbase = 'INSERT INTO `%s`.`%s`' % (db, table)
         if fields:
             sqlbase += ' (%s)' % ','.join('`%s`' % f for f in fields)
@@ -520,6 +886,11 @@ class MySQL(object):
         # template = (%s, %s, ...)
         template = '(' + ','.join(['%s'] * ncol) + ')'
 
+        max_query_len = self.max_query_len
+        if bulk_load:
+            # (fallback) adapt the batch size to the server limit
+            max_query_len = self._get_server_variable('max_allowed_packet') - len(sqlbase) - 1024
+
         num_inserted = 0
 
         while True:
@@ -538,7 +909,7 @@ class MySQL(object):
                     break
 
                 # MySQL allows queries up to 1M characters
-                if self.max_query_len > 0 and len(values) > self.max_query_len:
+                if max_query_len > 0 and len(values) > max_query_len:
                     break
 
                 values += ','
@@ -550,6 +921,169 @@ class MySQL(object):
 
         return num_inserted
 
+    def _load_many(self, table, fields, mapping, obj, itr, do_update, db, update_columns, pipelined):
+        """
+        Implementation of insert_many with bulk_load = True. Rows are written in the format of MySQL.escape (quoted
+        and backslash-escaped strings, NULL for None) and loaded in batches of bulk_load_batch_factor * max_allowed_packet
+        bytes. With do_update, each batch is loaded into a temporary table and merged with INSERT ... SELECT ...
+        ON DUPLICATE KEY UPDATE. The connection is held for the whole duration.
+        """
+
+        if mapping is None:
+            mapping = lambda o: o
+
+        batch_len = self.bulk_load_batch_factor * self._get_server_variable('max_allowed_packet')
+
+        if fields:
+            field_list = ','.join('`%s`' % f for f in fields)
+        else:
+            field_list = '*'
+
+        if fields and do_update:
+            # staging table without keys and auto-increment
+            load_table = '_bulkload_%s' % table
+            if update_columns is None:
+                update_columns = fields
+
+            merge_sql = 'INSERT INTO `%s`.`%s` (%s)' % (db, table, field_list)
+            merge_sql += ' SELECT %s FROM `%s`.`%s`' % (field_list, db, load_table)
+            merge_sql += ' ON DUPLICATE KEY UPDATE ' + ','.join('`{f}`=VALUES(`{f}`)'.format(f = f) for f in update_columns)
+        else:
+            load_table = table
+            merge_sql = None
+
+        load_sql = 'LOAD DATA LOCAL INFILE %s'
+        if merge_sql is None:
+            load_sql += ' IGNORE'
+        load_sql += ' INTO TABLE `%s`.`%s`' % (db, load_table)
+        load_sql += ' FIELDS TERMINATED BY \',\' OPTIONALLY ENCLOSED BY \'\\\'\' ESCAPED BY \'\\\\\''
+        load_sql += ' LINES TERMINATED BY \'\\n\''
+        if fields:
+            load_sql += ' (%s)' % field_list
+
+        # state shared with the writer: [next object or None]
+        current = [obj, itr]
+
+        def write_batch(out):
+            # write rows until the batch is full or the objects are exhausted
+            nbytes = 0
+            obj, itr = current
+            while itr is not None:
+                line = ','.join(MySQL.escape(mapping(obj))) + '\n'
+                if type(line) is unicode:
+                    line = line.encode('utf-8')
+                out.write(line)
+                nbytes += len(line)
+
+                try:
+                    obj = itr.next()
+                except StopIteration:
+                    itr = None
+                    break
+
+                if nbytes > batch_len:
+                    break
+
+            current[:] = [obj, itr]
+            return nbytes
+
+        tmpdir = tempfile.mkdtemp(prefix = 'dynamo_load_')
+        path = os.path.join(tmpdir, 'rows')
+
+        if pipelined:
+            os.mkfifo(path, 0600)
+
+        num_inserted = 0
+
+        self._connection_lock.acquire()
+        state = self._state()
+        state.pinned += 1
+        try:
+            if merge_sql is not None:
+                self.query('DROP TEMPORARY TABLE IF EXISTS `%s`.`%s`' % (db, load_table))
+                self.query('CREATE TEMPORARY TABLE `%s`.`%s` ENGINE=MyISAM SELECT %s FROM `%s`.`%s` LIMIT 0' % (db, load_table, field_list, db, table))
+                state.tmp_tables.add((db, load_table))
+
+            while current[1] is not None:
+                if pipelined:
+                    nloaded = self._load_pipelined(load_sql, path, write_batch)
+                else:
+                    with open(path, 'w') as out:
+                        write_batch(out)
+
+                    nloaded = self.query(load_sql % MySQL.escape(path), retries = 0)
+
+                if merge_sql is None:
+                    num_inserted += nloaded
+                else:
+                    num_inserted += self.query(merge_sql, retries = 0)
+                    self.query('DELETE FROM `%s`.`%s`' % (db, load_table))
+
+            if merge_sql is not None:
+                self.query('DROP TEMPORARY TABLE `%s`.`%s`' % (db, load_table))
+                state.tmp_tables.discard((db, load_table))
+
+        finally:
+            state.pinned -= 1
+            if not self.reuse_connection and state.pinned == 0:
+                self._release_connection()
+            self._connection_lock.release()
+            shutil.rmtree(tmpdir, ignore_errors = True)
+
+        return num_inserted
+
+    def _load_pipelined(self, load_sql, path, write_batch):
+        """
+        Run LOAD DATA on a named pipe while a thread encodes the rows into it.
+        """
+
+        error = []
+
+        def writer():
+            try:
+                with open(path, 'w') as out:
+                    write_batch(out)
+            except:
+                error.append(sys.exc_info())
+
+        thread = threading.Thread(target = writer)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            nloaded = self.query(load_sql % MySQL.escape(path), retries = 0)
+        except:
+            # If the pipe was never opened, the writer is blocked in open(). Open the read end so it can finish.
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                pass
+
+            thread.join()
+            raise
+
+        thread.join()
+
+        if len(error) != 0:
+            raise error[0][0], error[0][1], error[0][2]
+
+        return nloaded
+
+    def _get_server_variable(self, name):
+        """
+        Global server variable, queried once per object.
+        """
+
+        try:
+            return self._server_variables[name]
+        except KeyError:
+            pass
+
+        value = self.query('SELECT @@%s' % name)[0]
+        self._server_variables[name] = value
+        return value
+
     def insert_select_many(self, insert_table, insert_fields, select_table, select_fields, key, pool, do_update = True, db = '', update_columns = None, additional_conditions = [], order_by = ''):
         """
         INSERT INTO insert_table (insert_fields) SELECT select_fields FROM select_table WHERE key IN pool
@@ -816,7 +1350,14 @@ class MySQL(object):
             sql += ','.join(columns)
             sql += ') ENGINE=MyISAM DEFAULT CHARSET=latin1'
 
-        self.query(sql)
+        self._connection_lock.acquire()
+        try:
+            self.query(sql)
+            self._state().tmp_tables.add((db, table))
+            self._connection_lock.release()
+        except:
+            self._fully_unlock()
+            raise
 
     def truncate_tmp_table(self, table, db = ''):
         if not db:
@@ -847,6 +1388,8 @@ class MySQL(object):
 
         self.query('SET sql_notes = 1')
 
+        self._state().tmp_tables.discard((db, table))
+
     def make_map(self, table, objects, object_id_map = None, id_object_map = None, key = None, tmp_join = False):
         objitr = iter(objects)
 
@@ -2,16 +2,22 @@ import sys
 import os
 import urllib
 import urllib2
+import urlparse
 import httplib
+import socket
 import ssl
 import time
 import json
 import re
+import hashlib
+import fnmatch
 import logging
 import threading
+from cStringIO import StringIO
 
 from dynamo.dataformat import Configuration, ConfigurationError
 from dynamo.utils.transform import unicode2str
+from dynamo.utils.parallel import Map
 
 LOG = logging.getLogger(__name__)
 
@@ -159,6 +165,11 @@ class CERNSSOCookieAuthHandler(urllib2.HTTPSHandler):
                     self.cookies[domain].append((name, value))
 
     def https_request(self, request):
+        self.add_cookie(request)
+
+        return urllib2.HTTPSHandler.https_request(self, request)
+
+    def add_cookie(self, request):
         try:
             cookies = self.cookies[request.get_host()]
             # concatenate all cookies for the domain with '; '
@@ -166,7 +177,116 @@ class CERNSSOCookieAuthHandler(urllib2.HTTPSHandler):
         except KeyError:
             pass
 
-        return urllib2.HTTPSHandler.https_request(self, request)
+
+class HTTPConnectionPool(object):
+    """
+    Idle persistent HTTP(S) connections per (scheme, host).
+    """
+
+    def __init__(self, max_idle, idle_timeout):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+
+        # {(scheme, host): [(connection, time of last use)]}
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        @return An idle connection or None
+        """
+
+        now = time.time()
+
+        with self._lock:
+            try:
+                connections = self._idle[key]
+            except KeyError:
+                return None
+
+            while len(connections) != 0:
+                connection, last_used = connections.pop()
+                if now - last_used < self.idle_timeout:
+                    return connection
+
+                # the server has likely closed it already
+                connection.close()
+
+        return None
+
+    def put(self, key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append((connection, time.time()))
+                return
+
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            for connections in self._idle.itervalues():
+                for connection, _ in connections:
+                    connection.close()
+
+            self._idle = {}
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of response bodies. Each entry is a file with a JSON header line (url, timestamp, ETag,
+    Last-Modified) followed by the raw content.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            if not os.path.isdir(self.path):
+                raise
+
+    def key(self, url, accept):
+        return hashlib.sha1(accept + ' ' + url).hexdigest()
+
+    def get(self, key):
+        """
+        @return (header dict, content) or None
+        """
+
+        try:
+            with open(os.path.join(self.path, key)) as source:
+                header = json.loads(source.readline())
+                content = source.read()
+        except (IOError, ValueError):
+            return None
+
+        return header, content
+
+    def put(self, key, url, etag, last_modified, content):
+        header = {'url': url, 'timestamp': time.time(), 'etag': etag, 'last_modified': last_modified}
+        self._write(key, header, content)
+
+    def touch(self, key, header, content):
+        """
+        Revalidated entry: reset the timestamp.
+        """
+        header['timestamp'] = time.time()
+        self._write(key, header, content)
+
+    def _write(self, key, header, content):
+        # write and rename so that readers never see a partial file
+        tmp_path = os.path.join(self.path, '.%s.%d.%s' % (key, os.getpid(), threading.current_thread().ident))
+        try:
+            with open(tmp_path, 'w') as out:
+                out.write(json.dumps(header) + '\n')
+                out.write(content)
+
+            os.rename(tmp_path, os.path.join(self.path, key))
+        except (IOError, OSError):
+            LOG.warning('Failed to write response cache entry for %s', header['url'])
 
 
 class RESTService(object):
@@ -191,6 +311,13 @@ class RESTService(object):
                                          default HTTPSCertKeyHandler.
                        conf auth_handler_conf
                        int  num_attempts
+                       bool keep_alive   Keep persistent connections to the servers. Default True.
+                       int  max_idle_connections  Number of idle connections kept per host. Default 4.
+                       float idle_timeout  Idle connections older than this (in seconds) are not reused. Default 10.
+                       str  cache_dir    Directory for the response cache. Default empty (no cache).
+                       float cache_ttl   Time in seconds during which a cached response is used without revalidation. Default 3600.
+                       list cache_resources  fnmatch patterns of resources to cache. Default ['*'].
+                       int  max_parallel_requests  Default concurrency of make_requests_parallel. Default 8.
         """
 
         self.url_base = config.url_base
@@ -200,20 +327,38 @@ class RESTService(object):
         self.auth_handler_conf = config.get('auth_handler_conf', Configuration())
         self.num_attempts = config.get('num_attempts', 1)
 
+        self.keep_alive = config.get('keep_alive', True)
+        self._connections = HTTPConnectionPool(config.get('max_idle_connections', 4), config.get('idle_timeout', 10.))
+        # auth handler instance, created at the first request (possibly from parallel threads)
+        self._handler = None
+        self._handler_lock = threading.Lock()
+
+        if config.get('cache_dir', ''):
+            self._cache = ResponseCache(config.cache_dir, config.get('cache_ttl', 3600.))
+            self.cache_resources = list(config.get('cache_resources', ['*']))
+        else:
+            self._cache = None
+            self.cache_resources = []
+
+        self.max_parallel_requests = config.get('max_parallel_requests', 8)
+
         self.last_errorcode = 0
         self.last_exception = None
 
-    def make_request(self, resource = '', options = [], method = GET, format = 'url', retry_on_error = True, timeout = 0):
+    def make_request(self, resource = '', options = [], method = GET, format = 'url', retry_on_error = True, timeout = 0, cache = None):
         """
         @param resource       What comes after url_base
         @param options        For GET calls, compiled into key=value&key=value&... For POST calls, becomes data
         @param method         GET or POST
         @param format         Format to send data in.
         @param retry_on_error Retry on general error (error code != 400 - Bad request).
-        @param timeout        If > 0, launch a monitoring thread and raise an exception when more than given number of seconds have elapsed.
+        @param timeout        If > 0, raise an exception when more than given number of seconds have elapsed.
+        @param cache          Use the response cache for GET requests. If None, cache if the resource matches cache_resources.
         """
 
         request = self._form_request(resource, options, method, format)
+        if cache is None:
+            cache = any(fnmatch.fnmatch(resource, pattern) for pattern in self.cache_resources)
 
         wait = 1.
         exceptions = []
@@ -221,7 +366,7 @@ class RESTService(object):
         last_except = None
         while len(exceptions) != self.num_attempts:
             try:
-                result = self._request_one(request, timeout)
+                result = self._request_one(request, timeout, cache = cache)
                 return result
     
             except urllib2.HTTPError as err:
@@ -248,6 +393,35 @@ class RESTService(object):
 
         raise RuntimeError('webservice too many attempts')
 
+    def make_requests_parallel(self, requests, method = GET, format = 'url', retry_on_error = True, timeout = 0, num_threads = 0):
+        """
+        Make multiple requests concurrently.
+        @param requests     List of resource strings or (resource, options) tuples.
+        @param num_threads  Maximum number of concurrent requests. Default max_parallel_requests.
+        Other parameters are passed to make_request.
+
+        @return  List of results in the order of requests.
+        """
+
+        arguments = []
+        for request in requests:
+            if type(request) is tuple:
+                arguments.append(request)
+            else:
+                arguments.append((request, []))
+
+        def request_one(resource, options):
+            return self.make_request(resource, options, method = method, format = format, retry_on_error = retry_on_error, timeout = timeout)
+
+        if num_threads <= 0:
+            num_threads = self.max_parallel_requests
+
+        parallelizer = Map(Configuration(num_threads = min(num_threads, len(arguments)), repeat_on_exception = False, ordered = True))
+        try:
+            return parallelizer.execute(request_one, arguments)
+        finally:
+            parallelizer.close()
+
     def _form_request(self, resource = '', options = [], method = GET, format = 'url'):
         """
         Form a urllib2.Request object from the given options.
@@ -308,9 +482,181 @@ class RESTService(object):
 
         return request
 
-    def _request_one(self, request, timeout):
+    def _request_one(self, request, timeout, cache = False):
+        """
+        Make one HTTP(S) request and return the parsed content. Raises urllib2.HTTPError for error responses.
+        """
+
+        cache_key = None
+        entry = None
+        extra_headers = {}
+
+        if cache and self._cache is not None and request.get_method() == 'GET':
+            cache_key = self._cache.key(request.get_full_url(), self.accept)
+            entry = self._cache.get(cache_key)
+
+            if entry is not None:
+                header, content = entry
+                if time.time() - header['timestamp'] < self._cache.ttl:
+                    return self._parse(content)
+
+                # revalidate
+                if header['etag']:
+                    extra_headers['If-None-Match'] = header['etag']
+                if header['last_modified']:
+                    extra_headers['If-Modified-Since'] = header['last_modified']
+
+        if self.auth_handler and self._handler is None:
+            with self._handler_lock:
+                if self._handler is None:
+                    self._handler = self.auth_handler(self.auth_handler_conf)
+
+        if self.keep_alive and (self._handler is None or isinstance(self._handler, (HTTPSCertKeyHandler, CERNSSOCookieAuthHandler))):
+            status, headers, content = self._open_persistent(request, extra_headers, timeout)
+        else:
+            status, headers, content = self._open_urllib2(request, extra_headers, timeout)
+
+        if status == httplib.NOT_MODIFIED and entry is not None:
+            header, content = entry
+            self._cache.touch(cache_key, header, content)
+
+        elif cache_key is not None and status == httplib.OK:
+            self._cache.put(cache_key, request.get_full_url(), headers.getheader('ETag'), headers.getheader('Last-Modified'), content)
+
+        return self._parse(content)
+
+    def _parse(self, content):
+        if self.accept == 'application/json':
+            result = json.loads(content)
+            unicode2str(result)
+
+        elif self.accept == 'application/xml':
+            # TODO implement xml -> dict
+            result = content
+
+        return result
+
+    def _request_headers(self, request, extra_headers):
+        # Same precedence as urllib2: request headers, then Accept, then the configured headers
+        headers = {}
+        for name, value in [('Accept', self.accept)] + self.headers:
+            headers.setdefault(name.capitalize(), value)
+
+        headers.setdefault('User-agent', 'Python-urllib/%s' % urllib2.__version__)
+        headers.update(request.header_items())
+        headers.update(extra_headers)
+
+        if request.has_data() and 'Content-type' not in headers:
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
+
+        return headers
+
+    def _open_persistent(self, request, extra_headers, timeout):
+        """
+        Make the request over a pooled connection, following redirects for GET requests.
+        If timeout > 0, it is the deadline for the whole request including redirects (a RuntimeError is raised when
+        it passes, as with RequestWatcher in _open_urllib2), and also the socket timeout of each operation.
+        Requests to hosts reached through a proxy (http_proxy, https_proxy, no_proxy environment) are passed to
+        _open_urllib2, whose default opener handles the proxy.
+        @return (status, headers, content)
+        """
+
+        if timeout > 0:
+            deadline = time.time() + timeout
+
+        for _ in range(5):
+            if self._use_proxy(request):
+                if timeout > 0:
+                    remaining = deadline - time.time()
+                    if remaining <= 0.:
+                        raise RuntimeError('Timeout in Webservice (%s)' % request.get_full_url())
+                else:
+                    remaining = 0
+
+                return self._open_urllib2(request, extra_headers, remaining)
+
+            # cookies are per host - add them on every hop
+            if hasattr(self._handler, 'add_cookie'):
+                self._handler.add_cookie(request)
+
+            scheme = request.get_type()
+            host = request.get_host()
+            key = (scheme, host)
+
+            # A pooled connection may have been closed by the server while idle. Idempotent requests are retried once
+            # with a new connection; others are not, since the server may already have acted on them.
+            retry_stale = request.get_method() in ('GET', 'HEAD')
+
+            connection = self._connections.get(key)
+            while True:
+                reused = connection is not None
+                if not reused:
+                    connection = self._new_connection(scheme, host)
+
+                if timeout > 0:
+                    remaining = deadline - time.time()
+                    if remaining <= 0.:
+                        connection.close()
+                        raise RuntimeError('Timeout in Webservice (%s)' % request.get_full_url())
+
+                    connection.timeout = remaining
+                else:
+                    connection.timeout = None
+
+                if connection.sock is not None:
+                    connection.sock.settimeout(connection.timeout)
+
+                try:
+                    connection.request(request.get_method(), request.get_selector(), request.get_data(), self._request_headers(request, extra_headers))
+                    response = connection.getresponse()
+                    content = response.read()
+                except (httplib.HTTPException, socket.error):
+                    connection.close()
+                    if reused and retry_stale and not isinstance(sys.exc_info()[1], socket.timeout):
+                        connection = None
+                        continue
+
+                    raise
+
+                break
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._connections.put(key, connection)
+
+            if timeout > 0 and time.time() > deadline:
+                raise RuntimeError('Timeout in Webservice (%s)' % request.get_full_url())
+
+            if response.status in (301, 302, 303, 307) and request.get_method() == 'GET' and response.getheader('Location'):
+                request = urllib2.Request(urlparse.urljoin(request.get_full_url(), response.getheader('Location')))
+                continue
+
+            if response.status >= 400:
+                raise urllib2.HTTPError(request.get_full_url(), response.status, response.reason, response.msg, StringIO(content))
+
+            return response.status, response.msg, content
+
+        raise RuntimeError('Too many redirects for %s' % request.get_full_url())
+
+    def _use_proxy(self, request):
+        # same decision as urllib2.ProxyHandler
+        proxies = urllib.getproxies()
+        return request.get_type() in proxies and not urllib.proxy_bypass(request.get_host())
+
+    def _new_connection(self, scheme, host):
+        if scheme == 'https':
+            if hasattr(self._handler, 'create_connection'):
+                return self._handler.create_connection(host)
+            else:
+                return httplib.HTTPSConnection(host)
+        else:
+            return httplib.HTTPConnection(host)
+
+    def _open_urllib2(self, request, extra_headers, timeout):
         """
         Use urllib2 opener mechanism to make on HTTP(S) request.
+        @return (status, headers, content)
         """
 
         if self.auth_handler:
@@ -323,31 +669,32 @@ class RESTService(object):
 
         opener.addheaders.extend(self.headers)
 
+        for name, value in extra_headers.iteritems():
+            request.add_unredirected_header(name, value)
+
         if timeout > 0:
             watcher = RequestWatcher('Webservice (%s)' % request.get_full_url())
             watcher.start(timeout)
 
-        response = opener.open(request)
+        try:
+            response = opener.open(request)
+        except urllib2.HTTPError as err:
+            if err.code != httplib.NOT_MODIFIED:
+                raise
 
-        if timeout > 0:
-            watcher.stop()
+            return err.code, err.info(), ''
+        finally:
+            if timeout > 0:
+                watcher.stop()
 
-        # clean up - break reference cycle so python can free the memory up
-        for handler in opener.handlers:
-            handler.parent = None
-        del opener
+            # clean up - break reference cycle so python can free the memory up
+            for handler in opener.handlers:
+                handler.parent = None
+            del opener
 
         content = response.read()
+        status = response.getcode()
+        headers = response.info()
         del response
 
-        if self.accept == 'application/json':
-            result = json.loads(content)
-            unicode2str(result)
-
-        elif self.accept == 'application/xml':
-            # TODO implement xml -> dict
-            result = content
-
-        del content
-
-        return result
+        return status, headers, content
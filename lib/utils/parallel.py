@@ -1,3 +1,4 @@
+import sys
 import time
 import multiprocessing
 import threading
@@ -5,206 +6,168 @@ import Queue
 
 from dynamo.dataformat import Configuration
 
-class FunctionWrapper(object):
-    def __init__(self, function, start_sem, done_sem):
-        self.function = function
-        self._start_sem = start_sem
-        self._done_sem = done_sem
-
-    def __call__(self, inputs, outputs, exception):
-        try:
-            for args in inputs:
-                output = self.function(*args)
-                outputs.append(output)
-
-        except Exception as ex:
-            exception.set(ex)
-
-        self._start_sem.release()
-        self._done_sem.release()
-
-
-class ExceptionHolder(object):
-    def __init__(self):
-        self.exception = None
-
-    def set(self, exc):
-        self.exception = exc
-
-
 class ThreadTimeout(RuntimeError):
     pass
 
 
-class ThreadController(object):
-    def __init__(self, function, start_sem):
-        self.print_progress = False
-        self.timeout = 0
-        self.repeat_on_exception = False
-        self.auto_start = False
-        self.logger = None
-
-        # if ntotal != 0, we print progress
-        self.ntotal = 0
-        self._start_time = 0
-        self._ndone = 0
-        self._watermark = 0
-
-        self._start_sem = start_sem
-        self._done_sem = threading.Semaphore(0)
-        self._target_function = function
+class TimingStats(object):
+    """
+    Per-call timing statistics of one execute() or starter session.
+    """
 
-        self._inputs = []
-        self._all_outputs = []
-        self._thread_defs = []
+    def __init__(self):
+        self.num_calls = 0
+        self.total_time = 0.
+        self.max_time = 0.
+        self.slowest_args = None
+        self.wall_time = 0.
 
-    def add_inputs(self, arguments, name = ''):
+    def record(self, times):
         """
-        Reserve a thread.
-        @param arguments  List of arguments. Each element corresponds to a single function call
-                          within a thread.
-        @param name       Name of the thread.
+        @param times  List of (elapsed time, arguments)
         """
+        for elapsed, args in times:
+            self.num_calls += 1
+            self.total_time += elapsed
+            if elapsed > self.max_time:
+                self.max_time = elapsed
+                self.slowest_args = args
+
+    def mean_time(self):
+        if self.num_calls == 0:
+            return 0.
+        else:
+            return self.total_time / self.num_calls
 
-        self._inputs.append((arguments, name))
-
-        if self.auto_start:
-            self._collect_threads()
-            while len(self._inputs) > 1 and self._start_one(blocking = False):
-                pass
-
-    def execute(self):
-        """Run all threads and return the full list of outputs."""
-
-        while len(self._inputs) != 0:
-            self._start_one()
-            self._collect_threads()
-
-        while len(self._thread_defs) != 0:
-            self._collect_threads(blocking = True)
-
-        outputs = self._all_outputs
-
-        self._start_time = 0
-        self._ndone = 0
-        self._watermark = 0
-        self._inputs = []
-        self._all_outputs = []
-
-        return outputs
+    def __str__(self):
+        return '%d calls in %.1fs (wall), %.1fs (total), %.3fs (mean), %.3fs (max)' % \
+            (self.num_calls, self.wall_time, self.total_time, self.mean_time(), self.max_time)
 
-    def iterate(self):
-        """Run threads and yield the outputs as they become available."""
 
-        while True:
-            while len(self._inputs) != 0:
-                if not self._start_one(blocking = False):
-                    # could not start
-                    break
+class TaskBatch(object):
+    """
+    Bookkeeping of one execute() or starter session on a WorkerPool. Inputs are processed in slices
+    (list of argument tuples), and the slice outputs are returned through a result queue.
+    """
 
-            if len(self._all_outputs) == 0:
-                if len(self._inputs) == 0 and len(self._thread_defs) == 0:
-                    # we are done
-                    return
+    def __init__(self, function):
+        self.function = function
+        # (slice index, outputs, [(elapsed, args)], (exception, inputs) or None)
+        self.results = Queue.Queue()
+        # slice index -> (start time, inputs)
+        self.running = {}
+        # set when the session is aborted; remaining slices are skipped
+        self.cancelled = False
 
-                # otherwise block until there is a thread completed
-                self._collect_threads(blocking = True)
+    def run(self, index, inputs):
+        if self.cancelled:
+            self.results.put((index, [], [], None))
+            return
 
-            else:
-                yield self._all_outputs.pop()
+        self.running[index] = (time.time(), inputs)
 
-    def _start_one(self, blocking = True):
-        # If blocking = True, return False immediately unless there is a free slot
-        if not blocking:
-            if not self._start_sem.acquire(False):
-                return False
+        outputs = []
+        times = []
+        exception = None
+        try:
+            for args in inputs:
+                start = time.time()
+                outputs.append(self.function(*args))
+                times.append((time.time() - start, args))
+        except:
+            exception = (sys.exc_info()[1], inputs)
 
-            self._start_sem.release()
+        self.running.pop(index)
+        self.results.put((index, outputs, times, exception))
 
-        arguments, name = self._inputs.pop(0)
 
-        exception = ExceptionHolder()
-        outputs = []
+class WorkerPool(object):
+    """
+    Persistent pool of daemon worker threads. Slices are passed to the workers through a bounded queue,
+    so that the submitter blocks when the workers fall behind.
+    """
 
-        target = FunctionWrapper(self._target_function, self._start_sem, self._done_sem)
-        thread = threading.Thread(target = target, args = (arguments, outputs, exception))
-        thread.daemon = True
-        if name:
-            thread.name = name
+    def __init__(self, num_workers, queue_size):
+        self.num_workers = num_workers
+        self._tasks = Queue.Queue(queue_size)
+        self._workers = []
+        self._lock = threading.Lock()
+        self._closed = False
 
-        # Blocks here until there is a free slot
-        self._start_sem.acquire()
-        thread.start()
-        if self._start_time == 0:
-            self._start_time = time.time()
+    def submit(self, batch, index, inputs, block = True):
+        """
+        @return False if block = False and the queue is full.
+        """
+        if len(self._workers) < self.num_workers:
+            self._start_workers()
 
-        self._thread_defs.append((thread, time.time(), arguments, exception, outputs))
+        try:
+            self._tasks.put((batch, index, inputs), block)
+        except Queue.Full:
+            return False
 
         return True
 
-    def _collect_threads(self, blocking = False):
-        if blocking:
-            # Block until there is a completed thread
-            self._done_sem.acquire()
-            # Increment the semaphore count by one (to be reduced below)
-            self._done_sem.release()
-
-        ith = 0
-        while ith != len(self._thread_defs):
-            thread, start_time, arguments, exception, outputs = self._thread_defs[ith]
-            if self._collect_one(thread, start_time, arguments, exception):
-                self._thread_defs.pop(ith)
-                self._all_outputs.extend(outputs)
-                # Reduce the semaphore count by one
-                self._done_sem.acquire()
-            else:
-                ith += 1
+    def close(self):
+        """
+        Let the workers exit once they are done with their current slice.
+        """
+        self._closed = True
 
-    def _collect_one(self, thread, time_started, inputs, exception):
-        if thread.is_alive():
-            if self.timeout > 0 and time.time() - time_started > self.timeout:
-                if self.logger:
-                    self.logger.error('Thread ' + thread.name + ' timed out.')
-                    self.logger.error('Inputs: ' + str([str(i) for i in inputs]))
+    def _start_workers(self):
+        with self._lock:
+            while len(self._workers) < self.num_workers:
+                thread = threading.Thread(target = self._work, name = 'MapWorker-%d' % len(self._workers))
+                thread.daemon = True
+                thread.start()
+                self._workers.append(thread)
 
-                raise ThreadTimeout(thread.name)
+    def _work(self):
+        # module globals can be gone at interpreter shutdown
+        get = self._tasks.get
+        empty = Queue.Empty
 
-            return False
+        while not self._closed:
+            try:
+                batch, index, inputs = get(timeout = 1)
+            except empty:
+                continue
 
-        thread.join()
+            batch.run(index, inputs)
 
-        if exception.exception is not None:
-            if self.logger:
-                self.logger.error('Exception in thread ' + thread.name)
-                self.logger.error('Inputs: ' + str([str(i) for i in inputs]))
 
-            if self.repeat_on_exception:
-                if self.logger:
-                    self.logger.error('Repeating execution')
+# Function executed in the process pool. Set before the pool is forked.
+_process_function = None
+_process_lock = threading.Lock()
 
-                for args in inputs:
-                    self._target_function(*args) # no catch
+def _run_process_slice(arg):
+    index, inputs = arg
 
-                if self.logger:
-                    self.logger.error('No exception was thrown during the repeat.')
+    outputs = []
+    times = []
+    try:
+        for args in inputs:
+            start = time.time()
+            outputs.append(_process_function(*args))
+            times.append((time.time() - start, args))
+    except:
+        return index, outputs, times, (sys.exc_info()[1], inputs)
 
-            raise exception.exception
-
-        if self.ntotal != 0 and self.logger: # progress report requested
-            self._ndone += len(inputs)
-            if self._ndone == self.ntotal or self._ndone > self._watermark:
-                self.logger.info('Processed %.1f%% of input (%ds elapsed).', 100. * self._ndone / self.ntotal, int(time.time() - self._start_time))
-                self.watermark += max(1, self._ntotal / 20)
-
-        return True
+    return index, outputs, times, None
 
 
 class AutoStarter(object):
-    def __init__(self, function, start_sem, task_per_thread):
+    """
+    Starts the function on the worker pool as inputs are added. add_input blocks when the workers fall behind.
+    """
+
+    def __init__(self, mapper, function):
+        self.mapper = mapper
+        self.batch = TaskBatch(function)
+        self.stats = TimingStats()
         self.inputs = []
-        self.controller = ThreadController(function, start_sem)
-        self.controller.auto_start = True
-        self.task_per_thread = task_per_thread
+        self.num_slices = 0
+        self._start_time = time.time()
 
     def add_input(self, args):
         if type(args) is not tuple:
@@ -212,60 +175,122 @@ class AutoStarter(object):
 
         self.inputs.append(args)
 
-        if len(self.inputs) == self.task_per_thread:
-            self.controller.add_inputs(self.inputs)
-            self.inputs = []
+        if len(self.inputs) == self.mapper.task_per_thread:
+            self._submit()
 
     def close(self):
         if len(self.inputs) != 0:
-            self.controller.add_inputs(self.inputs)
-            self.inputs = []
+            self._submit()
 
     def get_outputs(self):
-        return self.controller.execute()
+        self.close()
+
+        results = []
+        for _ in xrange(self.num_slices):
+            results.append(self.mapper._wait_result(self.batch, self.stats, None))
+
+        self.stats.wall_time = time.time() - self._start_time
+        self.mapper.stats = self.stats
+
+        if self.mapper.ordered:
+            results.sort()
+
+        outputs = []
+        for _, slice_outputs in results:
+            outputs.extend(slice_outputs)
+
+        return outputs
+
+    def _submit(self):
+        self.mapper._get_pool().submit(self.batch, self.num_slices, self.inputs)
+        self.num_slices += 1
+        self.inputs = []
+
 
-    
 class Map(object):
     """
-    Similar to multiprocessing.Pool.map but with threads. At each execute() call, instantiate a ThreadController
-    object to do the real work. Output list can be out of order.
+    Similar to multiprocessing.Pool.map. By default, the function is executed in a pool of worker threads that persists
+    for the lifetime of the Map object. With backend = 'process', a pool of forked processes is used instead, which
+    gives real parallelism for CPU-bound functions. In this case the function cannot modify objects of the calling
+    process, and the arguments and outputs must be picklable.
+    Output list is out of order unless ordered = True.
     """
 
     def __init__(self, config = Configuration()):
-        self.start_sem = threading.Semaphore(max(config.get('num_threads', multiprocessing.cpu_count() - 1), 1))
+        self.num_threads = max(config.get('num_threads', multiprocessing.cpu_count() - 1), 1)
         self.task_per_thread = config.get('task_per_thread', 1)
 
         self.print_progress = config.get('print_progress', False)
         self.timeout = config.get('timeout', 0)
         self.repeat_on_exception = config.get('repeat_on_exception', True)
 
+        # 'thread' or 'process'
+        self.backend = config.get('backend', 'thread')
+        # Return the outputs in the order of the inputs
+        self.ordered = config.get('ordered', False)
+        # Maximum number of input slices waiting for a worker
+        self.queue_size = config.get('queue_size', 2 * self.num_threads)
+
         self.logger = None
 
-    def execute(self, function, arguments, async = False):
+        # TimingStats of the last execution
+        self.stats = None
+
+        self._pool = None
+
+    def execute(self, function, arguments, async = False, ordered = None):
         """
         Execute function on each argument and return the function outputs in a list.
-        The output is not ordered.
         @param function   Thread function.
         @param arguments  List of arguments. Each element corresponds to a single function call.
                           Each element can be a single object or a tuple which gets unpacked.
-        @param async      If True, use the iterate function of ThreadController.
-        @return Unordered list of function outputs.
+        @param async      If True, return a generator that yields the outputs as they become available.
+        @param ordered    Return the outputs in the order of the arguments. Default is self.ordered.
+        @return List (or generator) of function outputs.
         """
 
         if len(arguments) == 0:
             return []
 
-        controller = ThreadController(function, self.start_sem)
-       
-        controller.print_progress = self.print_progress
-        controller.timeout = self.timeout
-        controller.repeat_on_exception = self.repeat_on_exception
-        controller.logger = self.logger
+        if ordered is None:
+            ordered = self.ordered
+
+        if self.backend == 'process':
+            generator = self._iterate_processes(function, arguments, ordered)
+        else:
+            generator = self._iterate_threads(function, arguments, ordered)
 
-        if self.print_progress:
-            controller.ntotal = len(arguments)
+        if async:
+            return generator
+        else:
+            return list(generator)
+
+    def get_starter(self, function):
+        """
+        @return An AutoStarter that runs the function on the thread pool as inputs are added.
+        """
+
+        return AutoStarter(self, function)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Stop the worker threads.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
 
-        # In case we want to run the function multiple times in a single thread, we make slices of inputs
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = WorkerPool(self.num_threads, self.queue_size)
+
+        return self._pool
+
+    def _slices(self, arguments):
+        # In case we want to run the function multiple times in a single task, we make slices of inputs
         inputs = []
         for args in arguments:
             if type(args) is not tuple:
@@ -273,21 +298,186 @@ class Map(object):
 
             inputs.append(args)
             if len(inputs) == self.task_per_thread:
-                controller.add_inputs(inputs)
+                yield inputs
                 inputs = []
-    
+
         if len(inputs) != 0:
-            controller.add_inputs(inputs)
+            yield inputs
 
-        if async:
-            return controller.iterate()
-        else:
-            return controller.execute()
+    def _iterate_threads(self, function, arguments, ordered):
+        pool = self._get_pool()
+        batch = TaskBatch(function)
+        stats = self.stats = TimingStats()
+        progress = self._make_progress(len(arguments))
+        start_time = time.time()
 
-    def get_starter(self, function):
-        starter = AutoStarter(function, self.start_sem, self.task_per_thread)
-        starter.controller.timeout = self.timeout
-        starter.controller.repeat_on_exception = self.repeat_on_exception
-        starter.controller.logger = self.logger
+        slices = self._slices(arguments)
+        next_slice = None
+        num_submitted = 0
+        num_collected = 0
+
+        # for ordered output
+        buffered = {}
+        next_index = 0
+
+        try:
+            while True:
+                # Submit as many slices as the queue can take, then collect one
+                while slices is not None:
+                    if next_slice is None:
+                        try:
+                            next_slice = slices.next()
+                        except StopIteration:
+                            slices = None
+                            break
+
+                    # block only if there is nothing to collect
+                    if not pool.submit(batch, num_submitted, next_slice, block = (num_submitted == num_collected)):
+                        break
+
+                    num_submitted += 1
+                    next_slice = None
+
+                if num_collected == num_submitted:
+                    break
+
+                index, outputs = self._wait_result(batch, stats, progress)
+                num_collected += 1
+
+                if ordered:
+                    buffered[index] = outputs
+                    while next_index in buffered:
+                        for output in buffered.pop(next_index):
+                            yield output
+                        next_index += 1
+                else:
+                    for output in outputs:
+                        yield output
+
+        finally:
+            # also reached when the caller stops iterating
+            batch.cancelled = True
+            stats.wall_time = time.time() - start_time
+            if self.logger:
+                self.logger.debug('Map: %s', str(stats))
+
+    def _wait_result(self, batch, stats, progress):
+        while True:
+            try:
+                index, outputs, times, exception = batch.results.get(timeout = 1)
+                break
+            except Queue.Empty:
+                pass
+
+            if self.timeout > 0:
+                now = time.time()
+                for index, (start_time, inputs) in batch.running.items():
+                    if now - start_time > self.timeout:
+                        if self.logger:
+                            self.logger.error('Task %d timed out.', index)
+                            self.logger.error('Inputs: ' + str([str(i) for i in inputs]))
+
+                        batch.cancelled = True
+                        # the worker is stuck; start with a fresh pool next time
+                        self.close()
+                        raise ThreadTimeout('Task %d' % index)
+
+        stats.record(times)
+
+        if exception is not None:
+            batch.cancelled = True
+            self._handle_exception(batch.function, index, exception)
+
+        if progress is not None:
+            progress(len(times))
+
+        return index, outputs
+
+    def _handle_exception(self, function, index, exception):
+        exception, inputs = exception
+
+        if self.logger:
+            self.logger.error('Exception in task %d', index)
+            self.logger.error('Inputs: ' + str([str(i) for i in inputs]))
+
+        if self.repeat_on_exception:
+            # Repeat in the calling thread to obtain the full traceback
+            if self.logger:
+                self.logger.error('Repeating execution')
+
+            for args in inputs:
+                function(*args) # no catch
+
+            if self.logger:
+                self.logger.error('No exception was thrown during the repeat.')
+
+        raise exception
+
+    def _iterate_processes(self, function, arguments, ordered):
+        global _process_function
+
+        stats = self.stats = TimingStats()
+        progress = self._make_progress(len(arguments))
+        start_time = time.time()
+
+        with _process_lock:
+            _process_function = function
+            # processes fork here and inherit _process_function
+            pool = multiprocessing.Pool(self.num_threads)
+            _process_function = None
+
+        try:
+            tasks = enumerate(self._slices(arguments))
+            if ordered:
+                results = pool.imap(_run_process_slice, tasks)
+            else:
+                results = pool.imap_unordered(_run_process_slice, tasks)
+
+            while True:
+                try:
+                    if self.timeout > 0:
+                        index, outputs, times, exception = results.next(self.timeout)
+                    else:
+                        index, outputs, times, exception = results.next()
+                except StopIteration:
+                    break
+                except multiprocessing.TimeoutError:
+                    if self.logger:
+                        self.logger.error('Process pool timed out.')
+                    raise ThreadTimeout('process pool')
+
+                stats.record(times)
+
+                if exception is not None:
+                    self._handle_exception(function, index, exception)
+
+                if progress is not None:
+                    progress(len(times))
+
+                for output in outputs:
+                    yield output
+
+            pool.close()
+
+        finally:
+            pool.terminate()
+            pool.join()
+
+            stats.wall_time = time.time() - start_time
+            if self.logger:
+                self.logger.debug('Map: %s', str(stats))
+
+    def _make_progress(self, ntotal):
+        if not self.print_progress or not self.logger:
+            return None
+
+        start_time = time.time()
+        state = {'ndone': 0, 'watermark': 0}
+
+        def progress(ndone):
+            state['ndone'] += ndone
+            if state['ndone'] == ntotal or state['ndone'] > state['watermark']:
+                self.logger.info('Processed %.1f%% of input (%ds elapsed).', 100. * state['ndone'] / ntotal, int(time.time() - start_time))
+                state['watermark'] += max(1, ntotal / 20)
 
-        return starter
+        return progress
@@ -0,0 +1,338 @@
+import os
+import stat
+import errno
+import time
+import json
+import hashlib
+import logging
+import multiprocessing
+
+LOG = logging.getLogger(__name__)
+
+def make_private_directory(path):
+    """
+    Create a directory accessible only by the current user, or check that an existing one is. The cache directories
+    are at fixed paths in a world-writable file system, so a directory created in advance by someone else must not
+    be used.
+    @param path  Directory path
+    @raise OSError if the path is not a directory owned by the current user with mode 0700
+    """
+
+    parent = os.path.dirname(path.rstrip('/'))
+    if parent and not os.path.isdir(parent):
+        os.makedirs(parent)
+
+    try:
+        os.mkdir(path, 0700)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    else:
+        # mkdir mode is masked by umask
+        os.chmod(path, 0700)
+
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() or stat.S_IMODE(st.st_mode) != 0700:
+        raise OSError(errno.EPERM, '%s is not a directory private to uid %d' % (path, os.geteuid()))
+
+
+def write_private_file(path, content):
+    """
+    Atomically replace the file at path with content, readable only by the current user.
+    """
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+
+    try:
+        os.unlink(tmp_path)
+    except OSError:
+        pass
+
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    try:
+        with os.fdopen(fd, 'w') as out:
+            out.write(content)
+
+        os.rename(tmp_path, path)
+    except:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+        raise
+
+
+class JSONString(str):
+    """
+    Already serialized JSON content. The web server inserts it into the response without encoding.
+    """
+    pass
+
+
+class CachingStream(object):
+    """
+    Iterable over the serialized chunks of a streamed response. Chunks are collected as they pass through and the
+    full response is stored in the cache when the stream is exhausted.
+    """
+
+    def __init__(self, chunks, cache, key, header):
+        self.chunks = chunks
+        self.cache = cache
+        self.key = key
+        self.header = header
+
+    def __iter__(self):
+        collected = []
+        size = 0
+        for chunk in self.chunks:
+            if collected is not None:
+                collected.append(chunk)
+                size += len(chunk)
+                if size > self.cache.max_size / 10:
+                    # too large to be cached
+                    collected = None
+
+            yield chunk
+
+        if collected is not None:
+            self.cache.put(self.key, self.header, ''.join(collected))
+
+
+class ResponseCache(object):
+    """
+    Cache of web module responses, shared by the forked web server processes through files in a directory
+    (by default on a memory-backed file system). Entries are keyed by the module, the request parameters, and
+    the versions of the data sources the module depends on. The inventory version is incremented by the web
+    server whenever the workers get a new inventory image or update; other data sources are versioned by time
+    slots of the module's cache_ttl. Total size of the entries is kept under max_size by removing the
+    least recently used ones.
+    """
+
+    # Request parameters that do not affect the content (JSONP callback and jQuery cache buster)
+    ignored_parameters = ('callback', '_')
+
+    def __init__(self, config):
+        self.path = config.get('path', '/dev/shm/dynamo_web_cache')
+        self.max_size = int(config.get('max_size', 256) * 1024 * 1024)
+
+        make_private_directory(self.path)
+
+        # Shared counters (the object is created in the server process before forking)
+        self.inventory_version = multiprocessing.Value('L', 0, lock = True)
+        # bytes written since the last size check
+        self._written = multiprocessing.Value('L', 0, lock = True)
+
+        # Inventory version restarts from 0 when the server restarts; distinguish with the start time
+        self._instance = '%x' % int(time.time() * 1000)
+
+    def make_key(self, path, request, provider):
+        """
+        @param path      SCRIPT_NAME + PATH_INFO
+        @param request   Parsed request dictionary
+        @param provider  WebModule instance
+        @return  Hex digest identifying the response
+        """
+
+        params = []
+        for key in sorted(request.iterkeys()):
+            if key in self.ignored_parameters:
+                continue
+
+            value = request[key]
+            if type(value) is list:
+                value = sorted(value)
+
+            params.append((key, value))
+
+        versions = []
+        for source in provider.cache_depends:
+            if source == 'inventory':
+                versions.append('%s.%d' % (self._instance, self.inventory_version.value))
+            else:
+                versions.append('%s.%d' % (source, int(time.time() / max(provider.cache_ttl, 1))))
+
+        return hashlib.sha1(repr((path, params, versions))).hexdigest()
+
+    def get(self, key):
+        """
+        @return (header dict, body) or None
+        """
+
+        path = os.path.join(self.path, key)
+        try:
+            with open(path) as source:
+                header = json.loads(source.readline())
+                body = source.read()
+        except (IOError, ValueError):
+            return None
+
+        try:
+            # LRU bookkeeping
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return header, body
+
+    def put(self, key, header, body):
+        """
+        @param header  Dict of JSON-serializable response metadata
+        @param body    Response content string
+        """
+
+        if len(body) > self.max_size / 10:
+            # do not let one response flush the cache
+            return
+
+        try:
+            write_private_file(os.path.join(self.path, key), json.dumps(header) + '\n' + body)
+        except (IOError, OSError):
+            LOG.warning('Failed to write web response cache entry %s', key)
+            return
+
+        with self._written.get_lock():
+            self._written.value += len(body)
+            check = self._written.value > self.max_size / 10
+            if check:
+                self._written.value = 0
+
+        if check:
+            self._enforce_limit()
+
+    def new_inventory_version(self):
+        """
+        Invalidate the entries depending on the inventory. Must be called after the workers can see the new inventory.
+        """
+        with self.inventory_version.get_lock():
+            self.inventory_version.value += 1
+
+    def _enforce_limit(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+
+        if total <= self.max_size:
+            return
+
+        # remove the least recently used entries until the total is below 80% of the limit
+        entries.sort()
+        for _, size, name in entries:
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+            total -= size
+            if total < self.max_size * 0.8:
+                break
+
+
+class AuthCache(object):
+    """
+    Cache of user identification and authorization results for HTTPS requests, shared by the web server processes
+    through files in a directory. Unknown DNs are cached too, with a shorter lifetime. All entries are dropped when
+    the user data version reported by the authorizer (checked at most every check_interval seconds) changes.
+    """
+
+    def __init__(self, config):
+        self.path = config.get('path', '/dev/shm/dynamo_web_auth')
+        self.ttl = config.get('ttl', 300)
+        self.negative_ttl = config.get('negative_ttl', 60)
+        self.check_interval = config.get('check_interval', 10)
+
+        make_private_directory(self.path)
+
+        # Shared between processes
+        self._last_check = multiprocessing.Value('d', 0., lock = True)
+        self._version = multiprocessing.Value('l', 0, lock = True)
+
+        # Entries from a previous server instance are not trusted
+        self.invalidate()
+
+    def get_user(self, dn, authorizer):
+        """
+        Identify the user from the DN (allowing truncation) and list the authorizations.
+        @param dn          Certificate DN
+        @param authorizer  Authorizer used for cache misses
+        @return  (user name, user id, user dn, [(role, target)]) or None if the user is unknown
+        """
+
+        self._check_version(authorizer)
+
+        path = os.path.join(self.path, hashlib.sha1(dn).hexdigest())
+
+        try:
+            with open(path) as source:
+                entry = json.loads(source.read())
+        except (IOError, ValueError):
+            pass
+        else:
+            if entry['user'] is None:
+                ttl = self.negative_ttl
+            else:
+                ttl = self.ttl
+
+            if time.time() - entry['time'] < ttl:
+                if entry['user'] is None:
+                    return None
+                else:
+                    authlist = [tuple(str(v) if v is not None else None for v in auth) for auth in entry['authlist']]
+                    return (str(entry['user']), entry['id'], str(entry['dn']), authlist)
+
+        userinfo = authorizer.identify_user(dn = dn, check_trunc = True)
+
+        if userinfo is None:
+            entry = {'time': time.time(), 'user': None}
+            result = None
+        else:
+            user, user_id, user_dn = userinfo
+            authlist = list(authorizer.list_user_auth(user))
+            entry = {'time': time.time(), 'user': user, 'id': user_id, 'dn': user_dn, 'authlist': authlist}
+            result = (user, user_id, user_dn, authlist)
+
+        try:
+            write_private_file(path, json.dumps(entry))
+        except (IOError, OSError):
+            LOG.warning('Failed to write user cache entry for %s', dn)
+
+        return result
+
+    def invalidate(self):
+        for name in os.listdir(self.path):
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def _check_version(self, authorizer):
+        now = time.time()
+
+        with self._last_check.get_lock():
+            if now - self._last_check.value < self.check_interval:
+                return
+
+            self._last_check.value = now
+
+        version = authorizer.get_user_data_version()
+        if version is None:
+            # authorizer cannot tell; rely on the TTL
+            return
+
+        version = hash(version)
+
+        with self._version.get_lock():
+            if version == self._version.value:
+                return
+
+            self._version.value = version
+
+        LOG.info('User data changed. Invalidating the user cache.')
+        self.invalidate()
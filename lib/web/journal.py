@@ -0,0 +1,84 @@
+import os
+import json
+import logging
+import multiprocessing
+
+LOG = logging.getLogger(__name__)
+
+class UpdateJournal(object):
+    """
+    Append-only file of inventory update commands. The server process appends the commands it has applied to its
+    inventory, and the web server workers, which hold copies of the inventory made at fork time, replay the new
+    commands before serving a request. The WSGI master process replays the journal before forking a worker, so that
+    a new worker inherits its read position and only replays the later commands. Only complete batches (appended in
+    one call) are visible to the readers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        # Create or truncate
+        open(self.path, 'w').close()
+
+        # Size of the file up to the last complete batch; shared between processes
+        self._committed = multiprocessing.Value('L', 0, lock = True)
+
+        # Writer side (server process)
+        self._out = None
+        # Reader side (worker processes): position up to which the commands were read in this process
+        self._offset = 0
+
+    def size(self):
+        return self._committed.value
+
+    def append(self, update_commands):
+        """
+        @param update_commands  List of (cmd, objstr)
+        """
+
+        if self._out is None:
+            self._out = open(self.path, 'a')
+
+        for cmd, objstr in update_commands:
+            self._out.write(json.dumps((cmd, objstr)) + '\n')
+
+        self._out.flush()
+
+        with self._committed.get_lock():
+            self._committed.value = self._out.tell()
+
+    def read(self):
+        """
+        @return List of (cmd, objstr) appended since the last call in this process.
+        """
+
+        end = self._committed.value
+        if end <= self._offset:
+            return []
+
+        with open(self.path) as source:
+            source.seek(self._offset)
+            data = source.read(end - self._offset)
+
+        self._offset = end
+
+        update_commands = []
+        for line in data.splitlines():
+            cmd, objstr = json.loads(line)
+            update_commands.append((cmd, str(objstr)))
+
+        return update_commands
+
+    def close(self):
+        """
+        Close and remove the file. Called from the writer side.
+        """
+
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -9,6 +9,15 @@ class WebModule(object):
         self.message = ''
 
         self.input_data = None
+        # Iterator over the lines of the request body when it is line-delimited JSON (application/x-ndjson)
+        self.input_stream = None
+
+        # Response caching (read-only modules only). Responses are cached per request parameters and versions
+        # of the data sources in cache_depends. 'inventory' is versioned by the server; other sources are
+        # considered fresh for cache_ttl seconds.
+        self.cacheable = False
+        self.cache_depends = ['inventory']
+        self.cache_ttl = 300
 
     def run(self, caller, request, inventory):
         """
@@ -16,6 +25,10 @@ class WebModule(object):
         @param caller    WebServer.User object (namedtuple of (name, id, authlist))
         @param request   A dictionary (or list if JSON list is uploaded) of user request
         @param inventory The inventory
+        @return  Any JSONizable python object (or a string for non-JSON content types). Large results can be
+                 returned as a generator of records (or a dict with generator values), which is serialized and
+                 sent as the records are produced. Exceptions raised within the generator cannot change the
+                 response status any more, so the request should be validated before returning the generator.
         """
 
         raise NotImplementedError('run')
@@ -7,9 +7,12 @@ class FileDownloadMixin(object):
         self.content_type = content_type
 
         self.additional_headers = [
-            ('Content-Disposition', 'attachment; filename="%s"' % filename),
-            ('Content-Length', str(len(content))),
-            ('Connection', 'close')
+            ('Content-Disposition', 'attachment; filename="%s"' % filename)
         ]
+        if type(content) is str:
+            # content can also be a generator of strings
+            self.additional_headers.append(('Content-Length', str(len(content))))
+
+        self.additional_headers.append(('Connection', 'close'))
 
         return content
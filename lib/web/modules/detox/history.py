@@ -15,6 +15,11 @@ class WebDetoxHistory(WebModule):
 
         self.detox_history = DetoxHistoryBase()
 
+        # New cycles are recorded by detox, outside of the inventory update cycle
+        self.cacheable = True
+        self.cache_depends = ['detox_history']
+        self.cache_ttl = 60
+
         # The partition that shows up when the page is opened with no arguments
         self.default_partition = config.detox.default_partition
         # List of partitions whose timestamp can go red if the update has not happened for a long while
@@ -247,12 +252,12 @@ class DetoxCycleDump(WebDetoxHistory, FileDownloadMixin):
 
         decisions = self.detox_history.get_deletion_decisions(self.cycle, size_only = False, decisions = ['delete'])
 
-        dump = ''
-        for site_name, site_decisions in decisions.iteritems():
-            for dataset_name, replica_size, decision, condition_id, condition_text in site_decisions:
-                dump += '%s\t%s\t%.2f\n' % (site_name, dataset_name, replica_size * 1.e-9)
+        def dump():
+            for site_name, site_decisions in decisions.iteritems():
+                for dataset_name, replica_size, decision, condition_id, condition_text in site_decisions:
+                    yield '%s\t%s\t%.2f\n' % (site_name, dataset_name, replica_size * 1.e-9)
 
-        return self.export_content(dump, 'deletions_%d.txt' % self.cycle)
+        return self.export_content(dump(), 'deletions_%d.txt' % self.cycle)
 
 
 class DetoxCyclePolicy(WebDetoxHistory):
@@ -323,10 +328,14 @@ class DetoxDatasetSearch(WebDetoxHistory):
         except KeyError:
             raise exceptions.MissingParameter('datasets')
 
+        if type(pattern_strings) is str:
+            pattern_strings = [pattern_strings]
+
         data = {'results': [], 'conditions': {0: 'No policy match'}}
         conditions = data['conditions']
 
-        decisions = self.detox_history.get_deletion_decisions(self.cycle, size_only = False)
+        # only the decisions on the matching datasets
+        decisions = self.detox_history.get_dataset_deletion_decisions(self.cycle, pattern_strings)
 
         multi_action = {}
         for site_name, site_decisions in decisions.iteritems():
@@ -0,0 +1,203 @@
+import time
+import json
+import logging
+
+from dynamo.web.exceptions import MissingParameter, IllFormedRequest, InvalidRequest
+from dynamo.utils.transform import unicode2str
+import dynamo.dataformat as df
+
+LOG = logging.getLogger(__name__)
+
+class RecordStream(object):
+    """
+    Line-delimited JSON body of the inject and delete modules. Each line is a dict with a single key naming the
+    object type, e.g.
+      {"dataset": {"name": "/A/B/C", "status": "valid"}}
+      {"file": {"dataset": "/A/B/C", "block": "0123-abcd", "name": "/store/...", "size": 1000, ...}}
+    Objects below the dataset level name their parents in the record. Records are parsed and checked one by one,
+    and consecutive records of the same type and parents are handed over as one group so that the objects of a
+    block (or a dataset replica) are applied together. Rejected records are reported with their line numbers.
+    """
+
+    # record type -> parent keys
+    parent_keys = {
+        'dataset': (),
+        'site': (),
+        'group': (),
+        'datasetreplica': (),
+        'block': ('dataset',),
+        'file': ('dataset', 'block'),
+        'blockreplica': ('dataset', 'site')
+    }
+
+    # maximum number of records in a group
+    group_size = 10000
+
+    def __init__(self, lines):
+        """
+        @param lines  Iterable of input lines
+        """
+
+        self.lines = lines
+
+        self.num_records = 0
+        self.num_applied = 0
+        # [{'line': line number, 'error': message}]
+        self.errors = []
+
+        self._start_time = time.time()
+
+    def process(self, check, apply):
+        """
+        Read the stream to the end.
+        @param check  Function (type, obj) raising MissingParameter, IllFormedRequest, or InvalidRequest
+                      if the record cannot be used.
+        @param apply  Function (type, parents, objects) that applies a group of records.
+        """
+
+        group_key = None
+        group = []
+
+        for iline, line in enumerate(self.lines):
+            line = line.strip()
+            if not line:
+                continue
+
+            self.num_records += 1
+
+            try:
+                rtype, obj, parents = self._parse(line)
+            except (MissingParameter, IllFormedRequest, InvalidRequest) as ex:
+                self._reject(iline, str(ex))
+                continue
+
+            key = (rtype, parents)
+            if key != group_key or len(group) == RecordStream.group_size:
+                # apply the previous group first; the record may refer to the objects in it
+                self._apply(group_key, group, apply)
+                group_key = key
+                group = []
+
+            try:
+                check(rtype, obj)
+            except (MissingParameter, IllFormedRequest, InvalidRequest) as ex:
+                self._reject(iline, str(ex))
+                continue
+
+            group.append((iline, obj))
+
+        self._apply(group_key, group, apply)
+
+        elapsed = time.time() - self._start_time
+        LOG.info('Processed %d records (%d rejected) in %.1f seconds.', self.num_records, len(self.errors), elapsed)
+
+    def summary(self):
+        """
+        @return Dict of the record counts, processing rate, and errors.
+        """
+
+        elapsed = time.time() - self._start_time
+
+        return {
+            'records': self.num_records,
+            'applied': self.num_applied,
+            'rejected': len(self.errors),
+            'seconds': round(elapsed, 3),
+            'records_per_second': round(self.num_records / max(elapsed, 1.e-3), 1),
+            'errors': self.errors
+        }
+
+    def _parse(self, line):
+        """
+        @return (type, obj, parents)
+        """
+
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise IllFormedRequest('record', line[:100], hint = 'Could not parse the line')
+
+        if type(record) is not dict or len(record) != 1:
+            raise IllFormedRequest('record', line[:100], hint = 'Record must be a dict with a single key')
+
+        unicode2str(record)
+        rtype, obj = record.items()[0]
+
+        try:
+            keys = RecordStream.parent_keys[rtype]
+        except KeyError:
+            raise IllFormedRequest('record', rtype, allowed = sorted(RecordStream.parent_keys.keys()))
+
+        if type(obj) is not dict:
+            raise IllFormedRequest(rtype, str(obj)[:100], hint = 'Object must be a dict')
+
+        parents = []
+        for key in keys:
+            try:
+                parents.append(obj[key])
+            except KeyError:
+                raise MissingParameter(key, context = rtype + ' ' + str(obj))
+
+        return rtype, obj, tuple(parents)
+
+    def _apply(self, key, group, apply):
+        if len(group) == 0:
+            return
+
+        rtype, parents = key
+
+        try:
+            apply(rtype, parents, [obj for _, obj in group])
+        except (MissingParameter, IllFormedRequest, InvalidRequest) as ex:
+            # Records were checked individually; this is a problem with the parents or the current inventory
+            # state. Part of the group may have been applied.
+            first, last = group[0][0], group[-1][0]
+            for iline, _ in group:
+                self._reject(iline, '%s (records on lines %d-%d)' % (str(ex).strip(), first + 1, last + 1))
+        else:
+            self.num_applied += len(group)
+
+    def _reject(self, iline, message):
+        self.errors.append({'line': iline + 1, 'error': message.strip()})
+
+
+def find_parent(rtype, parents, inventory):
+    """
+    Find the object under which a group of streamed records is applied.
+    @param rtype      Record type (block, file, or blockreplica)
+    @param parents    Parent names of the group
+    @param inventory  Inventory
+    @return Dataset for blocks, Block for files, DatasetReplica for block replicas.
+    """
+
+    try:
+        dataset = inventory.datasets[parents[0]]
+    except KeyError:
+        raise InvalidRequest('Unknown dataset %s' % parents[0])
+
+    if rtype == 'block':
+        return dataset
+
+    elif rtype == 'file':
+        try:
+            internal_name = df.Block.to_internal_name(parents[1])
+        except:
+            raise IllFormedRequest('block', parents[1], hint = 'Name does not match the format')
+
+        block = dataset.find_block(internal_name)
+        if block is None:
+            raise InvalidRequest('Unknown block %s of %s' % (parents[1], dataset.name))
+
+        return block
+
+    elif rtype == 'blockreplica':
+        try:
+            site = inventory.sites[parents[1]]
+        except KeyError:
+            raise InvalidRequest('Unknown site %s' % parents[1])
+
+        replica = site.find_dataset_replica(dataset)
+        if replica is None:
+            raise InvalidRequest('Replica of %s at %s does not exist' % (dataset.name, site.name))
+
+        return replica
@@ -9,6 +9,11 @@ class ListDatasets(WebModule):
     Simple dataset listing.
     """
 
+    def __init__(self, config):
+        WebModule.__init__(self, config)
+
+        self.cacheable = True
+
     def run(self, caller, request, inventory):
         datasets = []
     
@@ -27,13 +32,13 @@ class ListDatasets(WebModule):
                 except KeyError:
                     pass
     
-        response = []
-        for dataset in datasets:
-            response.append({'name': dataset.name, 'size': dataset.size, 'num_files': dataset.num_files,
-                'status': Dataset.status_name(dataset.status), 'type': Dataset.data_type_name(dataset.data_type)})
+        # a wildcard can match the full inventory - stream the records
+        def response():
+            for dataset in datasets:
+                yield {'name': dataset.name, 'size': dataset.size, 'num_files': dataset.num_files,
+                    'status': Dataset.status_name(dataset.status), 'type': Dataset.data_type_name(dataset.data_type)}
     
-        # return any JSONizable python object (maybe should be limited to a list)
-        return response
+        return response()
 
 
 # exported to __init__.py
@@ -3,6 +3,7 @@ import logging
 
 from dynamo.web.exceptions import MissingParameter, IllFormedRequest, InvalidRequest, AuthorizationError
 from dynamo.web.modules._base import WebModule
+from dynamo.web.modules.inventory._records import RecordStream, find_parent
 import dynamo.dataformat as df
 from dynamo.registry.registry import RegistryDatabase
 
@@ -24,16 +25,28 @@ class DeleteDataBase(WebModule):
         The values must be lists of dicts, where each dict represents an object. Having unique
         names are sufficient to identify the objects. Blocks should be listed
         within a dataset dict, Files within Blocks, and BlockReplicas within DatasetReplicas.
+        Large deletions can instead be sent as line-delimited JSON (Content-Type application/x-ndjson), one
+        object per line (see RecordStream).
         """
 
         if ('admin', 'inventory') not in caller.authlist:
             raise AuthorizationError()
 
+        counts = {}
+
+        if self.input_stream is not None:
+            stream = RecordStream(self.input_stream)
+            apply = lambda rtype, parents, objects: self._apply_records(rtype, parents, objects, inventory, counts)
+            stream.process(self._check_record, apply)
+
+            self._finalize()
+
+            counts.update(stream.summary())
+            return counts
+
         if type(self.input_data) is not dict:
             raise IllFormedRequest('input', type(self.input_data).__name__, hint = 'data must be a dict type')
 
-        counts = {}
-
         if 'dataset' in self.input_data:
             self._delete_datasets(self.input_data['dataset'], inventory, counts)
 
@@ -53,6 +66,47 @@ class DeleteDataBase(WebModule):
     def _finalize(self):
         pass
 
+    def _flush(self):
+        pass
+
+    def _check_record(self, rtype, obj):
+        """
+        Check the fields of a streamed record.
+        """
+
+        if rtype == 'datasetreplica':
+            required = ('dataset', 'site')
+        elif rtype == 'blockreplica':
+            required = ('block',)
+        else:
+            required = ('name',)
+
+        for key in required:
+            if key not in obj:
+                raise MissingParameter(key, context = rtype + ' ' + str(obj))
+
+    def _apply_records(self, rtype, parents, objects, inventory, counts):
+        """
+        Apply a group of streamed records with the same type and parents.
+        """
+
+        if rtype == 'dataset':
+            self._delete_datasets(objects, inventory, counts)
+        elif rtype == 'site':
+            self._delete_sites(objects, inventory, counts)
+        elif rtype == 'group':
+            self._delete_groups(objects, inventory, counts)
+        elif rtype == 'datasetreplica':
+            self._delete_datasetreplicas(objects, inventory, counts)
+        elif rtype == 'block':
+            self._delete_blocks(objects, find_parent(rtype, parents, inventory), inventory, counts)
+        elif rtype == 'file':
+            self._delete_files(objects, find_parent(rtype, parents, inventory), inventory, counts)
+        elif rtype == 'blockreplica':
+            self._delete_blockreplicas(objects, find_parent(rtype, parents, inventory), inventory, counts)
+
+        self._flush()
+
     def _delete_datasets(self, objects, inventory, counts):
         num_datasets = 0
 
@@ -78,7 +132,10 @@ class DeleteDataBase(WebModule):
 
                 num_datasets += 1
 
-        counts['datasets'] = num_datasets
+        try:
+            counts['datasets'] += num_datasets
+        except KeyError:
+            counts['datasets'] = num_datasets
 
     def _delete_sites(self, objects, inventory, counts):
         num_sites = 0
@@ -101,7 +158,10 @@ class DeleteDataBase(WebModule):
         
             num_sites += 1
 
-        counts['sites'] = num_sites
+        try:
+            counts['sites'] += num_sites
+        except KeyError:
+            counts['sites'] = num_sites
 
     def _delete_groups(self, objects, inventory, counts):
         num_groups = 0
@@ -124,7 +184,10 @@ class DeleteDataBase(WebModule):
 
             num_groups += 1
 
-        counts['groups'] = num_groups
+        try:
+            counts['groups'] += num_groups
+        except KeyError:
+            counts['groups'] = num_groups
 
     def _delete_datasetreplicas(self, objects, inventory, counts):
         num_datasetreplicas = 0
@@ -150,7 +213,7 @@ class DeleteDataBase(WebModule):
                 except KeyError:
                     raise InvalidRequest('Unknown site %s' % site_name)
 
-            replica = site.find_datast_replica(dataset)
+            replica = site.find_dataset_replica(dataset)
 
             if replica is None:
                 raise InvalidRequest('Replica of %s at %s does not exist' % (dataset_name, site_name))
@@ -167,7 +230,10 @@ class DeleteDataBase(WebModule):
         
                 num_datasetreplicas += 1
 
-        counts['datasetreplicas'] = num_datasetreplicas
+        try:
+            counts['datasetreplicas'] += num_datasetreplicas
+        except KeyError:
+            counts['datasetreplicas'] = num_datasetreplicas
 
     def _delete_blocks(self, objects, dataset, inventory, counts):
         num_blocks = 0
@@ -290,6 +356,9 @@ class DeleteData(DeleteDataBase):
     as the central inventory update table. The updater process will pick up the deletion instructions asynchronously.
     """
 
+    # number of queued commands written to the registry at once when deleting from a stream
+    flush_size = 50000
+
     def __init__(self, config):
         DeleteDataBase.__init__(self, config)
 
@@ -310,13 +379,24 @@ class DeleteData(DeleteDataBase):
     def _register_update(self, inventory, obj):
         self.queue.append(('update', repr(obj)))
 
-    def _finalize(self):
+    def _flush(self, force = False):
+        # Streamed deletions are written out in batches
+        if len(self.queue) == 0 or (not force and len(self.queue) < DeleteData.flush_size):
+            return
+
         fields = ('cmd', 'obj')
 
         # make entries consecutive
         self.registry.db.lock_tables(write = ['data_injections'])
-        self.registry.db.insert_many('data_injections', fields, None, self.queue)
-        self.registry.db.unlock_tables()
+        try:
+            self.registry.db.insert_many('data_injections', fields, None, self.queue)
+        finally:
+            self.registry.db.unlock_tables()
+
+        self.queue = []
+
+    def _finalize(self):
+        self._flush(force = True)
 
         self.message = 'Data will be deleted in the regular update cycle later.'
 
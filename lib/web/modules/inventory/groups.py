@@ -4,6 +4,11 @@ import re
 from dynamo.web.modules._base import WebModule
 
 class ListGroups(WebModule):
+    def __init__(self, config):
+        WebModule.__init__(self, config)
+
+        self.cacheable = True
+
     def run(self, caller, request, inventory):
         # collect information from the inventory and registry according to the requests
 
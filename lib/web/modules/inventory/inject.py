@@ -3,8 +3,10 @@ import logging
 
 from dynamo.web.exceptions import MissingParameter, IllFormedRequest, InvalidRequest, AuthorizationError, TryAgain
 from dynamo.web.modules._base import WebModule
+from dynamo.web.modules.inventory._records import RecordStream, find_parent
 import dynamo.dataformat as df
 from dynamo.registry.registry import RegistryDatabase
+from dynamo.fileop.rlfsm import RLFSM
 
 LOG = logging.getLogger(__name__)
 
@@ -23,16 +25,29 @@ class InjectDataBase(WebModule):
         The top level keys must be "dataset", "site", "group", or "datasetreplica".
         The values must be lists of dicts, where each dict represents an object. Blocks should be listed
         within a dataset dict, Files within Blocks, and BlockReplicas within DatasetReplicas.
+        Large injections can instead be sent as line-delimited JSON (Content-Type application/x-ndjson), one
+        object per line (see RecordStream). Records are then processed as they are read, and the rejected ones
+        are reported in the response.
         """
 
         if ('admin', 'inventory') not in caller.authlist:
             raise AuthorizationError()
 
+        counts = {}
+
+        if self.input_stream is not None:
+            stream = RecordStream(self.input_stream)
+            apply = lambda rtype, parents, objects: self._apply_records(rtype, parents, objects, inventory, counts)
+            stream.process(lambda rtype, obj: self._check_record(rtype, obj, inventory), apply)
+
+            self._finalize()
+
+            counts.update(stream.summary())
+            return counts
+
         if type(self.input_data) is not dict:
             raise IllFormedRequest('input', type(self.input_data).__name__, hint = 'data must be a dict type')
 
-        counts = {}
-
         # blocks_with_new_file list used in the synchronous version of this class
 
         if 'dataset' in self.input_data:
@@ -54,6 +69,62 @@ class InjectDataBase(WebModule):
     def _finalize(self):
         pass
 
+    def _flush(self):
+        pass
+
+    def _check_record(self, rtype, obj, inventory):
+        """
+        Check the fields of a streamed record.
+        """
+
+        if rtype == 'datasetreplica':
+            required = ('dataset', 'site')
+        elif rtype == 'blockreplica':
+            required = ('block',)
+        elif rtype == 'file':
+            required = ('name', 'size')
+        else:
+            required = ('name',)
+
+        for key in required:
+            if key not in obj:
+                raise MissingParameter(key, context = rtype + ' ' + str(obj))
+
+        if rtype == 'block':
+            try:
+                df.Block.to_internal_name(obj['name'])
+            except:
+                raise IllFormedRequest('name', obj['name'], hint = 'Name does not match the format')
+
+        elif rtype == 'file':
+            if any(algo not in obj for algo in df.File.checksum_algorithms):
+                raise MissingParameter(','.join(df.File.checksum_algorithms), context = 'file ' + str(obj))
+
+        if rtype in ('datasetreplica', 'file') and 'site' in obj and obj['site'] not in inventory.sites:
+            raise InvalidRequest('Unknown site %s' % obj['site'])
+
+    def _apply_records(self, rtype, parents, objects, inventory, counts):
+        """
+        Apply a group of streamed records with the same type and parents.
+        """
+
+        if rtype == 'dataset':
+            self._make_datasets(objects, inventory, counts)
+        elif rtype == 'site':
+            self._make_sites(objects, inventory, counts)
+        elif rtype == 'group':
+            self._make_groups(objects, inventory, counts)
+        elif rtype == 'datasetreplica':
+            self._make_datasetreplicas(objects, inventory, counts)
+        elif rtype == 'block':
+            self._make_blocks(objects, find_parent(rtype, parents, inventory), inventory, counts)
+        elif rtype == 'file':
+            self._make_files(objects, find_parent(rtype, parents, inventory), inventory, counts)
+        elif rtype == 'blockreplica':
+            self._make_blockreplicas(objects, find_parent(rtype, parents, inventory), inventory, counts)
+
+        self._flush()
+
     def _make_datasets(self, objects, inventory, counts):
         num_datasets = 0
 
@@ -105,7 +176,10 @@ class InjectDataBase(WebModule):
             if blocks is not None:
                 self._make_blocks(blocks, dataset, inventory, counts)
 
-        counts['datasets'] = num_datasets
+        try:
+            counts['datasets'] += num_datasets
+        except KeyError:
+            counts['datasets'] = num_datasets
 
     def _make_sites(self, objects, inventory, counts):
         num_sites = 0
@@ -149,7 +223,10 @@ class InjectDataBase(WebModule):
         
                 num_sites += 1
 
-        counts['sites'] = num_sites
+        try:
+            counts['sites'] += num_sites
+        except KeyError:
+            counts['sites'] = num_sites
 
     def _make_groups(self, objects, inventory, counts):
         num_groups = 0
@@ -181,7 +258,10 @@ class InjectDataBase(WebModule):
 
                 num_groups += 1
 
-        counts['groups'] = num_groups
+        try:
+            counts['groups'] += num_groups
+        except KeyError:
+            counts['groups'] = num_groups
 
     def _make_datasetreplicas(self, objects, inventory, counts):
         num_datasetreplicas = 0
@@ -256,7 +336,10 @@ class InjectDataBase(WebModule):
             if blockreplicas is not None:
                 self._make_blockreplicas(blockreplicas, replica, inventory, counts)
 
-        counts['datasetreplicas'] = num_datasetreplicas
+        try:
+            counts['datasetreplicas'] += num_datasetreplicas
+        except KeyError:
+            counts['datasetreplicas'] = num_datasetreplicas
 
     def _make_blocks(self, objects, dataset, inventory, counts):
         num_blocks = 0
@@ -323,6 +406,8 @@ class InjectDataBase(WebModule):
         num_files = 0
 
         block_replicas = {}
+        # replicas to be registered once at the end
+        updated_replicas = set()
 
         for obj in objects:
             try:
@@ -414,7 +499,7 @@ class InjectDataBase(WebModule):
             if block_replica is not None:
                 # add_file updates the size and file_ids list
                 block_replica.add_file(lfile)
-                self._register_update(inventory, block_replica)
+                updated_replicas.add(block_replica)
 
                 # go through all the other replicas of this block and update the ones that claim to be full
                 old_files_list = None
@@ -440,10 +525,13 @@ class InjectDataBase(WebModule):
                             old_files_list = tuple(old_files_list)
 
                         replica.file_ids = old_files_list
-                        self._register_update(inventory, replica)
+                        updated_replicas.add(replica)
 
             num_files += 1
 
+        for replica in updated_replicas:
+            self._register_update(inventory, replica)
+
         if num_files != 0:
             self._register_update(inventory, block)
 
@@ -560,6 +648,9 @@ class InjectData(InjectDataBase):
     as the central inventory update table. The updater process will pick up the injection instructions asynchronously.
     """
 
+    # number of queued objects written to the registry at once when injecting from a stream
+    flush_size = 50000
+
     def __init__(self, config):
         InjectDataBase.__init__(self, config)
 
@@ -577,14 +668,25 @@ class InjectData(InjectDataBase):
     def _register_update(self, inventory, obj):
         self.inject_queue.append(obj)
 
-    def _finalize(self):
+    def _flush(self, force = False):
+        # Streamed injections are written out in batches
+        if len(self.inject_queue) == 0 or (not force and len(self.inject_queue) < InjectData.flush_size):
+            return
+
         fields = ('cmd', 'obj')
         mapping = lambda obj: ('update', repr(obj))
 
         # make injection entries consecutive
         self.registry.db.lock_tables(write = ['data_injections'])
-        self.registry.db.insert_many('data_injections', fields, mapping, self.inject_queue)
-        self.registry.db.unlock_tables()
+        try:
+            self.registry.db.insert_many('data_injections', fields, mapping, self.inject_queue)
+        finally:
+            self.registry.db.unlock_tables()
+
+        self.inject_queue = []
+
+    def _finalize(self):
+        self._flush(force = True)
 
         self.message = 'Data will be injected in the regular update cycle later.'
 
@@ -1,16 +1,19 @@
 import re
 import math
 import json
+import logging
 import collections
 
 from dynamo.web.modules._base import WebModule
 from dynamo.web.modules._html import HTMLMixin
 from dynamo.web.modules._common import yesno
 import dynamo.web.exceptions as exceptions
-from dynamo.dataformat import Dataset, Site, Group
+from dynamo.dataformat import Dataset, Site, Group, Block, File, DatasetReplica, BlockReplica
 
 from _customize import customize_stats
 
+LOG = logging.getLogger(__name__)
+
 class InventoryStatCategories(object):
     """
     Just a holder for available data categorization. Specify
@@ -30,53 +33,48 @@ class InventoryStatCategories(object):
         ('group', ('Group name', Group, lambda g: g.name))
     ])
 
+    # Categories aggregated in the statistics cube. Requests constraining other categories are answered by a full scan.
+    cube_categories = ['data_type', 'dataset_status', 'dataset_software_version', 'site', 'site_status', 'group']
+
 customize_stats(InventoryStatCategories)
 
+def value_passes(value, pattern):
+    if type(pattern) is list:
+        # ORed list
+        for pat in pattern:
+            if pat is None and value is None:
+                return True
+            elif pat is not None and pat.match(value):
+                return True
+
+        # no pattern matched
+        return False
+            
+    elif pattern is None:
+        return value is None
+
+    else:
+        return pattern.match(value) is not None
+
 def passes_constraints(item, constraints):
     if len(constraints) == 0:
         return True
 
     for category, pattern in constraints.iteritems():
         valuemap = InventoryStatCategories.categories[category][2]
-        value = valuemap(item)
-
-        if type(pattern) is list:
-            # ORed list
-            match = True
-            for pat in pattern:
-                if pat is None and value is None:
-                    break
-                elif pat.match(value):
-                    break
-            else:
-                # no pattern matched
-                return False
-                
-        elif pattern is None and value is not None:
-            return False
-
-        elif not pattern.match(value):
+        if not value_passes(valuemap(item), pattern):
             return False
 
     return True
 
+def parse_constraints(request):
+    """
+    @return {category: compiled pattern, None, or list of patterns and None}
+    """
 
-def filter_and_categorize(request, inventory, counts_only = False):
-    # return {category: [(dataset_replica, [block_replica])]} or {category: [(dataset, replication)]} that match the filter
-
-    # constraints
-    dataset_constraints = {}
-    site_constraints = {}
-    group_constraints = {}
-
-    for category, (_, target, _) in InventoryStatCategories.categories.iteritems():
-        if target is Dataset:
-            constraints = dataset_constraints
-        elif target is Site:
-            constraints = site_constraints
-        elif target is Group:
-            constraints = group_constraints
+    constraints = {}
 
+    for category in InventoryStatCategories.categories.iterkeys():
         try:
             const_req = request[category]
         except KeyError:
@@ -99,10 +97,334 @@ def filter_and_categorize(request, inventory, counts_only = False):
                         else:
                             constraints[category].append(re.compile(const_str))
 
+    return constraints
+
+def get_list_by(request):
     try:
-        list_by = request['list_by'].strip()
+        return request['list_by'].strip()
     except:
-        list_by = next(cat for cat in InventoryStatCategories.categories.iterkeys())
+        return next(cat for cat in InventoryStatCategories.categories.iterkeys())
+
+
+class InventoryStatCube(object):
+    """
+    Block replica counts and sizes aggregated over the cube categories, kept up to date incrementally through
+    the inventory observer interface (see DynamoInventory.observers). The cube is built in the server process
+    when the inventory is loaded and is inherited by the forked web server processes.
+    """
+
+    # Cube of this process
+    instance = None
+
+    def __init__(self):
+        # {target class: [mapping]}
+        self.dimensions = {Dataset: [], Site: [], Group: []}
+        # {category: (target class, index in the key)}
+        self.index = {}
+
+        for category in InventoryStatCategories.cube_categories:
+            _, target, mapping = InventoryStatCategories.categories[category]
+            self.index[category] = (target, len(self.dimensions[target]))
+            self.dimensions[target].append(mapping)
+
+        # {(dataset key, site key, group key): [number of block replicas, physical size, projected size]}
+        self.cells = {}
+        # {dataset key: {number of replicas: number of datasets}}
+        self.dataset_counts = {}
+
+        self.valid = False
+
+        # names of datasets taken out of the cube in before_change, added back at the end of the batch;
+        # None if the cube is to be rebuilt
+        self._dirty = set()
+        # True between start_batch and end_batch; outside of batches each change is a batch by itself
+        self._in_batch = False
+
+    def covers(self, constraints, list_by):
+        """
+        @return True if a request with the constraints and list_by can be answered from the cube.
+        """
+        if not self.valid or list_by not in self.index:
+            return False
+
+        return all(category in self.index for category in constraints)
+
+    def sizes(self, constraints, list_by, by_site = False):
+        """
+        @param constraints  Return value of parse_constraints
+        @param list_by      Category name
+        @param by_site      If True, split the sizes by site name
+        @return {key: [physical size, projected size]} or {(site name, key): [physical size, projected size]}
+        """
+
+        passes = self._make_filter(constraints)
+        target, index = self.index[list_by]
+
+        product = {}
+
+        if target is Dataset and not by_site:
+            # categories with datasets but no matching replicas are listed too
+            for dkey in self.dataset_counts.iterkeys():
+                if passes(dkey, None, None):
+                    product.setdefault(dkey[index], [0, 0])
+
+        if by_site:
+            _, site_index = self.index['site']
+
+        for (dkey, skey, gkey), (_, physical, projected) in self.cells.iteritems():
+            if not passes(dkey, skey, gkey):
+                continue
+
+            if target is Dataset:
+                key = dkey[index]
+            elif target is Site:
+                key = skey[index]
+            else:
+                key = gkey[index]
+
+            if by_site:
+                key = (skey[site_index], key)
+
+            try:
+                sizes = product[key]
+            except KeyError:
+                sizes = product[key] = [0, 0]
+
+            sizes[0] += physical
+            sizes[1] += projected
+
+        return product
+
+    def replication(self, constraints, list_by):
+        """
+        Distribution of the number of replicas per dataset. Only possible when the list_by and all constraints
+        are dataset categories.
+        @return {key: [(number of replicas, number of datasets)]} or None
+        """
+
+        if self.index[list_by][0] is not Dataset:
+            return None
+
+        if any(self.index[category][0] is not Dataset for category in constraints):
+            return None
+
+        passes = self._make_filter(constraints)
+        _, index = self.index[list_by]
+
+        product = {}
+        for dkey, counts in self.dataset_counts.iteritems():
+            if passes(dkey, None, None):
+                product.setdefault(dkey[index], []).extend(counts.iteritems())
+
+        return product
+
+    def build(self, inventory):
+        self.cells = {}
+        self.dataset_counts = {}
+        self._dirty = set()
+
+        for dataset in inventory.datasets.itervalues():
+            self._add(dataset, 1)
+
+        self.valid = True
+
+        LOG.info('Built inventory statistics cube with %d cells.', len(self.cells))
+
+    def inventory_loaded(self, inventory):
+        self.build(inventory)
+
+    def start_batch(self, inventory):
+        self._in_batch = True
+
+    def end_batch(self, inventory):
+        self._in_batch = False
+        self._flush(inventory)
+
+    def before_change(self, inventory, obj):
+        if self._dirty is None:
+            # rebuilding anyway
+            return
+
+        if not self.valid:
+            self._dirty = None
+            return
+
+        names = self._affected_datasets(inventory, obj)
+        if names is None:
+            self._dirty = None
+            return
+
+        for name in names:
+            # the contribution of a dataset is taken out once per batch, with its state before the first change
+            if name in self._dirty:
+                continue
+
+            self._dirty.add(name)
+
+            try:
+                dataset = inventory.datasets[name]
+            except KeyError:
+                continue
+
+            self._add(dataset, -1)
+
+    def after_change(self, inventory, obj):
+        if not self._in_batch:
+            self._flush(inventory)
+
+    def _flush(self, inventory):
+        """
+        Add the datasets changed in the batch back to the cube, each aggregated once.
+        """
+
+        if not inventory.loaded:
+            return
+
+        dirty = self._dirty
+        self._dirty = set()
+
+        if dirty is None:
+            # full rebuild needed
+            self.build(inventory)
+            return
+
+        for name in dirty:
+            try:
+                dataset = inventory.datasets[name]
+            except KeyError:
+                continue
+
+            self._add(dataset, 1)
+
+    def _affected_datasets(self, inventory, obj):
+        """
+        @return Names of the datasets whose contributions can change by an update of obj, or None if the cube must be rebuilt.
+        """
+
+        if isinstance(obj, Dataset):
+            return [obj.name]
+        elif isinstance(obj, (Block, File, DatasetReplica, BlockReplica)):
+            return [obj._dataset_name()]
+        elif isinstance(obj, Site):
+            try:
+                site = inventory.sites[obj.name]
+            except KeyError:
+                return []
+
+            return [replica.dataset.name for replica in site.dataset_replicas()]
+        elif isinstance(obj, Group):
+            return None
+        else:
+            return []
+
+    def _add(self, dataset, sign):
+        dkey = tuple(mapping(dataset) for mapping in self.dimensions[Dataset])
+        group_keys = {}
+
+        num_replicas = 0
+
+        for replica in dataset.replicas:
+            if len(replica.block_replicas) == 0:
+                continue
+
+            num_replicas += 1
+
+            skey = tuple(mapping(replica.site) for mapping in self.dimensions[Site])
+
+            for block_replica in replica.block_replicas:
+                group = block_replica.group
+                try:
+                    gkey = group_keys[group]
+                except KeyError:
+                    gkey = group_keys[group] = tuple(mapping(group) for mapping in self.dimensions[Group])
+
+                key = (dkey, skey, gkey)
+                try:
+                    cell = self.cells[key]
+                except KeyError:
+                    cell = self.cells[key] = [0, 0, 0]
+
+                cell[0] += sign
+                cell[1] += sign * block_replica.size
+                cell[2] += sign * block_replica.block.size
+
+                if cell[0] == 0:
+                    self.cells.pop(key)
+
+        try:
+            counts = self.dataset_counts[dkey]
+        except KeyError:
+            counts = self.dataset_counts[dkey] = {}
+
+        counts[num_replicas] = counts.get(num_replicas, 0) + sign
+
+        if counts[num_replicas] == 0:
+            counts.pop(num_replicas)
+            if len(counts) == 0:
+                self.dataset_counts.pop(dkey)
+
+    def _make_filter(self, constraints):
+        # {target: [(index, pattern, {value: result})]}
+        tests = {Dataset: [], Site: [], Group: []}
+        for category, pattern in constraints.iteritems():
+            target, index = self.index[category]
+            tests[target].append((index, pattern, {}))
+
+        def key_passes(key, target_tests):
+            for index, pattern, memo in target_tests:
+                value = key[index]
+                try:
+                    result = memo[value]
+                except KeyError:
+                    result = memo[value] = value_passes(value, pattern)
+
+                if not result:
+                    return False
+
+            return True
+
+        def passes(dkey, skey, gkey):
+            if not key_passes(dkey, tests[Dataset]):
+                return False
+            if skey is not None and not key_passes(skey, tests[Site]):
+                return False
+            if gkey is not None and not key_passes(gkey, tests[Group]):
+                return False
+
+            return True
+
+        return passes
+
+    @staticmethod
+    def get(constraints, list_by):
+        """
+        @return The cube if it can answer the request, otherwise None.
+        """
+        cube = InventoryStatCube.instance
+        if cube is not None and cube.covers(constraints, list_by):
+            return cube
+        else:
+            return None
+
+
+def filter_and_categorize(request, inventory, counts_only = False):
+    # return {category: [(dataset_replica, [block_replica])]} or {category: [(dataset, replication)]} that match the filter
+
+    # constraints
+    dataset_constraints = {}
+    site_constraints = {}
+    group_constraints = {}
+
+    for category, pattern in parse_constraints(request).iteritems():
+        target = InventoryStatCategories.categories[category][1]
+        if target is Dataset:
+            dataset_constraints[category] = pattern
+        elif target is Site:
+            site_constraints[category] = pattern
+        elif target is Group:
+            group_constraints[category] = pattern
+
+    list_by = get_list_by(request)
 
     product = {}
 
@@ -200,12 +522,32 @@ def filter_and_categorize(request, inventory, counts_only = False):
 
 
 class TotalSizeListing(WebModule):
+    def __init__(self, config):
+        WebModule.__init__(self, config)
+
+        self.cacheable = True
+
     def run(self, caller, request, inventory):
         """
         @return {'statistic': 'size', 'content': [{key: key_name, size: size in TB}]}
         """
 
-        if yesno(request, 'physical'):
+        physical = yesno(request, 'physical')
+
+        constraints = parse_constraints(request)
+        list_by = get_list_by(request)
+
+        cube = InventoryStatCube.get(constraints, list_by)
+        if cube is not None:
+            content = []
+            for category, sizes in cube.sizes(constraints, list_by).iteritems():
+                content.append({'key': category, 'size': (sizes[0] if physical else sizes[1]) * 1.e-12})
+
+            content.sort(key = lambda x: x['size'], reverse = True)
+
+            return {'statistic': 'size', 'content': content}
+
+        if physical:
             get_size = lambda bl: sum(br.size for br in bl)
         else:
             get_size = lambda bl: sum(br.block.size for br in bl)
@@ -227,11 +569,45 @@ class TotalSizeListing(WebModule):
 
 
 class ReplicationFactorListing(WebModule):
+    def __init__(self, config):
+        WebModule.__init__(self, config)
+
+        self.cacheable = True
+
     def run(self, caller, request, inventory):
         """
         @return {'statistic': 'replication', 'content': [{key: key_name, mean: mean rep factor, rms: rms rep factor}]}
         """
 
+        constraints = parse_constraints(request)
+        list_by = get_list_by(request)
+
+        cube = InventoryStatCube.get(constraints, list_by)
+        if cube is not None:
+            dataset_counts = cube.replication(constraints, list_by)
+        else:
+            dataset_counts = None
+
+        if dataset_counts is not None:
+            content = []
+
+            for category, counts in dataset_counts.iteritems():
+                sumw = 0.
+                sumw2 = 0.
+                n = 0
+                for count, ndatasets in counts:
+                    sumw += count * ndatasets
+                    sumw2 += count * count * ndatasets
+                    n += ndatasets
+
+                mean = sumw / n
+                rms = math.sqrt(max(sumw2 / n - mean * mean, 0.))
+                content.append({'key': category, 'mean': mean, 'rms': rms})
+
+            content.sort(key = lambda x: x['mean'], reverse = True)
+
+            return {'statistic': 'replication', 'content': content}
+
         dataset_counts = filter_and_categorize(request, inventory, counts_only = True)
 
         content = []
@@ -255,12 +631,39 @@ class ReplicationFactorListing(WebModule):
 
 
 class SiteUsageListing(WebModule):
+    def __init__(self, config):
+        WebModule.__init__(self, config)
+
+        self.cacheable = True
+
     def run(self, caller, request, inventory):
         """
         @return {'statistic': 'usage', 'content': [{'site': site_name, 'usage': [{key: key_name, size: size}]}]}
         """
 
-        if yesno(request, 'physical', True):
+        physical = yesno(request, 'physical', True)
+
+        constraints = parse_constraints(request)
+        list_by = get_list_by(request)
+
+        cube = InventoryStatCube.get(constraints, list_by)
+        if cube is not None and 'site' in cube.index:
+            by_site = {} # {site name: [{key: key_name, size: size}]}
+            for (site_name, category), sizes in cube.sizes(constraints, list_by, by_site = True).iteritems():
+                by_site.setdefault(site_name, []).append({'key': category, 'size': (sizes[0] if physical else sizes[1]) * 1.e-12})
+
+            content = []
+            for site_name, site_content in by_site.iteritems():
+                site_content.sort(key = lambda x: x['size'], reverse = True)
+                content.append({'site': site_name, 'usage': site_content})
+
+            content.sort(key = lambda x: x['site'])
+
+            keys = sorted(cube.sizes(constraints, list_by).iterkeys())
+
+            return {'statistic': 'usage', 'content': content, 'keys': keys}
+
+        if physical:
             get_size = lambda bl: sum(br.size for br in bl)
         else:
             get_size = lambda bl: sum(br.block.size for br in bl)
@@ -316,6 +719,8 @@ class InventoryStats(WebModule, HTMLMixin):
 
         self.default_constraints = config.inventory.stats.default_constraints
 
+        self.cacheable = True
+
     def run(self, caller, request, inventory):
         # Parse GET and POST requests and set the defaults
         try:
@@ -114,9 +114,18 @@ class PollCopyRequest(CopyRequestBase):
         CopyRequestBase.__init__(self, config)
 
     def run(self, caller, request, inventory):
-        self.parse_input(request, inventory, ('request_id', 'item', 'site', 'status', 'user'))
+        self.parse_input(request, inventory, ('request_id', 'item', 'site', 'status', 'user', 'since'))
 
         constraints = self.make_constraints(by_id = False)
+
+        if 'since' in self.params:
+            # incremental poll; requests at the returned sequence number are returned again by the next poll
+            sequence, existing_requests, removed = self.manager.poll_requests(self.params['since'], **constraints)
+
+            self.message = '%d requests changed' % (len(existing_requests) + len(removed))
+
+            return {'sequence': sequence, 'requests': [r.to_dict() for r in existing_requests.itervalues()], 'removed': removed}
+
         existing_requests = self.manager.get_requests(**constraints)
 
         if 'item' in self.params and 'site' in self.params and \
@@ -30,7 +30,7 @@ class ParseInputMixin(object):
 
         # Pick up the values and cast them to correct types
 
-        for key in ['request_id', 'n']:
+        for key in ['request_id', 'n', 'since']:
             if key not in request:
                 continue
 
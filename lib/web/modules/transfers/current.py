@@ -28,8 +28,11 @@ class CurrentFileTransfers(WebModule):
             transfers.extend(self.rlfsm.transfer_query.get_transfer_status(batch_id))
 
         transfers_map = dict((t[0], t[1:]) for t in transfers)
-        
-        data = []
+
+        return self._make_records(current_tasks, transfers_map)
+
+    def _make_records(self, current_tasks, transfers_map):
+        # generator - records are streamed out
         for task_id, batch_id, source, destination, lfn, size in current_tasks:
             try:
                 transfer = transfers_map[task_id]
@@ -48,17 +51,15 @@ class CurrentFileTransfers(WebModule):
                 else:
                     finish = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(transfer[3]))
 
-            data.append({
-                    'id': task_id,
-                    'from': source,
-                    'to': destination,
-                    'lfn': lfn,
-                    'size': size,
-                    'status': status,
-                    'start': start,
-                    'finish': finish})
-
-        return data
+            yield {
+                'id': task_id,
+                'from': source,
+                'to': destination,
+                'lfn': lfn,
+                'size': size,
+                'status': status,
+                'start': start,
+                'finish': finish}
 
 export_data = {
     'current': CurrentFileTransfers
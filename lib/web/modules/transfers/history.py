@@ -15,6 +15,11 @@ class FileTransferHistory(WebModule):
 
         self.history = HistoryDatabase()
 
+        # Time windows are relative to the current time
+        self.cacheable = True
+        self.cache_depends = ['history']
+        self.cache_ttl = 300
+
     def run(self, caller, request, inventory):
 
         # give all the request dictionary
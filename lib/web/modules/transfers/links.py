@@ -0,0 +1,39 @@
+from dynamo.web.modules._base import WebModule
+from dynamo.fileop.rlfsm import RLFSM
+
+class FileTransferLinks(WebModule):
+    """
+    Per-link concurrency and performance metrics written by dynamo-fileopd.
+    """
+
+    def __init__(self, config):
+        WebModule.__init__(self, config)
+
+        self.rlfsm = RLFSM()
+        self.rlfsm.set_read_only(True)
+
+    def run(self, caller, request, inventory):
+        sql = 'SELECT `source_site`, `destination_site`, `concurrency`, `active`, `queued`, `throughput`, `error_rate`,'
+        sql += ' `num_done`, `num_failed`, `num_timeouts`, `last_update` FROM `standalone_transfer_links`'
+        sql += ' ORDER BY `source_site`, `destination_site`'
+
+        data = []
+        for source, destination, concurrency, active, queued, throughput, error_rate, num_done, num_failed, num_timeouts, last_update in self.rlfsm.db.xquery(sql):
+            data.append({
+                    'from': source,
+                    'to': destination,
+                    'concurrency': int(concurrency),
+                    'active': active,
+                    'queued': queued,
+                    'throughput': throughput,
+                    'error_rate': error_rate,
+                    'done': num_done,
+                    'failed': num_failed,
+                    'timeouts': num_timeouts,
+                    'last_update': last_update.strftime('%Y-%m-%d %H:%M:%S')})
+
+        return data
+
+export_data = {
+    'links': FileTransferLinks
+}
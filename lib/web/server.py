@@ -10,6 +10,8 @@ import collections
 import warnings
 import multiprocessing
 import cStringIO
+import types
+import itertools
 from cgi import parse_qs, escape
 from flup.server.fcgi_fork import WSGIServer
 
@@ -18,7 +20,11 @@ import dynamo.web.exceptions as exceptions
 # Actual modules imported at the bottom of this file
 from dynamo.web.modules import modules, load_modules
 from dynamo.web.modules._html import HTMLMixin
+from dynamo.web.modules.inventory.stats import InventoryStatCube
+from dynamo.web.cache import ResponseCache, AuthCache, JSONString, CachingStream, make_private_directory
+from dynamo.web.journal import UpdateJournal
 
+from dynamo.dataformat import Configuration
 from dynamo.utils.transform import unicode2str
 from dynamo.utils.log import reset_logger
 
@@ -66,11 +72,30 @@ class WebServer(object):
 
         # Preforked WSGI server
         # Preforking = have at minimum min_idle and at maximum max_idle child processes listening to the out-facing port.
-        # There can be at most max_procs children. Each child process is single-use to ensure changes to shared resources (e.g. inventory)
-        # made in a child process does not affect the other processes.
-        prefork_config = {'minSpare': config.get('min_idle', 1), 'maxSpare': config.get('max_idle', 5), 'maxChildren': config.get('max_procs', 10), 'maxRequests': 1}
+        # There can be at most max_procs children. Child processes (workers) serve up to max_requests requests (0 = unlimited).
+        # Long-lived workers replay the inventory updates from the update journal before each request. A worker is recycled
+        # after serving a write-enabled request, to ensure changes to the inventory made in a worker does not affect later
+        # requests, and when its private memory exceeds worker_max_memory (MB).
+        # With max_requests = 1, workers are single-use and the web server is restarted at each inventory update.
+        self.max_requests = config.get('max_requests', 0)
+        self.worker_max_memory = config.get('worker_max_memory', 2048)
+
+        prefork_config = {'minSpare': config.get('min_idle', 1), 'maxSpare': config.get('max_idle', 5), 'maxChildren': config.get('max_procs', 10), 'maxRequests': self.max_requests}
         self.wsgi_server = WSGIServer(self.main, bindAddress = config.socket, umask = 0, **prefork_config)
 
+        # Inventory updates for long-lived workers. A new journal is started at each (re)start of the web server.
+        journal_config = config.get('update_journal', Configuration())
+        self.journal_dir = journal_config.get('path', '/dev/shm/dynamo_web_updates')
+        # Restart the web server instead of appending when the journal exceeds this size (MB)
+        self.journal_max_size = journal_config.get('max_size', 256) * 1024 * 1024
+        self.journal = None
+        self._journal_serial = 0
+        # Set by the WSGI master process when it failed to replay the journal; the web server is then restarted at the next update
+        self.restart_requested = multiprocessing.Value('I', 0, lock = True)
+
+        # Set during a request when the worker should exit after the response
+        self.recycle_worker = False
+
         self.server_proc = None
 
         self.active_count = multiprocessing.Value('I', 0, lock = True)
@@ -85,15 +110,50 @@ class WebServer(object):
         # cookie string -> (user name, user id)
         self.known_users = {}
 
+        # DN -> (user name, user id, dn, authlist), shared among the web server processes
+        auth_cache_config = config.get('auth_cache', Configuration())
+        self.auth_cache = None
+        if auth_cache_config.get('enabled', True):
+            try:
+                self.auth_cache = AuthCache(auth_cache_config)
+            except OSError as ex:
+                LOG.error('Not using the authorization cache: %s', str(ex))
+
+        # Authorizer reused for all requests handled by one process
+        self._authorizer = None
+        self._authorizer_pid = 0
+
         # Log file path (start a rotating log if specified)
         self.log_path = None
 
         self.debug = config.get('debug', False)
 
+        # Streamed responses (modules returning generators) are written out in chunks of this size
+        self.stream_chunk_size = config.get('stream_chunk_size', 65536)
+
+        # Maintain the inventory statistics cube in the server process
+        self.stats_cube = config.get('stats_cube', True)
+
+        # Response cache for read-only modules, shared among the web server processes
+        cache_config = config.get('response_cache', Configuration())
+        self.response_cache = None
+        if cache_config.get('enabled', True):
+            try:
+                self.response_cache = ResponseCache(cache_config)
+            except OSError as ex:
+                LOG.error('Not using the response cache: %s', str(ex))
+
     def start(self):
         if self.server_proc and self.server_proc.is_alive():
             raise RuntimeError('Web server is already running')
 
+        if self.stats_cube:
+            # Built when the inventory is loaded and updated with the inventory; web server processes inherit it
+            InventoryStatCube.instance = InventoryStatCube()
+            self.dynamo_server.inventory.observers.append(InventoryStatCube.instance)
+
+        self.journal = self._new_journal()
+
         self.server_proc = multiprocessing.Process(target = self._serve)
         self.server_proc.daemon = True
         self.server_proc.start()
@@ -101,6 +161,13 @@ class WebServer(object):
         LOG.info('Started web server (PID %d).', self.server_proc.pid)
 
     def stop(self):
+        self._stop_server_proc()
+
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def _stop_server_proc(self):
         LOG.info('Stopping web server (PID %d).', self.server_proc.pid)
 
         self.server_proc.terminate()
@@ -133,6 +200,11 @@ class WebServer(object):
         old_active_count = self.active_count
         self.active_count = multiprocessing.Value('I', 0, lock = True)
 
+        # The new server starts from the current inventory image
+        old_journal = self.journal
+        self.journal = self._new_journal()
+        self.restart_requested.value = 0
+
         # A new WSGI server will overtake the socket. New requests will be handled by new_server_proc
         LOG.debug('Starting new web server.')
         new_server_proc = multiprocessing.Process(target = self._serve)
@@ -148,12 +220,54 @@ class WebServer(object):
             if elapsed >= 10.:
                 break
 
-        self.stop()
+        self._stop_server_proc()
+
+        if old_journal is not None:
+            old_journal.close()
 
         self.server_proc = new_server_proc
 
+        if self.response_cache is not None:
+            self.response_cache.new_inventory_version()
+
         LOG.info('Started web server (PID %d).', self.server_proc.pid)
 
+    def check_restart(self):
+        """
+        Restart the web server if the WSGI master process failed to apply the inventory updates. Workers forked from
+        the master would otherwise start from its broken inventory until the next update.
+        """
+
+        if self.server_proc is not None and self.restart_requested.value != 0:
+            LOG.warning('Web server inventory is out of sync.')
+            self.restart()
+
+    def update_inventory(self, update_commands):
+        """
+        Propagate inventory updates applied in the server process to the web server. Long-lived workers replay the
+        updates from the journal. With single-use workers or when the journal is full, the web server is restarted.
+        @param update_commands  List of (cmd, objstr)
+        """
+
+        if self.journal is None or self.journal.size() > self.journal_max_size or self.restart_requested.value != 0:
+            self.restart()
+            return
+
+        self.journal.append(update_commands)
+
+        if self.response_cache is not None:
+            self.response_cache.new_inventory_version()
+
+    def _new_journal(self):
+        if self.max_requests == 1:
+            return None
+
+        # The journal is replayed into the inventory of the workers - only this user must be able to write it
+        make_private_directory(self.journal_dir)
+
+        self._journal_serial += 1
+        return UpdateJournal('%s/%d_%d' % (self.journal_dir, os.getpid(), self._journal_serial))
+
     def _serve(self):
         if self.log_path:
             reset_logger()
@@ -193,6 +307,17 @@ class WebServer(object):
         except KeyboardInterrupt:
             os._exit(0)
 
+        if self.journal is not None:
+            # Workers are forked from this (WSGI master) process. Bring the inventory of this process up to date
+            # before each fork so that a new worker only replays the updates made after it was forked.
+            spawn_child = self.wsgi_server._spawnChild
+
+            def sync_and_spawn(sock):
+                self._sync_master_inventory()
+                return spawn_child(sock)
+
+            self.wsgi_server._spawnChild = sync_and_spawn
+
         try:
             self.wsgi_server.run()
         except SystemExit as exc:
@@ -229,6 +354,9 @@ class WebServer(object):
         sys.stdout = stream
         sys.stderr = stream
 
+        # set to True when the request bookkeeping is handed over to the response generator
+        streaming = False
+
         try:
             self.code = 200 # HTTP response code
             self.content_type = 'application/json' # content type string
@@ -236,12 +364,15 @@ class WebServer(object):
             self.callback = None # set to callback function name if this is a JSONP request
             self.message = '' # string
             self.phedex_request = '' # backward compatibility
+            self.recycle_worker = False
 
             content = self._main(environ)
 
             # Maybe we can use some standard library?
             if self.code == 200:
                 status = 'OK'
+            elif self.code == 304:
+                status = 'Not Modified'
             elif self.code == 400:
                 status = 'Bad Request'
             elif self.code == 403:
@@ -253,8 +384,18 @@ class WebServer(object):
             elif self.code == 503:
                 status = 'Service Unavailable'
 
+            if self.code == 304:
+                start_response('%d %s' % (self.code, status), self.headers)
+                return ''
+
+            streamed = is_streamed(content)
+
             if self.content_type == 'application/json':
                 if self.phedex_request != '':
+                    if type(content) is JSONString:
+                        content = json.loads(content)
+                        unicode2str(content)
+
                     if type(content) is not dict:
                         self.code == 500
                         status = 'Internal Server Error'
@@ -270,45 +411,140 @@ class WebServer(object):
                                                 'request_url': url, 'request_version': '2.2.1'}}
                         json_data['phedex'].update(content)
     
-                        content = json.dumps(json_data)
+                        if streamed:
+                            content = iterjson(json_data)
+                        else:
+                            content = json.dumps(json_data)
 
                 else:
                     json_data = {'result': status, 'message': self.message}
-                    if content is not None:
+                    if content is not None and type(content) is not JSONString:
                         json_data['data'] = content
     
                     # replace content with the json string
                     start = time.time()
-                    if self.callback is not None:
-                        content = '%s(%s)' % (self.callback, json.dumps(json_data))
+                    if streamed:
+                        content = iterjson(json_data)
+                        if self.callback is not None:
+                            content = itertools.chain(['%s(' % self.callback], content, [')'])
+
                     else:
-                        content = json.dumps(json_data)
+                        json_str = json.dumps(json_data)
+                        if type(content) is JSONString:
+                            # data is already serialized (cached response) - splice it in
+                            json_str = json_str[:-1] + ', "data": ' + content + '}'
+    
+                        if self.callback is not None:
+                            content = '%s(%s)' % (self.callback, json_str)
+                        else:
+                            content = json_str
 
-                    root_logger.info('Make JSON: %s seconds', time.time() - start)
+                        root_logger.info('Make JSON: %s seconds', time.time() - start)
 
             headers = [('Content-Type', self.content_type)] + self.headers
 
             start_response('%d %s' % (self.code, status), headers)
 
-            return content + '\n'
+            if streamed:
+                # Content is serialized and written out in chunks as the module generates the records.
+                # Request bookkeeping is done when the last chunk is sent.
+                response = self._stream(environ, content, stream, original_handler, stdout, stderr)
+                streaming = True
+                return response
+            else:
+                return content + '\n'
 
         finally:
-            sys.stdout = stdout
-            sys.stderr = stderr
+            if not streaming:
+                self._finish_request(environ, stream, original_handler, stdout, stderr)
 
-            root_logger.handlers.pop()
-            root_logger.addHandler(original_handler)
+    def _stream(self, environ, content, stream, original_handler, stdout, stderr):
+        start = time.time()
+        try:
+            for chunk in buffer_chunks(content, self.stream_chunk_size):
+                yield chunk
 
-            delim = '--------------'
-            log_tmp = stream.getvalue().strip()
-            if len(log_tmp) == 0:
-                log = 'empty log'
-            else:
-                log = 'return:\n%s\n%s%s' % (delim, ''.join('  %s\n' % line for line in log_tmp.split('\n')), delim)
+            yield '\n'
 
-            with self.active_count.get_lock():
-                LOG.info('%s-%s %s (%s:%s) %s', environ['REQUEST_SCHEME'], environ['REQUEST_METHOD'], environ['REQUEST_URI'], environ['REMOTE_ADDR'], environ['REMOTE_PORT'], log)
-                self.active_count.value -= 1
+            LOG.info('Streamed response: %s seconds', time.time() - start)
+
+        except GeneratorExit:
+            LOG.warning('Client closed the connection while the response was being streamed.')
+        except:
+            # Status and headers are already sent; the only thing we can do is to end the response.
+            # Client will see a truncated (invalid) JSON.
+            LOG.error('Exception while streaming the response:\n%s', traceback.format_exc())
+
+        finally:
+            self._finish_request(environ, stream, original_handler, stdout, stderr)
+
+    def _finish_request(self, environ, stream, original_handler, stdout, stderr):
+        sys.stdout = stdout
+        sys.stderr = stderr
+
+        root_logger = logging.getLogger()
+        root_logger.handlers.pop()
+        root_logger.addHandler(original_handler)
+
+        delim = '--------------'
+        log_tmp = stream.getvalue().strip()
+        if len(log_tmp) == 0:
+            log = 'empty log'
+        else:
+            log = 'return:\n%s\n%s%s' % (delim, ''.join('  %s\n' % line for line in log_tmp.split('\n')), delim)
+
+        with self.active_count.get_lock():
+            LOG.info('%s-%s %s (%s:%s) %s', environ['REQUEST_SCHEME'], environ['REQUEST_METHOD'], environ['REQUEST_URI'], environ['REMOTE_ADDR'], environ['REMOTE_PORT'], log)
+            self.active_count.value -= 1
+
+        if self.max_requests != 1:
+            if not self.recycle_worker and self.worker_max_memory > 0:
+                memory = private_memory()
+                if memory > self.worker_max_memory:
+                    LOG.info('Web server worker %d uses %.0f MB of private memory.', os.getpid(), memory)
+                    self.recycle_worker = True
+
+            if self.recycle_worker:
+                # The child loop of the flup prefork server exits when the request count reaches maxRequests
+                LOG.debug('Recycling web server worker %d.', os.getpid())
+                self.wsgi_server._maxRequests = 1
+
+    def _sync_master_inventory(self):
+        """
+        Replay the journal in the WSGI master process. On failure, the inventory of this process (and of all workers
+        forked from now on) is in an unknown state; the server process is asked to restart the web server, which it
+        does in its next cycle (see check_restart).
+        """
+
+        if not self.dynamo_server.inventory.loaded or self.restart_requested.value != 0:
+            return
+
+        try:
+            self._sync_inventory()
+        except:
+            LOG.error('Web server failed to apply the inventory updates: %s', str(sys.exc_info()[1]))
+            self.restart_requested.value = 1
+
+    def _sync_inventory(self):
+        """
+        Replay the inventory updates made since the last request in this process (or, in the WSGI master process,
+        since the last fork of a worker).
+        """
+
+        update_commands = self.journal.read()
+        if len(update_commands) == 0:
+            return
+
+        start = time.time()
+
+        try:
+            self.dynamo_server.inventory.replay(update_commands)
+        except:
+            # inventory of this worker is now in an unknown state
+            self.recycle_worker = True
+            raise
+
+        LOG.info('Applied %d inventory updates in %.2f seconds.', len(update_commands), time.time() - start)
 
     def _main(self, environ):
         """
@@ -330,16 +566,22 @@ class WebServer(object):
             authlist = []
 
         elif environ['REQUEST_SCHEME'] == 'https':
-            authorizer = self.dynamo_server.manager.master.create_authorizer()
+            authorizer = self._get_authorizer()
 
             # Client DN must match a known user
             try:
                 dn = WebServer.format_dn(environ['SSL_CLIENT_S_DN'])
-                userinfo = authorizer.identify_user(dn = dn, check_trunc = True)
+                if self.auth_cache is None:
+                    userinfo = authorizer.identify_user(dn = dn, check_trunc = True)
+                    if userinfo is not None:
+                        userinfo += (authorizer.list_user_auth(userinfo[0]),)
+                else:
+                    userinfo = self.auth_cache.get_user(dn, authorizer)
+
                 if userinfo is None:
                     raise exceptions.AuthorizationError()
 
-                user, user_id, dn = userinfo
+                user, user_id, dn, authlist = userinfo
 
             except exceptions.AuthorizationError:
                 self.code = 403
@@ -348,8 +590,6 @@ class WebServer(object):
             except:
                 return self._internal_server_error()
 
-            authlist = authorizer.list_user_auth(user)
-
         else:
             self.code = 400
             self.message = 'Only HTTP or HTTPS requests are allowed.'
@@ -423,6 +663,8 @@ class WebServer(object):
                 else:
                     self.dynamo_server.manager.master.start_write_web(socket.gethostname(), os.getpid())
                     # stop is called from the DynamoServer upon successful inventory update
+                    # inventory of this process will be modified
+                    self.recycle_worker = True
 
             except:
                 self.dynamo_server.manager.master.stop_write_web()
@@ -433,7 +675,7 @@ class WebServer(object):
 
         if provider.require_authorizer:
             if authorizer is None:
-                authorizer = self.dynamo_server.manager.master.create_authorizer()
+                authorizer = self._get_authorizer()
 
             provider.authorizer = authorizer
 
@@ -457,20 +699,25 @@ class WebServer(object):
                     # length -1: rely on wsgi.input having an EOF at the end
                     content_length = -1
 
-                post_data = environ['wsgi.input'].read(content_length)
+                if content_type in ('application/x-ndjson', 'application/jsonl'):
+                    # Line-delimited records are left to the module to be parsed as they arrive
+                    provider.input_stream = iterlines(environ['wsgi.input'], content_length)
 
-                # Even though our default content type is URL form, we check if this is a JSON
-                try:
-                    json_data = json.loads(post_data)
-                except:
-                    if content_type == 'application/json':
-                        self.code = 400
-                        self.message = 'Could not parse input.'
-                        return
                 else:
-                    content_type = 'application/json'
-                    provider.input_data = json_data
-                    unicode2str(provider.input_data)
+                    post_data = environ['wsgi.input'].read(content_length)
+
+                    # Even though our default content type is URL form, we check if this is a JSON
+                    try:
+                        json_data = json.loads(post_data)
+                    except:
+                        if content_type == 'application/json':
+                            self.code = 400
+                            self.message = 'Could not parse input.'
+                            return
+                    else:
+                        content_type = 'application/json'
+                        provider.input_data = json_data
+                        unicode2str(provider.input_data)
 
                 if content_type == 'application/x-www-form-urlencoded':
                     try:
@@ -478,7 +725,7 @@ class WebServer(object):
                     except:
                         self.code = 400
                         self.message = 'Could not parse input.'
-                elif content_type != 'application/json':
+                elif content_type not in ('application/json', 'application/x-ndjson', 'application/jsonl'):
                     self.code = 400
                     self.message = 'Unknown Content-Type %s.' % content_type
 
@@ -508,7 +755,35 @@ class WebServer(object):
             ## Step 5
             caller = WebServer.User(user, dn, user_id, authlist)
 
+            cache_key = None
+            if self.response_cache is not None and provider.cacheable and not provider.write_enabled:
+                cache_key = self.response_cache.make_key(environ['SCRIPT_NAME'] + environ['PATH_INFO'], request, provider)
+                etag = '"%s"' % cache_key
+
+                if etag in environ.get('HTTP_IF_NONE_MATCH', ''):
+                    self.code = 304
+                    self.headers = [('ETag', etag)]
+                    return
+
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    header, body = cached
+                    unicode2str(header)
+                    self.message = header['message']
+                    self.content_type = header['content_type']
+                    self.headers = [tuple(h) for h in header['headers']] + [('ETag', etag)]
+                    if 'callback' in request:
+                        self.callback = request['callback']
+
+                    if self.content_type == 'application/json':
+                        return JSONString(body)
+                    else:
+                        return body
+
             if self.dynamo_server.inventory.loaded:
+                if self.journal is not None:
+                    self._sync_inventory()
+
                 inventory = self.dynamo_server.inventory.create_proxy()
                 if provider.write_enabled:
                     inventory._update_commands = []
@@ -539,8 +814,36 @@ class WebServer(object):
         if 'callback' in request:
             self.callback = request['callback']
 
+        if cache_key is not None and content is not None:
+            header = {'message': self.message, 'content_type': self.content_type, 'headers': self.headers}
+
+            if is_streamed(content):
+                if self.content_type == 'application/json':
+                    if self.phedex_request == '':
+                        # cache the serialized data as it is streamed out
+                        content = CachingStream(iterjson(content), self.response_cache, cache_key, header)
+                        self.headers = self.headers + [('ETag', etag)]
+                else:
+                    content = CachingStream(content, self.response_cache, cache_key, header)
+                    self.headers = self.headers + [('ETag', etag)]
+
+            else:
+                if self.content_type == 'application/json':
+                    content = JSONString(json.dumps(content))
+
+                self.response_cache.put(cache_key, header, content)
+                self.headers = self.headers + [('ETag', etag)]
+
         return content
 
+    def _get_authorizer(self):
+        # Reuse the authorizer and its database connection within a process (but never across a fork)
+        if self._authorizer is None or self._authorizer_pid != os.getpid():
+            self._authorizer = self.dynamo_server.manager.master.create_authorizer()
+            self._authorizer_pid = os.getpid()
+
+        return self._authorizer
+
     def _internal_server_error(self):
         self.code = 500
         self.content_type = 'text/plain'
@@ -562,3 +865,111 @@ class DummyInventory(object):
     """
     def __getattr__(self, attr):
         raise exceptions.TryAgain('Dynamo server is starting. Please try again in a few moments.')
+
+
+def private_memory():
+    """
+    @return Memory used exclusively by this process (i.e. excluding pages shared with the parent after fork) in MB.
+    """
+
+    total = 0
+    try:
+        with open('/proc/self/smaps_rollup') as source:
+            for line in source:
+                if line.startswith('Private_'):
+                    total += int(line.split()[1])
+    except IOError:
+        # older kernels - fall back to the resident set size
+        with open('/proc/self/status') as source:
+            for line in source:
+                if line.startswith('VmRSS:'):
+                    total = int(line.split()[1])
+                    break
+
+    return total / 1024.
+
+def is_streamed(content):
+    """
+    @param content  Return value of a module run()
+    @return True if content is a generator or a dict containing generators.
+    """
+
+    if type(content) is types.GeneratorType or type(content) is CachingStream:
+        return True
+    elif type(content) is dict:
+        return any(is_streamed(value) for value in content.itervalues())
+    else:
+        return False
+
+def iterjson(obj):
+    """
+    Serialize obj into JSON incrementally. Generators are written out as JSON arrays of their records.
+    Records themselves are serialized with json.dumps. CachingStream is already serialized.
+    """
+
+    if type(obj) is CachingStream:
+        for chunk in obj:
+            yield chunk
+
+    elif type(obj) is types.GeneratorType:
+        yield '['
+        delim = ''
+        for record in obj:
+            yield delim + json.dumps(record)
+            delim = ', '
+        yield ']'
+
+    elif is_streamed(obj):
+        yield '{'
+        delim = ''
+        for key, value in obj.iteritems():
+            yield delim + json.dumps(key) + ': '
+            for chunk in iterjson(value):
+                yield chunk
+            delim = ', '
+        yield '}'
+
+    else:
+        yield json.dumps(obj)
+
+def iterlines(source, length = -1):
+    """
+    Iterate over the lines of a request body without reading it all in memory.
+    @param source  wsgi.input
+    @param length  CONTENT_LENGTH (-1 to read until EOF)
+    """
+
+    try:
+        remaining = int(length)
+    except (TypeError, ValueError):
+        remaining = -1
+
+    while remaining != 0:
+        if remaining > 0:
+            line = source.readline(remaining)
+            remaining -= len(line)
+        else:
+            line = source.readline()
+
+        if not line:
+            break
+
+        yield line
+
+def buffer_chunks(chunks, size):
+    """
+    Concatenate the strings from the chunks generator into blocks of at least size bytes.
+    """
+
+    buf = []
+    length = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buf)
+            buf = []
+            length = 0
+
+    if len(buf) != 0:
+        yield ''.join(buf)
@@ -0,0 +1,14 @@
+-- Add the request change sequence numbers to an existing history database.
+-- RequestManager.poll_requests selects the copy and deletion requests by change_seq, and _next_change_seq draws the
+-- numbers from the request_change_sequences table. Existing requests start at 0 and are returned only to pollers
+-- that read from the beginning; the sequences start at 1 with the first change after the migration.
+-- Run with the dynamo server stopped: mysql -D dynamohistory < change_seq.sql
+
+ALTER TABLE `copy_requests` ADD COLUMN `change_seq` bigint(20) unsigned NOT NULL DEFAULT '0' AFTER `rejection_reason`, ADD KEY `change_seq` (`change_seq`);
+ALTER TABLE `deletion_requests` ADD COLUMN `change_seq` bigint(20) unsigned NOT NULL DEFAULT '0' AFTER `rejection_reason`, ADD KEY `change_seq` (`change_seq`);
+
+CREATE TABLE IF NOT EXISTS `request_change_sequences` (
+  `optype` enum('copy','deletion') NOT NULL,
+  `value` bigint(20) unsigned NOT NULL DEFAULT '0',
+  PRIMARY KEY (`optype`)
+) ENGINE=MyISAM DEFAULT CHARSET=latin1;
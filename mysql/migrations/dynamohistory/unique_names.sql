@@ -0,0 +1,40 @@
+-- Add the UNIQUE keys on the names of the partitions and user_services tables of an existing history database.
+-- HistoryDatabase.resolve_ids relies on them to insert names concurrently without creating duplicate rows.
+-- Duplicate rows (same name, compared case-sensitively) are merged into the row with the lowest id, and the
+-- references in copy_cycles, deletion_cycles, and detox_locks are moved to that row first.
+-- Run with the dynamo server stopped: mysql -D dynamohistory < unique_names.sql
+
+CREATE TEMPORARY TABLE `partition_ids` (
+  `id` int(10) unsigned NOT NULL,
+  `new_id` int(10) unsigned NOT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=MyISAM;
+
+INSERT INTO `partition_ids`
+  SELECT p.`id`, (SELECT MIN(`id`) FROM `partitions` WHERE BINARY `name` = BINARY p.`name`) FROM `partitions` AS p;
+
+DELETE FROM `partition_ids` WHERE `id` = `new_id`;
+
+UPDATE `copy_cycles` AS c INNER JOIN `partition_ids` AS m ON m.`id` = c.`partition_id` SET c.`partition_id` = m.`new_id`;
+UPDATE `deletion_cycles` AS c INNER JOIN `partition_ids` AS m ON m.`id` = c.`partition_id` SET c.`partition_id` = m.`new_id`;
+DELETE p FROM `partitions` AS p INNER JOIN `partition_ids` AS m ON m.`id` = p.`id`;
+
+CREATE TEMPORARY TABLE `service_ids` (
+  `id` int(10) unsigned NOT NULL,
+  `new_id` int(10) unsigned NOT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=MyISAM;
+
+INSERT INTO `service_ids`
+  SELECT s.`id`, (SELECT MIN(`id`) FROM `user_services` WHERE `name` = s.`name`) FROM `user_services` AS s;
+
+DELETE FROM `service_ids` WHERE `id` = `new_id`;
+
+UPDATE `detox_locks` AS l INNER JOIN `service_ids` AS m ON m.`id` = l.`service_id` SET l.`service_id` = m.`new_id`;
+DELETE s FROM `user_services` AS s INNER JOIN `service_ids` AS m ON m.`id` = s.`id`;
+
+ALTER TABLE `partitions` MODIFY `name` varchar(128) CHARACTER SET latin1 COLLATE latin1_general_cs NOT NULL, ADD UNIQUE KEY `name` (`name`);
+ALTER TABLE `user_services` ADD UNIQUE KEY `name` (`name`);
+
+DROP TEMPORARY TABLE `partition_ids`;
+DROP TEMPORARY TABLE `service_ids`;
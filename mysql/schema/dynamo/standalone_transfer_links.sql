@@ -0,0 +1,14 @@
+CREATE TABLE `standalone_transfer_links` (
+  `source_site` varchar(32) CHARACTER SET latin1 COLLATE latin1_general_ci NOT NULL,
+  `destination_site` varchar(32) CHARACTER SET latin1 COLLATE latin1_general_ci NOT NULL,
+  `concurrency` float NOT NULL DEFAULT '0',
+  `active` int(10) unsigned NOT NULL DEFAULT '0',
+  `queued` int(10) unsigned NOT NULL DEFAULT '0',
+  `throughput` float NOT NULL DEFAULT '0',
+  `error_rate` float NOT NULL DEFAULT '0',
+  `num_done` int(10) unsigned NOT NULL DEFAULT '0',
+  `num_failed` int(10) unsigned NOT NULL DEFAULT '0',
+  `num_timeouts` int(10) unsigned NOT NULL DEFAULT '0',
+  `last_update` datetime NOT NULL,
+  PRIMARY KEY (`source_site`,`destination_site`)
+) ENGINE=MyISAM DEFAULT CHARSET=latin1 COLLATE=latin1_general_cs;
@@ -4,8 +4,10 @@ CREATE TABLE `deletion_requests` (
   `request_time` datetime NOT NULL,
   `status` enum('new','activated','completed','rejected','cancelled') NOT NULL DEFAULT 'new',
   `rejection_reason` text CHARACTER SET latin1 COLLATE latin1_general_cs,
+  `change_seq` bigint(20) unsigned NOT NULL DEFAULT '0',
   PRIMARY KEY (`id`),
   KEY `user` (`user_id`),
   KEY `request_time` (`request_time`),
-  KEY `status` (`status`)
+  KEY `status` (`status`),
+  KEY `change_seq` (`change_seq`)
 ) ENGINE=MyISAM DEFAULT CHARSET=latin1;
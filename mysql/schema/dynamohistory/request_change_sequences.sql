@@ -0,0 +1,5 @@
+CREATE TABLE `request_change_sequences` (
+  `optype` enum('copy','deletion') NOT NULL,
+  `value` bigint(20) unsigned NOT NULL DEFAULT '0',
+  PRIMARY KEY (`optype`)
+) ENGINE=MyISAM DEFAULT CHARSET=latin1;
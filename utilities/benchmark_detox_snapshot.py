@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+Compare single-site and single-dataset lookups on a detox cycle snapshot between the archived SQLite format
+(decompress the whole file, then query) and the chunked format. Both snapshot_NNNNNNNNN.db.xz and
+snapshot_NNNNNNNNN.snap must exist for the cycle (see convert_detox_snapshots.py).
+"""
+
+import os
+import sys
+import time
+import lzma
+import sqlite3
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description = 'Benchmark detox snapshot lookups.')
+
+parser.add_argument('archive', metavar = 'PATH', help = 'Snapshot archive directory.')
+parser.add_argument('cycle', metavar = 'CYCLE', type = int, help = 'Cycle number.')
+parser.add_argument('--site-id', '-s', metavar = 'ID', dest = 'site_id', type = int, help = 'Site id to look up (default: largest site).')
+parser.add_argument('--dataset-id', '-d', metavar = 'ID', dest = 'dataset_id', type = int, help = 'Dataset id to look up (default: any dataset of the site).')
+parser.add_argument('--repeat', '-r', metavar = 'N', dest = 'repeat', type = int, default = 3, help = 'Number of repetitions.')
+parser.add_argument('--tmp', '-t', metavar = 'PATH', dest = 'tmp', default = '/tmp', help = 'Directory for the decompressed SQLite file.')
+
+args = parser.parse_args()
+sys.argv = []
+
+from dynamo.detox.snapshot import SnapshotReader
+
+scycle = '%09d' % args.cycle
+base = '%s/%s/%s/snapshot_%s' % (args.archive, scycle[:3], scycle[3:6], scycle)
+
+snapshot = SnapshotReader(base + '.snap')
+
+site_id = args.site_id
+if site_id is None:
+    site_id = max(snapshot.totals.iterkeys(), key = lambda s: sum(snapshot.totals[s].itervalues()))
+
+dataset_id = args.dataset_id
+if dataset_id is None:
+    dataset_id = next(snapshot.replicas(site_id = site_id))[1]
+
+def sqlite_lookup(condition, arg):
+    sqlite_path = '%s/snapshot_%s.db.%d' % (args.tmp, scycle, os.getpid())
+    with open(base + '.db.xz', 'rb') as source:
+        with open(sqlite_path, 'wb') as out:
+            out.write(lzma.decompress(source.read()))
+
+    try:
+        db = sqlite3.connect(sqlite_path)
+        rows = db.execute('SELECT `site_id`, `dataset_id`, `size`, `decision_id`, `condition` FROM `replicas` WHERE ' + condition, (arg,)).fetchall()
+        db.close()
+    finally:
+        os.unlink(sqlite_path)
+
+    return rows
+
+def chunked_lookup(site_id = None, dataset_ids = None):
+    # open the file every time to include the footer read
+    reader = SnapshotReader(base + '.snap')
+    rows = list(reader.replicas(site_id = site_id, dataset_ids = dataset_ids))
+    return rows, reader.num_chunks_read
+
+print 'Cycle %d: %d chunks, site %d, dataset %d' % (args.cycle, len(snapshot.chunks), site_id, dataset_id)
+
+tests = [
+    ('site (sqlite)', lambda: (sqlite_lookup('`site_id` = ?', site_id), None)),
+    ('site (chunked)', lambda: chunked_lookup(site_id = site_id)),
+    ('dataset (sqlite)', lambda: (sqlite_lookup('`dataset_id` = ?', dataset_id), None)),
+    ('dataset (chunked)', lambda: chunked_lookup(dataset_ids = [dataset_id]))
+]
+
+for title, test in tests:
+    times = []
+    for _ in range(args.repeat):
+        start = time.time()
+        rows, num_chunks = test()
+        times.append(time.time() - start)
+
+    line = '%-18s %7d rows %9.3f s (best of %d)' % (title, len(rows), min(times), args.repeat)
+    if num_chunks is not None:
+        line += ' %d chunks read' % num_chunks
+
+    print line
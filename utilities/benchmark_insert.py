@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""
+Compare the throughput of the MySQL.insert_many paths (multi-row INSERT, LOAD DATA LOCAL INFILE through a
+temporary file, and LOAD DATA through a named pipe) on a synthetic table resembling the inventory files table.
+"""
+
+import sys
+import time
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description = 'Benchmark bulk insertion paths of MySQL.insert_many.')
+
+parser.add_argument('--rows', '-n', metavar = 'N', dest = 'rows', type = int, default = 1000000, help = 'Number of rows to insert.')
+parser.add_argument('--db', '-d', metavar = 'DB', dest = 'db', default = 'dynamo_tmp', help = 'Database to create the test table in.')
+parser.add_argument('--update', '-u', action = 'store_true', dest = 'update', help = 'Use ON DUPLICATE KEY UPDATE (do_update = True).')
+parser.add_argument('--repeat', '-r', metavar = 'N', dest = 'repeat', type = int, default = 1, help = 'Number of repetitions per path.')
+
+args = parser.parse_args()
+sys.argv = []
+
+from dynamo.utils.interface.mysql import MySQL
+from dynamo.dataformat import Configuration
+
+db = MySQL(Configuration(local_infile = True))
+
+table = 'insert_benchmark'
+
+sql = 'CREATE TABLE `%s`.`%s` (' % (args.db, table)
+sql += '`id` int(10) unsigned NOT NULL AUTO_INCREMENT,'
+sql += '`block_id` int(10) unsigned NOT NULL,'
+sql += '`size` bigint(20) NOT NULL,'
+sql += '`name` varchar(512) CHARACTER SET latin1 COLLATE latin1_general_cs NOT NULL,'
+sql += 'PRIMARY KEY (`id`),'
+sql += 'UNIQUE KEY `name` (`name`)'
+sql += ') ENGINE=MyISAM DEFAULT CHARSET=latin1'
+
+def rows():
+    for i in xrange(args.rows):
+        yield (i / 100 + 1, 2000000000 + i, '/store/data/Run2018A/BenchmarkDataset/AOD/v1/%06d/%032x.root' % (i / 1000, i))
+
+paths = [
+    ('INSERT', {}),
+    ('LOAD DATA (file)', {'bulk_load': True}),
+    ('LOAD DATA (pipe)', {'bulk_load': True, 'pipelined': True})
+]
+
+fields = ('block_id', 'size', 'name')
+
+print 'max_allowed_packet = %d, max_query_len = %d' % (db.query('SELECT @@max_allowed_packet')[0], db.max_query_len)
+
+try:
+    for title, options in paths:
+        for _ in range(args.repeat):
+            db.query('DROP TABLE IF EXISTS `%s`.`%s`' % (args.db, table))
+            db.query(sql)
+
+            if args.update:
+                # half of the rows already exist
+                db.insert_many(table, fields, None, (row for row in rows() if row[1] % 2 == 0), do_update = False, db = args.db)
+
+            start = time.time()
+            db.insert_many(table, fields, None, rows(), do_update = args.update, db = args.db, **options)
+            elapsed = time.time() - start
+
+            nrows = db.query('SELECT COUNT(*) FROM `%s`.`%s`' % (args.db, table))[0]
+
+            print '%-20s %9d rows %8.2f s %10.0f rows/s' % (title, nrows, elapsed, args.rows / elapsed)
+
+finally:
+    db.query('DROP TABLE IF EXISTS `%s`.`%s`' % (args.db, table))
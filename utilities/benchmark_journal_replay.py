@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Measure the inventory update replay done by a freshly forked web server worker before its first request. A synthetic
+inventory is built in memory and an update journal is filled with batches of block replica updates. Workers are
+forked (1) from a master process that never replays the journal, so that the worker replays it from the beginning,
+and (2) from a master that replays the journal before each fork, so that the worker only replays the last batch.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description = 'Benchmark the journal replay of new web server workers.')
+
+parser.add_argument('--datasets', '-n', metavar = 'N', dest = 'datasets', type = int, default = 20000, help = 'Number of datasets.')
+parser.add_argument('--batches', '-b', metavar = 'N', dest = 'batches', type = int, default = 50, help = 'Number of update batches in the journal.')
+parser.add_argument('--batch-size', '-s', metavar = 'N', dest = 'batch_size', type = int, default = 2000, help = 'Number of update commands per batch.')
+
+args = parser.parse_args()
+sys.argv = []
+
+from dynamo.core.inventory import DynamoInventory
+from dynamo.web.journal import UpdateJournal
+from dynamo.web.modules.inventory.stats import InventoryStatCube
+from dynamo.dataformat import Configuration
+import dynamo.dataformat as df
+
+class AllReplicas(object):
+    def match(self, replica):
+        return True
+
+inventory = DynamoInventory(Configuration(partition_def_path = ''))
+inventory.update(df.Partition('AllDisk', condition = AllReplicas()))
+group = inventory.update(df.Group('AnalysisOps'))
+sites = [inventory.update(df.Site('T2_XX_Site%d' % i, status = df.Site.STAT_READY)) for i in xrange(20)]
+
+block_replicas = []
+for idataset in xrange(args.datasets):
+    dataset = inventory.update(df.Dataset('/Benchmark%d/Dataset%d/AOD' % (idataset % 100, idataset), status = df.Dataset.STAT_VALID))
+    blocks = [inventory.update(df.Block(df.Block.to_internal_name('%032x' % (idataset * 4 + i)), dataset, size = 1000, num_files = 1)) for i in xrange(4)]
+    for site in (sites[idataset % 20], sites[(idataset + 7) % 20]):
+        inventory.update(df.DatasetReplica(dataset, site))
+        for block in blocks:
+            block_replicas.append(inventory.update(df.BlockReplica(block, site, group, size = 1000)))
+
+inventory.loaded = True
+
+InventoryStatCube.instance = InventoryStatCube()
+inventory.observers.append(InventoryStatCube.instance)
+InventoryStatCube.instance.build(inventory)
+
+batches = []
+for ibatch in xrange(args.batches):
+    start = (ibatch * args.batch_size) % len(block_replicas)
+    batches.append([(DynamoInventory.CMD_UPDATE, repr(r)) for r in block_replicas[start:start + args.batch_size]])
+
+print '%d datasets, %d block replicas, journal of %d batches x %d commands' % (args.datasets, len(block_replicas), args.batches, args.batch_size)
+
+def fork_worker(journal):
+    """
+    Fork a worker that replays the journal as before its first request and reports the time through a pipe.
+    """
+
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        start = time.time()
+        update_commands = journal.read()
+        inventory.replay(update_commands)
+        os.write(write_end, '%d %f' % (len(update_commands), time.time() - start))
+        os._exit(0)
+
+    os.close(write_end)
+    result = os.read(read_end, 100)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+
+    num_commands, elapsed = result.split()
+    return int(num_commands), float(elapsed)
+
+tmpdir = tempfile.mkdtemp(prefix = 'dynamo_journal_')
+
+try:
+    for title, master_replays in [('worker replays all', False), ('master replays', True)]:
+        journal = UpdateJournal(os.path.join(tmpdir, title.replace(' ', '_')))
+
+        start = time.time()
+        for batch in batches:
+            journal.append(batch)
+            if master_replays and batch is not batches[-1]:
+                # the master forked a worker after this batch
+                inventory.replay(journal.read())
+
+        master_time = time.time() - start
+
+        num_commands, elapsed = fork_worker(journal)
+
+        print '%-20s first request replays %7d commands in %7.3f s (master spent %.3f s in total)' % (title, num_commands, elapsed, master_time)
+
+        journal.close()
+
+finally:
+    shutil.rmtree(tmpdir, ignore_errors = True)
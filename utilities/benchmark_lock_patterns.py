@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+Compare matching of wildcard dataset lock patterns against dataset names one regex at a time (the former
+MySQLReplicaLock behavior) and with LockPatternMatcher. Dataset names and lock patterns are generated synthetically;
+the matched (pattern, dataset) pairs of the two methods are checked to be identical.
+"""
+
+import sys
+import time
+import re
+import fnmatch
+import random
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description = 'Benchmark dataset lock pattern matching.')
+
+parser.add_argument('--datasets', '-n', metavar = 'N', dest = 'datasets', type = int, default = 20000, help = 'Number of dataset names.')
+parser.add_argument('--locks', '-l', metavar = 'N', dest = 'locks', type = int, default = 2000, help = 'Number of wildcard lock patterns.')
+parser.add_argument('--seed', '-s', metavar = 'N', dest = 'seed', type = int, default = 1, help = 'Random seed.')
+
+args = parser.parse_args()
+sys.argv = []
+
+from dynamo.policy.producers.mysqllock import LockPatternMatcher
+
+random.seed(args.seed)
+
+primaries = ['Primary%d_TuneX_13TeV' % i for i in xrange(max(args.datasets / 20, 1))]
+campaigns = ['Campaign%d' % i for i in xrange(20)]
+tiers = ['AOD', 'AODSIM', 'MINIAOD', 'MINIAODSIM', 'NANOAOD', 'RAW', 'RECO']
+
+names = set()
+while len(names) < args.datasets:
+    names.add('/%s/%s-v%d/%s' % (random.choice(primaries), random.choice(campaigns), random.randint(1, 3), random.choice(tiers)))
+
+names = list(names)
+
+def make_pattern():
+    primary, processed, tier = names[random.randrange(len(names))][1:].split('/')
+    choice = random.random()
+    if choice < 0.6:
+        return '/%s/*/%s' % (primary, tier)
+    elif choice < 0.8:
+        return '/%s*/%s/*' % (primary[:len(primary) / 2], processed)
+    elif choice < 0.95:
+        return '/%s/%s*/*' % (primary, processed[:-3])
+    else:
+        return '/*/%s/%s' % (processed, tier)
+
+patterns = set()
+while len(patterns) < args.locks:
+    patterns.add(make_pattern())
+
+print '%d dataset names, %d lock patterns' % (len(names), len(patterns))
+
+def per_pattern():
+    matched = set()
+    for pattern in patterns:
+        pat_exp = re.compile(fnmatch.translate(pattern))
+        for name in names:
+            if pat_exp.match(name):
+                matched.add((pattern, name))
+
+    return matched
+
+def compiled():
+    matched = set()
+    for name in names:
+        for pattern in matcher.match(name):
+            matched.add((pattern, name))
+
+    return matched
+
+start = time.time()
+matcher = LockPatternMatcher(patterns)
+print '%-12s %8.2f s' % ('compile', time.time() - start)
+
+results = []
+for title, match in [('compiled', compiled), ('per_pattern', per_pattern)]:
+    start = time.time()
+    matched = match()
+    elapsed = time.time() - start
+
+    print '%-12s %8.2f s %9d matches %12.0f names/s' % (title, elapsed, len(matched), len(names) / elapsed)
+    results.append(matched)
+
+if results[0] != results[1]:
+    print 'Results differ!'
+    sys.exit(1)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""
+Compare per-request (CopyRequestManager.update_request) and bulk (update_requests) bookkeeping of copy requests on a
+synthetic request registry. Registry and history tables are created from the schema files in scratch databases,
+filled with activated requests, and every action of every request is updated once per path.
+"""
+
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description = 'Benchmark copy request bookkeeping.')
+
+parser.add_argument('--requests', '-n', metavar = 'N', dest = 'requests', type = int, default = 5000, help = 'Number of activated requests.')
+parser.add_argument('--actions', '-a', metavar = 'N', dest = 'actions', type = int, default = 4, help = 'Number of actions per request.')
+parser.add_argument('--db', '-d', metavar = 'DB', dest = 'db', default = 'dynamo_tmp', help = 'Prefix of the scratch databases (DB_registry and DB_history are created).')
+parser.add_argument('--schema', '-s', metavar = 'PATH', dest = 'schema', default = os.path.dirname(os.path.realpath(__file__)) + '/../mysql/schema', help = 'Schema directory.')
+
+args = parser.parse_args()
+sys.argv = []
+
+from dynamo.utils.interface.mysql import MySQL
+from dynamo.dataformat import Configuration
+from dynamo.dataformat.request import Request, RequestAction
+from dynamo.request.copy import CopyRequestManager
+
+db = MySQL()
+
+registry_db = args.db + '_registry'
+history_db = args.db + '_history'
+
+tables = [
+    (registry_db, 'dynamoregister', ['copy_requests', 'active_copies', 'copy_request_items', 'copy_request_sites']),
+    (history_db, 'dynamohistory', ['copy_requests', 'groups', 'request_change_sequences'])
+]
+
+def make_databases():
+    for db_name, schema, table_names in tables:
+        db.query('DROP DATABASE IF EXISTS `%s`' % db_name)
+        db.query('CREATE DATABASE `%s`' % db_name)
+        for table in table_names:
+            with open('%s/%s/%s.sql' % (args.schema, schema, table)) as source:
+                db.query(source.read().replace('CREATE TABLE `', 'CREATE TABLE `%s`.`' % db_name, 1))
+
+    now = time.strftime('%Y-%m-%d %H:%M:%S')
+    groups = ['group%d' % i for i in range(10)]
+
+    db.insert_many('groups', ('name',), MySQL.make_tuple, groups, db = history_db)
+
+    mapping = lambda i: (i, groups[i % 10], 1, 'user%d' % (i % 100), now, now, 'activated')
+    fields = ('id', 'group', 'num_copies', 'user', 'first_request_time', 'last_request_time', 'status')
+    db.insert_many('copy_requests', fields, mapping, xrange(1, args.requests + 1), db = registry_db)
+
+    mapping = lambda i: (i, i % 10 + 1, 1, i % 100 + 1, now, 'activated')
+    fields = ('id', 'group_id', 'num_copies', 'user_id', 'request_time', 'status')
+    db.insert_many('copy_requests', fields, mapping, xrange(1, args.requests + 1), db = history_db)
+
+    def actions():
+        for i in xrange(1, args.requests + 1):
+            for j in xrange(args.actions):
+                yield (i, '/Benchmark%d/Dataset%d/AOD#%08x' % (i % 1000, j, i), 'T2_XX_Site%d' % (j % 50), 'new', now, now)
+
+    fields = ('request_id', 'item', 'site', 'status', 'created', 'updated')
+    db.insert_many('active_copies', fields, None, actions(), db = registry_db)
+
+params = db.config()
+params.pop('db', None)
+
+registry_params = Configuration(params)
+registry_params['db'] = registry_db
+history_params = Configuration(params)
+history_params['db'] = history_db
+
+manager = CopyRequestManager(Configuration({'registry': {'db_params': registry_params}, 'history': {'db_params': history_params}}))
+
+paths = [
+    ('update_request', lambda requests: [manager.update_request(r) for r in requests]),
+    ('update_requests', manager.update_requests)
+]
+
+try:
+    for title, update in paths:
+        make_databases()
+
+        manager.lock()
+        requests = manager.get_requests(statuses = [Request.ST_ACTIVATED]).values()
+
+        for request in requests:
+            for action in request.actions:
+                action.status = RequestAction.ST_QUEUED
+            # one in ten requests completes
+            if request.request_id % 10 == 0:
+                request.status = Request.ST_COMPLETED
+
+        start = time.time()
+        update(requests)
+        elapsed = time.time() - start
+
+        manager.unlock()
+
+        num_queued = db.query('SELECT COUNT(*) FROM `%s`.`active_copies` WHERE `status` = \'queued\'' % registry_db)[0]
+
+        print '%-16s %6d requests %8d queued actions %8.2f s %9.0f requests/s' % (title, len(requests), num_queued, elapsed, len(requests) / elapsed)
+
+finally:
+    for db_name, _, _ in tables:
+        db.query('DROP DATABASE IF EXISTS `%s`' % db_name)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+Measure the throughput (requests/s) and latency percentiles of the web server for a set of URLs. Run once with
+max_requests = 1 (single-use workers) and once with long-lived workers to compare.
+"""
+
+import sys
+import time
+import threading
+import urllib2
+import ssl
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description = 'Benchmark the Dynamo web server.')
+
+parser.add_argument('urls', metavar = 'URL', nargs = '+', help = 'URLs to request (cycled through).')
+parser.add_argument('--requests', '-n', metavar = 'N', dest = 'requests', type = int, default = 1000, help = 'Total number of requests.')
+parser.add_argument('--concurrency', '-c', metavar = 'N', dest = 'concurrency', type = int, default = 10, help = 'Number of concurrent clients.')
+parser.add_argument('--cert', metavar = 'PATH', dest = 'cert', help = 'Client certificate for HTTPS.')
+parser.add_argument('--key', metavar = 'PATH', dest = 'key', help = 'Client certificate key for HTTPS.')
+parser.add_argument('--label', '-l', metavar = 'TEXT', dest = 'label', default = '', help = 'Label printed with the results.')
+
+args = parser.parse_args()
+sys.argv = []
+
+if args.cert:
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.load_cert_chain(args.cert, args.key)
+    opener = urllib2.build_opener(urllib2.HTTPSHandler(context = context))
+else:
+    opener = urllib2.build_opener()
+
+latencies = []
+errors = [0]
+lock = threading.Lock()
+counter = iter(xrange(args.requests))
+
+def client():
+    while True:
+        with lock:
+            try:
+                irequest = counter.next()
+            except StopIteration:
+                return
+
+        url = args.urls[irequest % len(args.urls)]
+
+        start = time.time()
+        try:
+            response = opener.open(url)
+            response.read()
+            response.close()
+        except:
+            with lock:
+                errors[0] += 1
+            continue
+
+        elapsed = time.time() - start
+        with lock:
+            latencies.append(elapsed)
+
+start = time.time()
+
+threads = [threading.Thread(target = client) for _ in range(args.concurrency)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+
+wall_time = time.time() - start
+
+if len(latencies) == 0:
+    print 'All %d requests failed.' % errors[0]
+    sys.exit(1)
+
+latencies.sort()
+
+def percentile(p):
+    return latencies[min(int(len(latencies) * p / 100.), len(latencies) - 1)]
+
+if args.label:
+    print args.label
+
+print '%d requests (%d errors) with %d clients in %.2f s' % (args.requests, errors[0], args.concurrency, wall_time)
+print '  throughput   %8.1f requests/s' % (len(latencies) / wall_time)
+print '  latency mean %8.1f ms' % (sum(latencies) / len(latencies) * 1000.)
+print '  latency p50  %8.1f ms' % (percentile(50) * 1000.)
+print '  latency p99  %8.1f ms' % (percentile(99) * 1000.)
+print '  latency max  %8.1f ms' % (latencies[-1] * 1000.)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+Convert archived detox cycle snapshots (lzma-compressed SQLite files snapshot_NNNNNNNNN.db.xz) into the chunked
+snapshot format (snapshot_NNNNNNNNN.snap) readable without decompressing the full file.
+"""
+
+import os
+import sys
+import re
+import time
+import lzma
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description = 'Convert archived detox snapshots to the chunked format.')
+
+parser.add_argument('archive', metavar = 'PATH', help = 'Snapshot archive directory (snapshots_archive_dir of DetoxHistory).')
+parser.add_argument('--cycles', '-c', metavar = 'ID', dest = 'cycles', nargs = '+', type = int, help = 'Convert only these cycles.')
+parser.add_argument('--tmp', '-t', metavar = 'PATH', dest = 'tmp', default = '/tmp', help = 'Directory for the decompressed SQLite files.')
+parser.add_argument('--rows-per-chunk', '-n', metavar = 'N', dest = 'rows_per_chunk', type = int, default = 8192, help = 'Number of replica rows per chunk.')
+parser.add_argument('--overwrite', '-o', action = 'store_true', dest = 'overwrite', help = 'Convert even if the chunked snapshot exists.')
+parser.add_argument('--remove', '-R', action = 'store_true', dest = 'remove', help = 'Remove the .db.xz file after conversion.')
+
+args = parser.parse_args()
+sys.argv = []
+
+from dynamo.detox.snapshot import convert_sqlite_snapshot, SnapshotReader
+
+pattern = re.compile('snapshot_([0-9]{9}).db.xz$')
+
+for dirpath, dirnames, filenames in os.walk(args.archive):
+    dirnames.sort()
+
+    for filename in sorted(filenames):
+        matches = pattern.match(filename)
+        if not matches:
+            continue
+
+        cycle_number = int(matches.group(1))
+        if args.cycles and cycle_number not in args.cycles:
+            continue
+
+        xz_path = os.path.join(dirpath, filename)
+        snap_path = os.path.join(dirpath, 'snapshot_%09d.snap' % cycle_number)
+
+        if os.path.exists(snap_path) and not args.overwrite:
+            print 'Skipping cycle %d (already converted)' % cycle_number
+            continue
+
+        start = time.time()
+
+        sqlite_path = '%s/snapshot_%09d.db.%d' % (args.tmp, cycle_number, os.getpid())
+        with open(xz_path, 'rb') as source:
+            with open(sqlite_path, 'wb') as out:
+                out.write(lzma.decompress(source.read()))
+
+        try:
+            convert_sqlite_snapshot(sqlite_path, snap_path, rows_per_chunk = args.rows_per_chunk)
+        finally:
+            os.unlink(sqlite_path)
+
+        # make sure the new file is readable
+        num_chunks = len(SnapshotReader(snap_path).chunks)
+
+        print 'Converted cycle %d: %d chunks, %.1f -> %.1f MB in %.1f s' % \
+            (cycle_number, num_chunks, os.path.getsize(xz_path) * 1.e-6, os.path.getsize(snap_path) * 1.e-6, time.time() - start)
+
+        if args.remove:
+            os.unlink(xz_path)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+Replay the file transfer history and estimate the gain of throughput-aware source selection
+(RLFSM source_selection = 'throughput') over uniform random selection.
+The link performance model is trained online on the replayed records, so each decision only
+uses the history preceding it. Candidate sources of a file are all sites the file was transferred
+from in the replay window. Link load at the time of the historical transfers is not known and is
+not taken into account.
+"""
+
+import sys
+import time
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description = 'Estimate the gain of throughput-aware transfer source selection from history.')
+
+parser.add_argument('--days', '-d', metavar = 'DAYS', dest = 'days', type = float, default = 7., help = 'Number of days to replay.')
+parser.add_argument('--halflife', '-l', metavar = 'SECONDS', dest = 'halflife', type = float, default = 86400., help = 'Half-life of the link statistics.')
+parser.add_argument('--destination', '-s', metavar = 'SITE', dest = 'destination', help = 'Limit to transfers to this site.')
+
+args = parser.parse_args()
+sys.argv = []
+
+from dynamo.dataformat import Configuration
+from dynamo.history.history import HistoryDatabase
+from dynamo.fileop.linkperformance import LinkPerformance
+
+history_db = HistoryDatabase()
+
+model = LinkPerformance(Configuration(halflife = args.halflife))
+# history is fed record by record below
+model.loaded = True
+
+sql_base = ' FROM `file_transfers` AS t'
+sql_base += ' INNER JOIN `files` AS f ON f.`id` = t.`file_id`'
+sql_base += ' INNER JOIN `sites` AS ss ON ss.`id` = t.`source_id`'
+sql_base += ' INNER JOIN `sites` AS sd ON sd.`id` = t.`destination_id`'
+sql_base += ' WHERE t.`completed` > FROM_UNIXTIME(%s)'
+
+sql_args = (int(time.time() - args.days * 86400.),)
+if args.destination:
+    sql_base += ' AND sd.`name` = %s'
+    sql_args += (args.destination,)
+
+# Candidate sources per file
+candidates = {}
+sql = 'SELECT t.`file_id`, ss.`name`' + sql_base
+for file_id, source in history_db.db.xquery(sql, *sql_args):
+    try:
+        candidates[file_id].add(source)
+    except KeyError:
+        candidates[file_id] = set([source])
+
+num_records = 0
+num_decisions = 0
+time_actual = 0.
+time_random = 0.
+time_weighted = 0.
+time_best = 0.
+
+sql = 'SELECT t.`file_id`, f.`size`, ss.`name`, sd.`name`, t.`exitcode`, UNIX_TIMESTAMP(t.`started`), UNIX_TIMESTAMP(t.`finished`), UNIX_TIMESTAMP(t.`completed`)'
+sql += sql_base
+sql += ' ORDER BY t.`completed`'
+
+for file_id, size, source, destination, exitcode, started, finished, completed in history_db.db.xquery(sql, *sql_args):
+    num_records += 1
+
+    sources = sorted(candidates[file_id] - set([destination]))
+    if len(sources) > 1:
+        num_decisions += 1
+
+        times = [model.expected_time(s, destination, size, now = completed) for s in sources]
+        weights = [1. / t for t in times]
+
+        time_actual += model.expected_time(source, destination, size, now = completed)
+        time_random += sum(times) / len(times)
+        time_weighted += sum(w * t for w, t in zip(weights, times)) / sum(weights)
+        time_best += min(times)
+
+    model.update(source, destination, size, exitcode, started, finished, timestamp = completed)
+
+print 'Replayed %d transfers, %d with more than one candidate source.' % (num_records, num_decisions)
+
+if num_decisions == 0:
+    sys.exit(0)
+
+print 'Estimated total transfer time (hours) of the transfers with a choice:'
+print '  historical selection: %.1f' % (time_actual / 3600.)
+print '  uniform random:       %.1f' % (time_random / 3600.)
+print '  throughput-weighted:  %.1f (%.1f%% gain over random)' % (time_weighted / 3600., (1. - time_weighted / time_random) * 100.)
+print '  best link only:       %.1f (%.1f%% gain over random)' % (time_best / 3600., (1. - time_best / time_random) * 100.)
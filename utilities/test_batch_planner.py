@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+Test BatchPlanner with simulated transfer tasks and a simulated backend in which a batch is released only when its
+slowest file is done. Checks the batch constraints (single link, batch_size, max_batch_duration, size classes), the
+per-link and total task limits, and compares the time tasks are held by their batch against batching by link only.
+Exits with status 1 if any check fails.
+"""
+
+import sys
+import bisect
+import random
+import collections
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description = 'Test the transfer batch planner with a simulated backend.')
+
+parser.add_argument('--tasks', '-n', metavar = 'N', dest = 'tasks', type = int, default = 5000, help = 'Number of transfer tasks.')
+parser.add_argument('--links', '-l', metavar = 'N', dest = 'links', type = int, default = 12, help = 'Number of links.')
+parser.add_argument('--seed', '-s', metavar = 'N', dest = 'seed', type = int, default = 1, help = 'Random seed.')
+
+args = parser.parse_args()
+sys.argv = []
+
+from dynamo.fileop.batchplanner import BatchPlanner
+from dynamo.dataformat import Configuration
+
+random.seed(args.seed)
+
+# The planner only looks at task.source.name, task.subscription.destination.name, and task.subscription.file.size
+SimSite = collections.namedtuple('SimSite', ['name'])
+SimFile = collections.namedtuple('SimFile', ['lfn', 'size'])
+SimSubscription = collections.namedtuple('SimSubscription', ['file', 'destination'])
+SimTask = collections.namedtuple('SimTask', ['id', 'source', 'subscription'])
+
+class SimLinkPerformance(object):
+    def __init__(self, throughputs):
+        self.throughputs = throughputs
+
+    def throughput(self, source, destination):
+        return self.throughputs[(source, destination)]
+
+class SimBackend(object):
+    """
+    Runs each batch as one job in which all files are transferred in parallel at the link throughput. The tasks of a
+    batch are released together when the slowest file is done.
+    """
+
+    def __init__(self, performance):
+        self.performance = performance
+
+    def hold_time(self, batches):
+        """
+        @return Total time (s) tasks wait for the other files of their batch.
+        """
+        total = 0.
+        for batch in batches:
+            throughput = self.performance.throughput(batch[0].source.name, batch[0].subscription.destination.name)
+            durations = [task.subscription.file.size / throughput for task in batch]
+            longest = max(durations)
+            total += sum(longest - d for d in durations)
+
+        return total
+
+def make_tasks(num_tasks, links):
+    tasks = []
+    for itask in xrange(num_tasks):
+        source, destination = random.choice(links)
+        # log-uniform sizes between 1 MB and 50 GB
+        size = int(10. ** random.uniform(6., 10.7))
+        sfile = SimFile('/store/file%d' % itask, size)
+        tasks.append(SimTask(itask, SimSite(source), SimSubscription(sfile, SimSite(destination))))
+
+    return tasks
+
+def link_of(task):
+    return (task.source.name, task.subscription.destination.name)
+
+failures = []
+
+def check(title, condition):
+    print '%-60s %s' % (title, 'OK' if condition else 'FAILED')
+    if not condition:
+        failures.append(title)
+
+sites = ['T2_SITE_%d' % i for i in range(args.links)]
+links = [(sites[i], sites[(i + 1) % len(sites)]) for i in range(args.links)]
+performance = SimLinkPerformance(dict((link, 10. ** random.uniform(6.5, 8.5)) for link in links))
+backend = SimBackend(performance)
+
+tasks = make_tasks(args.tasks, links)
+
+## Batch constraints
+
+config = Configuration(batch_size = 50, max_batch_duration = 3600)
+planner = BatchPlanner(config)
+planner.link_performance = performance
+
+batches = planner.plan(tasks)
+planned = [task.id for batch in batches for task in batch]
+
+check('All tasks planned exactly once', sorted(planned) == range(args.tasks))
+check('One link per batch', all(len(set(link_of(t) for t in batch)) == 1 for batch in batches))
+check('Batches within batch_size', all(len(batch) <= config.batch_size for batch in batches))
+
+def duration(batch):
+    return sum(t.subscription.file.size / performance.throughput(*link_of(t)) for t in batch)
+
+# a single file longer than the limit forms its own batch
+check('Batches within max_batch_duration', all(len(batch) == 1 or duration(batch) <= config.max_batch_duration for batch in batches))
+
+def size_class(task):
+    return bisect.bisect_left(planner.size_classes, task.subscription.file.size)
+
+check('One file size class per batch', all(len(set(size_class(t) for t in batch)) == 1 for batch in batches))
+
+## Per-link limit
+
+config = Configuration(batch_size = 50, max_link_tasks = 100)
+planner = BatchPlanner(config)
+
+link_load = {links[0]: 100, links[1]: 60}
+batches = planner.plan(tasks, link_load = link_load)
+
+per_link = collections.Counter(link_of(t) for batch in batches for t in batch)
+available = collections.Counter(link_of(t) for t in tasks)
+
+check('Saturated link gets no tasks', per_link[links[0]] == 0)
+check('Partially loaded link filled up to max_link_tasks', per_link[links[1]] == min(40, available[links[1]]))
+check('Other links capped at max_link_tasks', all(per_link[l] == min(100, available[l]) for l in links[2:]))
+
+## Total limit (max_pending_transfers headroom)
+
+config = Configuration(batch_size = 50)
+planner = BatchPlanner(config)
+
+max_tasks = 20 * args.links
+batches = planner.plan(tasks, max_tasks = max_tasks)
+planned_links = set(link_of(t) for batch in batches for t in batch)
+
+check('Total number of tasks within max_tasks', sum(len(batch) for batch in batches) == max_tasks)
+check('No link starved by max_tasks', planned_links == set(links))
+
+per_link = collections.Counter(link_of(t) for batch in batches for t in batch)
+check('max_tasks shared evenly among links', max(per_link.values()) - min(per_link.values()) <= 1)
+
+## Simulated backend: time tasks are held by slower files of their batch
+
+config = Configuration(batch_size = 50)
+planner = BatchPlanner(config)
+planner.link_performance = performance
+
+planned_hold = backend.hold_time(planner.plan(tasks))
+
+# batching by link only, in order of arrival, as before the planner
+by_link = collections.defaultdict(list)
+for task in tasks:
+    by_link[link_of(task)].append(task)
+
+naive_batches = []
+for link_tasks in by_link.itervalues():
+    for i in xrange(0, len(link_tasks), config.batch_size):
+        naive_batches.append(link_tasks[i:i + config.batch_size])
+
+naive_hold = backend.hold_time(naive_batches)
+
+print 'Total hold time: %.3g s planned, %.3g s by link only' % (planned_hold, naive_hold)
+check('Hold time at most a tenth of batching by link only', planned_hold < 0.1 * naive_hold)
+
+if len(failures) != 0:
+    sys.exit(1)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+Check Site.FileNameMapping (combined first-step regex and per-directory cache) against a plain step-by-step
+evaluation of the chains, on randomly generated rules and LFNs. Exits with status 1 if any mapping differs.
+"""
+
+import sys
+import re
+import random
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description = 'Test LFN to PFN mapping against a plain evaluation of the chains.')
+
+parser.add_argument('--trials', '-n', metavar = 'N', dest = 'trials', type = int, default = 200, help = 'Number of random rule sets.')
+parser.add_argument('--lfns', '-l', metavar = 'N', dest = 'lfns', type = int, default = 500, help = 'Number of LFNs per rule set.')
+parser.add_argument('--seed', '-s', metavar = 'N', dest = 'seed', type = int, default = 1, help = 'Random seed.')
+
+args = parser.parse_args()
+sys.argv = []
+
+from dynamo.dataformat import Site
+
+random.seed(args.seed)
+
+directories = ['/store/data/', '/store/mc/', '/store/user/', '/store/data/Run2017/', '/store/mc/RunII/AOD/', '/a/', '/x/store/']
+basenames = ['file.root', 'a', 'None', 'b|c.root', 'x.txt', 'store', '', 'f-1.root']
+
+# (lfn pattern, pfn replacement); separable and non-separable steps
+first_steps = [
+    ('/store/(.*)', 'root://host//data/{0}'),
+    ('/store/data/(.*)$', 'root://host//disk/{0}'),
+    ('/store/(mc|data)/(.*)', 'gsiftp://se/{0}/{1}'),
+    ('/(.*)/(.*)', '/pnfs/{0}/{1}'),
+    ('a|/store/(.*)', 'x{0}'),
+    ('/a/|/store/(.*)', 'y{0}'),
+    ('(?:/x|/a)/(.*)', '/mnt/{0}'),
+    ('/store/[^|/]+/(.*)', '/sub/{0}'),
+    ('/store/(.*)\\.root', '/root/{0}.root'),
+    ('/store/(.*)', '/dup/{0}/{0}'),
+    ('(.*)', 'file://{0}'),
+    ('/x/(.*)', 'srm://se?SFN=/x/{0}')
+]
+
+next_steps = [
+    ('root://host//(.*)', 'root://redirector//{0}'),
+    ('(.*)', '{0}'),
+    ('/pnfs/(.*)', 'dcap://door/pnfs/{0}'),
+    ('x(.*)', 'z{0}'),
+    ('(.*)/(.*)', '{0}/store/{1}')
+]
+
+def plain_map(chains, lfn):
+    for chain in chains:
+        source = lfn
+        for lfnpat, pfnpat in chain:
+            matches = re.match(lfnpat, source)
+            if matches is None:
+                source = None
+                break
+
+            source = pfnpat.format(*matches.groups())
+
+        if source is not None:
+            return source
+
+    return None
+
+def make_chains():
+    chains = []
+    # more than 99 groups in the first steps disables the combined regex
+    for _ in xrange(random.choice([1, 2, 3, 5, 60])):
+        chain = [random.choice(first_steps)]
+        for _ in xrange(random.randint(0, 2)):
+            chain.append(random.choice(next_steps))
+
+        chains.append(chain)
+
+    return chains
+
+num_checked = 0
+num_failed = 0
+num_cached = 0
+
+for trial in xrange(args.trials):
+    chains = make_chains()
+    mapping = Site.FileNameMapping(chains)
+    if mapping._use_cache:
+        num_cached += 1
+
+    for _ in xrange(args.lfns):
+        lfn = random.choice(directories) + ''.join(random.choice(directories)[1:] for _ in xrange(random.randint(0, 2))) + random.choice(basenames)
+
+        expected = plain_map(chains, lfn)
+        result = mapping.map(lfn)
+        num_checked += 1
+
+        if result != expected:
+            num_failed += 1
+            if num_failed <= 10:
+                print 'Mismatch for %s with %s: %s != %s' % (lfn, chains, result, expected)
+
+print '%d rule sets (%d cached), %d LFNs checked, %d mismatches' % (args.trials, num_cached, num_checked, num_failed)
+
+if num_failed != 0:
+    sys.exit(1)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+"""
+Test the FTS job status polling of FTSFileOperation against a mock FTS REST server. The FTS bookkeeping tables are
+created from the schema files in a scratch database and filled as if the jobs had been submitted. Checks the
+statuses reported per task, the bound on concurrent status queries, that the FTS sessions are pooled, and that jobs
+found in a final state are not queried again. Requires the FTS REST client (fts3) and a MySQL server.
+Exits with status 1 if any check fails.
+"""
+
+import os
+import sys
+import re
+import time
+import json
+import logging
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description = 'Test FTS job status polling against a mock FTS server.')
+
+parser.add_argument('--jobs', '-n', metavar = 'N', dest = 'jobs', type = int, default = 40, help = 'Number of transfer jobs.')
+parser.add_argument('--files', '-f', metavar = 'N', dest = 'files', type = int, default = 4, help = 'Number of files per job.')
+parser.add_argument('--db', '-d', metavar = 'DB', dest = 'db', default = 'dynamo_tmp_fts', help = 'Scratch database.')
+parser.add_argument('--x509', '-x', metavar = 'PATH', dest = 'x509', help = 'X509 proxy passed to the FTS client.')
+parser.add_argument('--schema', '-s', metavar = 'PATH', dest = 'schema', default = os.path.dirname(os.path.realpath(__file__)) + '/../mysql/schema', help = 'Schema directory.')
+
+args = parser.parse_args()
+sys.argv = []
+
+logging.basicConfig(level = logging.CRITICAL)
+
+from dynamo.utils.interface.mysql import MySQL
+from dynamo.dataformat import Configuration
+from dynamo.fileop.base import FileQuery
+from dynamo.fileop.impl.fts import FTSFileOperation
+
+FINAL_STATES = ('FINISHED', 'FINISHEDDIRTY', 'FAILED', 'CANCELED')
+
+class MockFTSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves the subset of the FTS REST API used by the client: endpoint information, job status, file and data
+    management listings of a job, and the bulk job listing (/jobs/id1,id2?files=...).
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), MockFTSHandler)
+        self.lock = threading.Lock()
+        # {job_id: {'job_id':, 'job_state':, 'files': [], 'dm': []}}
+        self.jobs = {}
+        # {job_id: number of single-job status queries}
+        self.job_queries = {}
+        self.num_bulk_queries = 0
+        self.num_contexts = 0
+        self.active = 0
+        self.max_active = 0
+        self.delay = 0.05
+
+        thread = threading.Thread(target = self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        pass
+
+class MockFTSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+
+        try:
+            time.sleep(server.delay)
+            self._get()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _get(self):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        path = url.path.rstrip('/')
+
+        if path in ('', '/whoami'):
+            if path == '':
+                # endpoint information is requested once per client context
+                with server.lock:
+                    server.num_contexts += 1
+
+            self._respond({'api': {'major': 3, 'minor': 7, 'patch': 0}, 'schema': {'major': 1, 'minor': 0, 'patch': 0},
+                'delegation': {'major': 1, 'minor': 0, 'patch': 0}, 'core': {'major': 3, 'minor': 7, 'patch': 0},
+                'user_dn': '/CN=test', 'dn': ['/CN=test'], 'delegation_id': 'test', 'vos': [], 'roles': []})
+            return
+
+        matches = re.match('/jobs/([^/]+)(?:/(files|dm))?$', path)
+        if matches is None:
+            self._respond({'status': '404 Not Found'}, 404)
+            return
+
+        job_ids = matches.group(1).split(',')
+
+        with server.lock:
+            if len(job_ids) > 1:
+                server.num_bulk_queries += 1
+            else:
+                server.job_queries[job_ids[0]] = server.job_queries.get(job_ids[0], 0) + 1
+
+            jobs = [server.jobs.get(job_id) for job_id in job_ids]
+            jobs = [json.loads(json.dumps(job)) for job in jobs if job is not None]
+
+        if len(jobs) == 0:
+            self._respond({'status': '404 Not Found'}, 404)
+            return
+
+        if matches.group(2) is not None:
+            # file or data management listing of one job
+            self._respond(jobs[0][matches.group(2)])
+            return
+
+        fields = urlparse.parse_qs(url.query).get('files')
+        if fields is None:
+            for job in jobs:
+                job.pop('files')
+                job.pop('dm')
+        else:
+            # only the requested file fields, as the bulk listing does
+            fields = fields[0].split(',')
+            for job in jobs:
+                job['files'] = [dict((k, v) for k, v in f.iteritems() if k in fields) for f in job['files']]
+                job['dm'] = [dict((k, v) for k, v in f.iteritems() if k in fields) for f in job['dm']]
+
+        if len(job_ids) == 1:
+            self._respond(jobs[0])
+        else:
+            self._respond(jobs)
+
+    def _respond(self, content, code = 200):
+        content = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+failures = []
+
+def check(title, condition):
+    print '%-60s %s' % (title, 'OK' if condition else 'FAILED')
+    if not condition:
+        failures.append(title)
+
+## Scratch bookkeeping database
+
+db = MySQL()
+
+db.query('DROP DATABASE IF EXISTS `%s`' % args.db)
+db.query('CREATE DATABASE `%s`' % args.db)
+for table in ['fts_servers', 'fts_transfer_batches', 'fts_transfer_tasks', 'fts_deletion_batches', 'fts_deletion_tasks', 'fts_staging_queue']:
+    with open('%s/dynamo/%s.sql' % (args.schema, table)) as source:
+        db.query(source.read().replace('CREATE TABLE `', 'CREATE TABLE `%s`.`' % args.db, 1))
+
+db_params = Configuration(db.config())
+db_params['db'] = args.db
+
+server = MockFTSServer()
+
+num_threads = 4
+config = Configuration(fts_server = server.url, db_params = db_params, status_poll_threads = num_threads,
+    status_bulk_size = 5, status_lifetime = 1, batch_size = 100, x509proxy = args.x509)
+
+operation = FTSFileOperation(config)
+operation._set_server_id()
+
+## Jobs as if submitted: transfer jobs in batches 1 and 2, one deletion job in batch 3
+
+states = ['SUBMITTED', 'ACTIVE', 'FINISHED', 'FAILED']
+expected_status = {'SUBMITTED': FileQuery.STAT_NEW, 'ACTIVE': FileQuery.STAT_QUEUED, 'FINISHED': FileQuery.STAT_DONE, 'FAILED': FileQuery.STAT_FAILED}
+
+task_id = 0
+file_id = 0
+# {task_id: (batch_id, job_id, expected status)}
+tasks = {}
+
+def make_file(job_state, optype):
+    global file_id
+    file_id += 1
+    entry = {'file_id': file_id, 'file_state': job_state, 'reason': None, 'start_time': None, 'finish_time': None}
+    if job_state in FINAL_STATES:
+        entry['start_time'] = '2020-01-01T00:00:00'
+        entry['finish_time'] = '2020-01-01T00:10:00'
+    if job_state == 'FAILED':
+        entry['reason'] = 'TRANSFER [5] mock failure'
+    if optype == 'transfer':
+        entry['source_surl'] = 'gsiftp://source/store/file%d' % file_id
+        entry['dest_surl'] = 'gsiftp://dest/store/file%d' % file_id
+    else:
+        entry['source_surl'] = 'gsiftp://dest/store/file%d' % file_id
+
+    return entry
+
+for ijob in xrange(args.jobs + 1):
+    if ijob == args.jobs:
+        optype, batch_id = 'deletion', 3
+    else:
+        optype, batch_id = 'transfer', ijob % 2 + 1
+
+    job_id = '%s-%04d' % (optype, ijob)
+    job_state = states[ijob % len(states)]
+    files = [make_file(job_state, optype) for _ in xrange(args.files)]
+
+    if optype == 'transfer':
+        server.jobs[job_id] = {'job_id': job_id, 'job_state': job_state, 'files': files, 'dm': []}
+        fts_batch_id = operation.db.insert_get_id('fts_transfer_batches', ('batch_id', 'task_type', 'fts_server_id', 'job_id'), (batch_id, 'transfer', operation.server_id, job_id))
+    else:
+        server.jobs[job_id] = {'job_id': job_id, 'job_state': job_state, 'files': [], 'dm': files}
+        fts_batch_id = operation.db.insert_get_id('fts_deletion_batches', ('batch_id', 'fts_server_id', 'job_id'), (batch_id, operation.server_id, job_id))
+
+    for entry in files:
+        task_id += 1
+        tasks[task_id] = (batch_id, job_id, expected_status[job_state])
+        table = 'fts_transfer_tasks' if optype == 'transfer' else 'fts_deletion_tasks'
+        operation.db.insert_many(table, ('id', 'fts_batch_id', 'fts_file_id'), None, [(task_id, fts_batch_id, entry['file_id'])])
+
+## First sweep
+
+results = {}
+for batch_id in (1, 2):
+    for result in operation.get_transfer_status(batch_id):
+        results[result[0]] = result
+for result in operation.get_deletion_status(3):
+    results[result[0]] = result
+
+check('Every task reported once', sorted(results.keys()) == sorted(tasks.keys()))
+check('Task statuses follow the job file states', all(results[tid][1] == tasks[tid][2] for tid in results))
+check('Exit code parsed from the failure reason', all(results[tid][2] == 5 for tid in results if tasks[tid][2] == FileQuery.STAT_FAILED))
+check('Finish time of completed tasks', all(results[tid][5] is not None for tid in results if tasks[tid][2] == FileQuery.STAT_DONE))
+check('Concurrent queries bounded by status_poll_threads', server.max_active <= num_threads)
+check('FTS sessions pooled', server.num_contexts <= num_threads + 1)
+
+## Second sweep: jobs in a final state are not queried again
+
+final_jobs = [job_id for job_id, job in server.jobs.iteritems() if job['job_state'] in FINAL_STATES]
+queries_before = dict((job_id, server.job_queries.get(job_id, 0)) for job_id in final_jobs)
+bulk_before = server.num_bulk_queries
+
+# let the polled statuses expire and move the active jobs along
+time.sleep(1.5)
+for job in server.jobs.itervalues():
+    if job['job_state'] == 'ACTIVE':
+        job['job_state'] = 'FINISHED'
+        for entry in job['files']:
+            entry.update(file_state = 'FINISHED', start_time = '2020-01-01T00:00:00', finish_time = '2020-01-01T00:10:00')
+
+results = {}
+for batch_id in (1, 2):
+    for result in operation.get_transfer_status(batch_id):
+        results[result[0]] = result
+
+check('Final jobs not queried again', all(server.job_queries.get(job_id, 0) == queries_before[job_id] for job_id in final_jobs))
+check('State changes of running jobs picked up', all(results[tid][1] == FileQuery.STAT_DONE for tid in results if server.jobs[tasks[tid][1]]['job_state'] == 'FINISHED'))
+
+print 'Bulk job listings: %d (first sweep), %d (second sweep)' % (bulk_before, server.num_bulk_queries - bulk_before)
+
+db.query('DROP DATABASE `%s`' % args.db)
+
+sys.stdout.flush()
+os._exit(1 if len(failures) != 0 else 0)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+Test the persistent-connection path of RESTService against local HTTP servers: connection reuse, redirects, no
+retry of POST requests on a stale connection, the total timeout, proxy settings from the environment, and the
+creation of a single auth handler under parallel requests. Exits with status 1 if any check fails.
+"""
+
+import os
+import sys
+import time
+import json
+import logging
+import socket
+import threading
+import BaseHTTPServer
+import SocketServer
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description = 'Test RESTService against local HTTP servers.')
+args = parser.parse_args()
+sys.argv = []
+
+# failed attempts are expected in some checks
+logging.basicConfig(level = logging.CRITICAL)
+
+from dynamo.utils.interface.webservice import RESTService, CERNSSOCookieAuthHandler, POST
+from dynamo.dataformat import Configuration
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.lock = threading.Lock()
+        # client ports of accepted connections
+        self.connections = []
+        # (method, path) of received requests
+        self.requests = []
+        # close the connection after the response without telling the client
+        self.drop_after_response = False
+        self.delay = 0.
+
+        thread = threading.Thread(target = self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # broken pipes from the dropped connections are expected
+        pass
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def get_request(self):
+        sock, address = BaseHTTPServer.HTTPServer.get_request(self)
+        with self.lock:
+            self.connections.append(address[1])
+
+        return sock, address
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        self._respond()
+
+    def _respond(self):
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path))
+
+        time.sleep(self.server.delay)
+
+        if self.path.startswith('/redirect/'):
+            # /redirect/N -> /redirect/N-1 -> ... -> /data
+            remaining = int(self.path[len('/redirect/'):])
+            self.send_response(302)
+            self.send_header('Location', '/redirect/%d' % (remaining - 1) if remaining > 1 else '/data')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        content = json.dumps({'path': self.path, 'method': self.command})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        self.wfile.flush()
+
+        if self.server.drop_after_response:
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = 1
+
+def make_service(url, **kwd):
+    config = Configuration(url_base = url, auth_handler = 'None', **kwd)
+    return RESTService(config)
+
+failures = []
+
+def check(title, condition):
+    print '%-60s %s' % (title, 'OK' if condition else 'FAILED')
+    if not condition:
+        failures.append(title)
+
+for var in ['http_proxy', 'HTTP_PROXY', 'https_proxy', 'HTTPS_PROXY', 'no_proxy', 'NO_PROXY']:
+    os.environ.pop(var, None)
+
+## Connection reuse
+server = StandInServer()
+service = make_service(server.url)
+results = [service.make_request('data/%d' % i) for i in range(10)]
+check('GET results', [r['path'] for r in results] == ['/data/%d' % i for i in range(10)])
+check('10 GET requests over one connection', len(server.connections) == 1)
+
+## Redirects
+result = service.make_request('redirect/3')
+check('Redirects followed to the final resource', result['path'] == '/data')
+
+## Stale connection: GET is retried, POST is not
+server.drop_after_response = True
+service.make_request('data/first')
+time.sleep(0.1)
+result = service.make_request('data/second')
+check('GET retried on a stale connection', result['path'] == '/data/second')
+
+service.make_request('data/third')
+time.sleep(0.1)
+num_posts = len([r for r in server.requests if r[0] == 'POST'])
+try:
+    service.make_request('data/post', ['a=1'], method = POST, retry_on_error = False)
+except RuntimeError:
+    pass
+check('POST on a stale connection not resent', len([r for r in server.requests if r[0] == 'POST']) == num_posts)
+server.drop_after_response = False
+
+## Total timeout over redirects
+server.delay = 0.4
+start = time.time()
+try:
+    service.make_request('redirect/4', retry_on_error = False, timeout = 1)
+except RuntimeError:
+    timed_out = True
+else:
+    timed_out = False
+elapsed = time.time() - start
+check('Timeout applies to the whole redirect chain', timed_out and elapsed < 2.)
+server.delay = 0.
+
+## Proxy from the environment
+proxy = StandInServer()
+target = StandInServer()
+os.environ['http_proxy'] = proxy.url
+try:
+    service = make_service(target.url)
+    result = service.make_request('data/proxied')
+finally:
+    del os.environ['http_proxy']
+check('Request goes through http_proxy', len(proxy.requests) == 1 and proxy.requests[0][1] == target.url + '/data/proxied')
+check('Target not contacted directly when proxied', len(target.requests) == 0)
+
+## One auth handler under parallel requests
+class CountingHandler(CERNSSOCookieAuthHandler):
+    instances = 0
+
+    def __init__(self, config):
+        CountingHandler.instances += 1
+        time.sleep(0.2)
+
+    def add_cookie(self, request):
+        pass
+
+service = make_service(server.url)
+service.auth_handler = CountingHandler
+results = service.make_requests_parallel(['data/%d' % i for i in range(16)], num_threads = 8)
+check('Parallel results', [r['path'] for r in results] == ['/data/%d' % i for i in range(16)])
+check('One auth handler created by parallel requests', CountingHandler.instances == 1)
+
+# server and worker threads are still blocked on keep-alive connections and queues; skip the interpreter shutdown
+sys.stdout.flush()
+os._exit(1 if len(failures) != 0 else 0)